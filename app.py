@@ -4,26 +4,35 @@ Sistema de Registro de Polvorín - Aplicación Flask
 Versión: 4.0 - Sistema Completo con CRUD
 """
 
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, send_file
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, Response, stream_with_context, make_response
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text, and_
+from sqlalchemy import text, and_, or_, event, union_all, select, literal
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime, date, timedelta
 from functools import wraps
-import pyodbc
 import os
 import hashlib
 import time
 import uuid
+import threading
 import json
 
 # Importar sincronización automática
-from sincronizacion_simple import trigger_sincronizacion_stock
+from sincronizacion_simple import encolar_sincronizacion, estado_cola_sincronizacion, suscribir_sincronizacion
+from exportacion_stock import generar_csv, generar_xlsx, FILAS_POR_BLOQUE
+from indice_busqueda import IndiceBusqueda
+from catalogo_explosivos import CatalogoExplosivos
+from difusion_stock import HubStock, SondeoSaldos
+from idempotencia import AlmacenIdempotencia, RespuestaGuardada, clave_valida
+from preinicializacion_turnos import PreinicializadorTurnos
+from stock_diario_disperso import TurnoDerivado, RESPONSABLE_DERIVADO, observaciones_derivadas
+from instrumentacion import instalar_instrumentacion, registrar_estrategia, obtener_metricas, reiniciar_metricas, VENTANA_PETICIONES
 
 app = Flask(__name__)
 app.secret_key = 'pallca_secret_key_2025'
 
-# Configuración de sesiones para evitar duplicados
-app.permanent_session_lifetime = timedelta(minutes=30)  # Transacciones expiran en 30 min
+# Configuración de sesiones
+app.permanent_session_lifetime = timedelta(minutes=30)  # Sesiones expiran en 30 min
 
 # Configuración de SQL Server Azure
 SQLSERVER_CONFIG = {
@@ -47,7 +56,8 @@ connection_string = (
     f"{SQLSERVER_CONFIG['database']}?driver=ODBC+Driver+17+for+SQL+Server"
 )
 
-app.config['SQLALCHEMY_DATABASE_URI'] = connection_string
+# DATABASE_URL permite apuntar a otra base (p. ej. SQLite local para los benchmarks)
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', connection_string)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
     'pool_pre_ping': True,
@@ -57,6 +67,16 @@ app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
 
 db = SQLAlchemy(app)
 
+# Métricas por petición (consultas SQL, tiempo de BD, estrategia de stock) para /admin/metrics.
+# La cabecera Server-Timing solo va a los administradores, como /admin/metrics
+# (SERVER_TIMING=true la envía a todos, p. ej. en desarrollo)
+SERVER_TIMING_TODOS = os.environ.get('SERVER_TIMING', 'false').lower() in ('1', 'true', 'si')
+
+def mostrar_server_timing():
+    return SERVER_TIMING_TODOS or (session.get('cargo') or '').lower() in ['administrador', 'admin']
+
+instalar_instrumentacion(app, mostrar_server_timing)
+
 # Modelos de base de datos (tablas ya existen)
 class Explosivo(db.Model):
     __tablename__ = 'explosivos'
@@ -237,6 +257,56 @@ class NivelAcceso(db.Model):
     def __repr__(self):
         return f'<NivelAcceso {self.id}: {self.nombre}>'
 
+class StockSaldo(db.Model):
+    __tablename__ = 'stock_saldos'
+
+    explosivo_id = db.Column(db.Integer, db.ForeignKey('explosivos.id'), primary_key=True)
+    total_ingresos = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    total_salidas = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    total_devoluciones = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    stock_actual = db.Column(db.Numeric(12, 2), nullable=False, default=0)  # ingresos - salidas + devoluciones
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<StockSaldo explosivo {self.explosivo_id}: {self.stock_actual}>'
+
+class StockMovimientoTurno(db.Model):
+    __tablename__ = 'stock_movimientos_turno'
+
+    explosivo_id = db.Column(db.Integer, db.ForeignKey('explosivos.id'), primary_key=True)
+    fecha = db.Column(db.Date, primary_key=True)
+    guardia = db.Column(db.String(10), primary_key=True)  # 'dia' o 'noche'
+    ingresos = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    salidas = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    devoluciones = db.Column(db.Numeric(12, 2), nullable=False, default=0)
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<StockMovimientoTurno {self.explosivo_id} {self.fecha} {self.guardia}>'
+
+class StockRecalculoPendiente(db.Model):
+    __tablename__ = 'stock_recalculo_pendiente'
+
+    explosivo_id = db.Column(db.Integer, db.ForeignKey('explosivos.id'), primary_key=True)
+    sucio_desde = db.Column(db.Date, nullable=False)  # stock_diario a recalcular desde esta fecha
+    fecha_actualizacion = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<StockRecalculoPendiente {self.explosivo_id} desde {self.sucio_desde}>'
+
+class IdempotenciaRespuesta(db.Model):
+    __tablename__ = 'idempotencia_respuestas'
+
+    clave = db.Column(db.String(200), primary_key=True)  # usuario:ruta:Idempotency-Key
+    estado = db.Column(db.String(20), nullable=False)  # 'en_proceso' o 'completada'
+    codigo = db.Column(db.Integer)
+    cuerpo = db.Column(db.Text)
+    tipo = db.Column(db.String(100))
+    creado_en = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+    def __repr__(self):
+        return f'<IdempotenciaRespuesta {self.clave}: {self.estado}>'
+
 # Funciones auxiliares
 def obtener_guardia_actual():
     """Determinar la guardia actual basado en la hora"""
@@ -344,31 +414,68 @@ def clasificar_explosivo_por_grupo(descripcion):
     # Grupo 5: Todos los demás (detonadores, cordones, accesorios, etc.)
     return 5
 
-def obtener_explosivos_ordenados():
-    """Obtener explosivos ordenados por grupo de la base de datos y luego por código"""
-    explosivos = Explosivo.query.all()
-    
-    def orden_personalizado(explosivo):
-        # Usar directamente la columna grupo de la base de datos
-        grupo = explosivo.grupo or 'ZZZ'  # Si no tiene grupo, va al final
-        
-        # Dentro del grupo EXPLOSIVOS, SUPERFAM tiene prioridad especial
-        if grupo == 'EXPLOSIVOS':
-            desc_upper = explosivo.descripcion.upper()
-            # SUPERFAM/ANFO aparece primero
-            if 'SUPERFAM' in desc_upper or 'ANFO' in desc_upper:
-                return (grupo, '0', explosivo.codigo)
-            # Los demás van por código normal
+# Catálogo de explosivos en memoria del proceso: se carga en el primer uso y cada
+# CATALOGO_VERIFICACION_SEG segundos se compara una firma barata de la tabla para
+# detectar cambios hechos desde scripts u otros procesos.
+CATALOGO_VERIFICACION_SEG = int(os.environ.get('CATALOGO_VERIFICACION_SEG', 60))
+
+catalogo_explosivos = CatalogoExplosivos()
+_catalogo_lock = threading.Lock()
+
+def firma_catalogo_explosivos():
+    """Firma de la tabla explosivos en una consulta agregada (sin leer las filas)"""
+    if db.engine.dialect.name == 'mssql':
+        query = """
+            SELECT COUNT(*) AS total, CHECKSUM_AGG(BINARY_CHECKSUM(id, codigo, descripcion, unidad, grupo)) AS firma
+            FROM explosivos
+        """
+    else:
+        # Base local de benchmarks: sin CHECKSUM_AGG, basta con altas y bajas
+        query = "SELECT COUNT(*) AS total, MAX(id) AS firma FROM explosivos"
+
+    row = db.session.execute(text(query)).fetchone()
+    return (row.total, row.firma)
+
+def cargar_catalogo_explosivos():
+    """Leer el catálogo completo y reemplazar la instantánea en memoria"""
+    firma = firma_catalogo_explosivos()
+    registros = db.session.query(
+        Explosivo.id, Explosivo.codigo, Explosivo.descripcion, Explosivo.unidad, Explosivo.grupo
+    ).all()
+    if catalogo_explosivos.cargar([tuple(r) for r in registros], firma=firma, cargado_en=time.time()):
+        incrementar_version_datos()
+        print(f"📦 Catálogo de explosivos cargado: {len(registros)} explosivos (versión {catalogo_explosivos.version})")
+
+def obtener_catalogo_explosivos(forzar=False):
+    """Catálogo listo para leer; se recarga si fue invalidado o si cambió la firma de la tabla"""
+    if not forzar and catalogo_explosivos.cargado and time.time() - catalogo_explosivos.verificado_en < CATALOGO_VERIFICACION_SEG:
+        return catalogo_explosivos
+
+    with _catalogo_lock:
+        if not forzar and catalogo_explosivos.cargado and time.time() - catalogo_explosivos.verificado_en < CATALOGO_VERIFICACION_SEG:
+            return catalogo_explosivos
+
+        try:
+            if not forzar and catalogo_explosivos.cargado and firma_catalogo_explosivos() == catalogo_explosivos.firma:
+                catalogo_explosivos.marcar_verificado(time.time())
             else:
-                return (grupo, '1', explosivo.codigo)
-        
-        # Para otros grupos, ordenar por código
-        return (grupo, '0', explosivo.codigo)
-    
-    # Ordenar usando la función personalizada
-    explosivos_ordenados = sorted(explosivos, key=orden_personalizado)
-    
-    return explosivos_ordenados
+                cargar_catalogo_explosivos()
+        except Exception as e:
+            db.session.rollback()
+            if not catalogo_explosivos.cargado:
+                raise
+            # Conservar el catálogo anterior hasta el próximo intento
+            print(f"⚠️ Error verificando catálogo de explosivos, se mantiene el anterior: {e}")
+
+    return catalogo_explosivos
+
+def obtener_explosivos_ordenados():
+    """Explosivos ordenados por grupo y luego por código (desde el catálogo en memoria)"""
+    return obtener_catalogo_explosivos().ordenados()
+
+def obtener_explosivos_por_codigo():
+    """Explosivos ordenados por código (listas de los formularios de edición)"""
+    return sorted(obtener_catalogo_explosivos().ordenados(), key=lambda e: e.codigo)
 
 def obtener_explosivo_id_de_devolucion(devolucion_id):
     """Obtener explosivo_id de una devolución a través de stock_diario"""
@@ -382,9 +489,836 @@ def obtener_explosivo_id_de_devolucion(devolucion_id):
         print(f"Error obteniendo explosivo_id de devolución {devolucion_id}: {e}")
         return None
 
+# Versión global de los datos para GET condicionales (ETag). Sube con cada movimiento
+# confirmado, cada sincronización de stock_diario y cada cambio de catálogo o labores.
+# Es del proceso: los cambios hechos por otros workers o scripts no la mueven, por eso
+# el ETag incluye además un periodo de DATOS_VERSION_VIGENCIA_SEG segundos.
+DATOS_VERSION_VIGENCIA_SEG = int(os.environ.get('DATOS_VERSION_VIGENCIA_SEG', 30))
+
+_version_datos = {'version': 0, 'instancia': uuid.uuid4().hex[:8]}
+_version_datos_lock = threading.Lock()
+
+def incrementar_version_datos(*_):
+    with _version_datos_lock:
+        _version_datos['version'] += 1
+
+def etag_version_datos():
+    """ETag débil de la versión de datos vigente (distinto por proceso y por periodo)"""
+    periodo = int(time.time() // DATOS_VERSION_VIGENCIA_SEG)
+    return f"{os.getpid():x}-{_version_datos['instancia']}-{_version_datos['version']}-{periodo}"
+
+def con_version_datos(f):
+    """Decorador para APIs de lectura: 304 sin consultar la base si el cliente ya tiene la versión vigente"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        # La versión se toma antes de generar la respuesta: un cambio concurrente deja el ETag viejo
+        etag = etag_version_datos()
+        if request.if_none_match.contains_weak(etag):
+            respuesta = Response(status=304)
+        else:
+            respuesta = make_response(f(*args, **kwargs))
+            if respuesta.status_code != 200:
+                return respuesta
+        respuesta.set_etag(etag, weak=True)
+        respuesta.headers['Cache-Control'] = 'private, no-cache'
+        return respuesta
+    return decorated_function
+
+# Idempotencia de los registros (cabecera Idempotency-Key): la memoria del proceso responde
+# los reintentos al instante; la tabla idempotencia_respuestas, si existe, cubre varios workers.
+IDEMPOTENCIA_TTL_SEG = int(os.environ.get('IDEMPOTENCIA_TTL_SEG', 24 * 3600))
+IDEMPOTENCIA_ESPERA_SEG = 15  # Espera máxima de un doble clic por la respuesta del primero
+IDEMPOTENCIA_PURGA_SEG = 600
+almacen_idempotencia = AlmacenIdempotencia(
+    max_claves=int(os.environ.get('IDEMPOTENCIA_MAX_CLAVES', 2000)),
+    ttl_seg=IDEMPOTENCIA_TTL_SEG
+)
+_purga_idempotencia = {'ultima': 0.0}
+
+def respuesta_repetida(guardada):
+    """Respuesta original de una clave ya procesada"""
+    respuesta = Response(guardada.cuerpo, status=guardada.codigo, mimetype=guardada.tipo)
+    respuesta.headers['Idempotent-Replayed'] = 'true'
+    return respuesta
+
+def reservar_clave_bd(clave):
+    """Reservar la clave en idempotencia_respuestas. Retorna (estado, RespuestaGuardada o None)"""
+    if not obtener_capacidades()['idempotencia_respuestas']:
+        return AlmacenIdempotencia.NUEVA, None
+
+    ahora = datetime.now()
+    params = {
+        'clave': clave,
+        'ahora': ahora,
+        'vencidas': ahora - timedelta(seconds=IDEMPOTENCIA_TTL_SEG),
+        'abandonadas': ahora - timedelta(seconds=almacen_idempotencia.reserva_seg)
+    }
+    try:
+        # Conexión propia: la reserva se confirma antes que el registro (otro worker la ve)
+        with db.engine.begin() as conn:
+            if time.time() - _purga_idempotencia['ultima'] > IDEMPOTENCIA_PURGA_SEG:
+                _purga_idempotencia['ultima'] = time.time()
+                conn.execute(text("DELETE FROM idempotencia_respuestas WHERE creado_en < :vencidas"), params)
+            else:
+                conn.execute(text("DELETE FROM idempotencia_respuestas WHERE clave = :clave AND creado_en < :vencidas"), params)
+
+            # Reserva de un worker caído a mitad del registro: se toma de nuevo
+            tomada = conn.execute(text("""
+                UPDATE idempotencia_respuestas SET creado_en = :ahora
+                WHERE clave = :clave AND estado = 'en_proceso' AND creado_en < :abandonadas
+            """), params).rowcount
+            if tomada:
+                return AlmacenIdempotencia.NUEVA, None
+
+            fila = conn.execute(text("""
+                SELECT estado, codigo, cuerpo, tipo FROM idempotencia_respuestas WHERE clave = :clave
+            """), params).first()
+            if fila is None:
+                conn.execute(text("""
+                    INSERT INTO idempotencia_respuestas (clave, estado, creado_en)
+                    VALUES (:clave, 'en_proceso', :ahora)
+                """), params)
+                return AlmacenIdempotencia.NUEVA, None
+
+        if fila.estado == 'completada':
+            return AlmacenIdempotencia.COMPLETADA, RespuestaGuardada(fila.codigo, fila.cuerpo, fila.tipo)
+        return AlmacenIdempotencia.EN_PROCESO, None
+    except IntegrityError:
+        # Otro worker reservó la misma clave entre la lectura y el INSERT
+        return AlmacenIdempotencia.EN_PROCESO, None
+    except Exception as e:
+        # Sin la tabla compartida queda la deduplicación en memoria
+        print(f"⚠️ Error reservando clave de idempotencia: {e}")
+        return AlmacenIdempotencia.NUEVA, None
+
+def completar_clave_bd(clave, guardada):
+    if not obtener_capacidades()['idempotencia_respuestas']:
+        return
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(text("""
+                UPDATE idempotencia_respuestas
+                SET estado = 'completada', codigo = :codigo, cuerpo = :cuerpo, tipo = :tipo
+                WHERE clave = :clave
+            """), {'clave': clave, 'codigo': guardada.codigo, 'cuerpo': guardada.cuerpo, 'tipo': guardada.tipo})
+    except Exception as e:
+        print(f"⚠️ Error guardando respuesta idempotente: {e}")
+
+def liberar_clave_bd(clave):
+    if not obtener_capacidades()['idempotencia_respuestas']:
+        return
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(text("""
+                DELETE FROM idempotencia_respuestas WHERE clave = :clave AND estado = 'en_proceso'
+            """), {'clave': clave})
+    except Exception as e:
+        print(f"⚠️ Error liberando clave de idempotencia: {e}")
+
+def con_idempotencia(f):
+    """Decorador para los POST de registro: la misma Idempotency-Key devuelve la respuesta original
+
+    Solo se guardan las respuestas exitosas; si el registro falla la clave se libera y
+    el reintento se ejecuta de nuevo. Sin cabecera, la petición se procesa como siempre.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        valor = request.headers.get('Idempotency-Key')
+        if request.method != 'POST' or not valor:
+            return f(*args, **kwargs)
+        if not clave_valida(valor):
+            return jsonify({'error': 'Idempotency-Key inválida'}), 400
+
+        # La clave vale por usuario y por ruta
+        clave = f"{session.get('user_id')}:{request.endpoint}:{valor}"
+        en_proceso = lambda: (jsonify({'error': 'Este registro ya se está procesando. Espere la confirmación.'}), 409)
+
+        estado, entrada = almacen_idempotencia.reservar(clave)
+        if estado == AlmacenIdempotencia.COMPLETADA:
+            return respuesta_repetida(entrada.respuesta)
+        if estado == AlmacenIdempotencia.EN_PROCESO:
+            # Doble clic en este proceso: esperar la respuesta del primer envío
+            guardada = almacen_idempotencia.esperar(entrada, IDEMPOTENCIA_ESPERA_SEG)
+            return respuesta_repetida(guardada) if guardada else en_proceso()
+
+        estado, guardada = reservar_clave_bd(clave)
+        if estado == AlmacenIdempotencia.COMPLETADA:
+            almacen_idempotencia.completar(clave, guardada)
+            return respuesta_repetida(guardada)
+        if estado == AlmacenIdempotencia.EN_PROCESO:
+            almacen_idempotencia.liberar(clave)
+            return en_proceso()
+
+        try:
+            respuesta = make_response(f(*args, **kwargs))
+        except Exception:
+            almacen_idempotencia.liberar(clave)
+            liberar_clave_bd(clave)
+            raise
+
+        if 200 <= respuesta.status_code < 300:
+            guardada = RespuestaGuardada(respuesta.status_code, respuesta.get_data(as_text=True), respuesta.mimetype)
+            almacen_idempotencia.completar(clave, guardada)
+            completar_clave_bd(clave, guardada)
+        else:
+            almacen_idempotencia.liberar(clave)
+            liberar_clave_bd(clave)
+        return respuesta
+    return decorated_function
+
+# Difusión de cambios de stock a los formularios abiertos (/api/stock/stream). Cada stream
+# ocupa un hilo del worker gthread: por defecto se admite la mitad de GUNICORN_THREADS y el
+# resto de los formularios sondea /api/stock-masivo (ver static/js/stock_en_vivo.js)
+SSE_MAX_CONEXIONES = int(os.environ.get('SSE_MAX_CONEXIONES', max(1, int(os.environ.get('GUNICORN_THREADS', 8)) // 2)))
+SSE_SONDEO_SALDOS_SEG = int(os.environ.get('SSE_SONDEO_SALDOS_SEG', 2))
+
+hub_stock = HubStock(max_suscriptores=SSE_MAX_CONEXIONES)
+
+# Cachés derivadas de los movimientos (dashboard, versión de datos, difusión): registrar_delta_stock
+# y su versión en lote acumulan en la sesión el delta de stock por explosivo, y todo se
+# invalida o publica recién al confirmarse la transacción.
+def marcar_movimientos_en_sesion(deltas):
+    acumulado = db.session.info.setdefault('movimientos_stock', {})
+    for explosivo_id, delta in deltas.items():
+        acumulado[explosivo_id] = acumulado.get(explosivo_id, 0.0) + delta
+
+def _tras_commit_movimientos(sesion):
+    # after_commit también se emite al liberar un SAVEPOINT (begin_nested): solo cuenta el commit real
+    if sesion.in_nested_transaction():
+        return
+    deltas = sesion.info.pop('movimientos_stock', None)
+    if deltas is None:
+        return
+    incrementar_version_datos()
+    invalidar_cache_dashboard()
+    if hub_stock.activo:
+        hub_stock.publicar(deltas, version=_version_datos['version'], saldos=leer_saldos_confirmados(deltas))
+
+def leer_saldos_confirmados(explosivos_ids):
+    """Saldos de stock_saldos ya confirmados (conexión propia: la sesión acaba de hacer commit)"""
+    try:
+        if not obtener_capacidades()['stock_saldos']:
+            return None
+        saldos = {}
+        with db.engine.connect() as conn:
+            for lote in dividir_en_lotes(sorted(explosivos_ids), 1):
+                placeholders = ','.join(f':id_{i}' for i in range(len(lote)))
+                result = conn.execute(text(f"""
+                    SELECT explosivo_id, stock_actual FROM stock_saldos WHERE explosivo_id IN ({placeholders})
+                """), {f'id_{i}': explosivo_id for i, explosivo_id in enumerate(lote)})
+                saldos.update({row.explosivo_id: float(row.stock_actual) for row in result})
+        return saldos
+    except Exception as e:
+        print(f"⚠️ Error leyendo saldos para difusión: {e}")
+        return None
+
+def leer_saldos_actualizados(desde=None):
+    """Tarea del sondeo de difusión: saldos de stock_saldos actualizados desde `desde`"""
+    with app.app_context():
+        if not obtener_capacidades()['stock_saldos']:
+            return {}
+        query = "SELECT explosivo_id, stock_actual FROM stock_saldos"
+        if desde is not None:
+            query += " WHERE fecha_actualizacion >= :desde"
+        with db.engine.connect() as conn:
+            result = conn.execute(text(query), {'desde': desde})
+            return {row.explosivo_id: float(row.stock_actual) for row in result}
+
+# Commits de otros workers y scripts: un solo sondeo por proceso, mientras haya streams abiertos
+sondeo_saldos = SondeoSaldos(hub_stock, leer_saldos_actualizados, intervalo_seg=SSE_SONDEO_SALDOS_SEG)
+
+def _tras_rollback_movimientos(sesion, transaccion_anterior):
+    # Solo el rollback de la transacción externa descarta los movimientos (no los savepoints)
+    if transaccion_anterior.parent is None:
+        sesion.info.pop('movimientos_stock', None)
+
+event.listen(db.session, 'after_commit', _tras_commit_movimientos)
+event.listen(db.session, 'after_soft_rollback', _tras_rollback_movimientos)
+# stock_diario se recalcula después del commit, en el hilo de sincronización
+suscribir_sincronizacion(incrementar_version_datos)
+
+def bloqueo_comprobacion():
+    """Pista para el NOT EXISTS de un INSERT si falta la fila: en SQL Server bloquea el rango,
+    así una segunda transacción espera a la primera en lugar de crear la misma fila"""
+    return 'WITH (UPDLOCK, HOLDLOCK)' if db.engine.dialect.name == 'mssql' else ''
+
+def sumar_o_crear_fila(sumar, crear, params):
+    """UPDATE de la fila de un agregado y, si no existe, INSERT ... WHERE NOT EXISTS.
+
+    Si otra transacción creó la fila entretanto (IntegrityError, o el INSERT no insertó
+    nada) se repite el UPDATE: la fila creada por la otra no incluye este movimiento.
+    """
+    if db.session.execute(sumar, params).rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            creadas = db.session.execute(crear, params).rowcount
+    except IntegrityError:
+        creadas = 0
+    if not creadas:
+        db.session.execute(sumar, params)
+
+def sumar_saldo_explosivo(params):
+    """Delta de un explosivo en stock_saldos (params: explosivo_id, ingresos, salidas, devoluciones, ahora).
+
+    Si el explosivo aún no tiene fila, se crea recalculando desde el historial, que ya
+    incluye el movimiento actual por estar en la misma transacción.
+    """
+    sumar_o_crear_fila(text("""
+        UPDATE stock_saldos
+        SET total_ingresos = total_ingresos + :ingresos,
+            total_salidas = total_salidas + :salidas,
+            total_devoluciones = total_devoluciones + :devoluciones,
+            stock_actual = stock_actual + :ingresos - :salidas + :devoluciones,
+            fecha_actualizacion = :ahora
+        WHERE explosivo_id = :explosivo_id
+    """), text(f"""
+        INSERT INTO stock_saldos (explosivo_id, total_ingresos, total_salidas, total_devoluciones, stock_actual, fecha_actualizacion)
+        SELECT :explosivo_id, t.ingresos, t.salidas, t.devoluciones, t.ingresos - t.salidas + t.devoluciones, :ahora
+        FROM (
+            SELECT
+                (SELECT COALESCE(SUM(cantidad), 0) FROM ingresos WHERE explosivo_id = :explosivo_id) AS ingresos,
+                (SELECT COALESCE(SUM(cantidad), 0) FROM salidas WHERE explosivo_id = :explosivo_id) AS salidas,
+                (SELECT COALESCE(SUM(cantidad_devuelta), 0) FROM devoluciones WHERE explosivo_id = :explosivo_id) AS devoluciones
+        ) t
+        WHERE NOT EXISTS (SELECT 1 FROM stock_saldos ss {bloqueo_comprobacion()} WHERE ss.explosivo_id = :explosivo_id)
+    """), params)
+
+def sumar_turno_explosivo(params):
+    """Delta de un explosivo en stock_movimientos_turno (params: explosivo_id, fecha, guardia,
+    inicio, fin, ingresos, salidas, devoluciones, ahora).
+
+    Si la fila del turno no existe se crea desde los movimientos de ese turno, que ya
+    incluyen el movimiento actual.
+    """
+    sumar_o_crear_fila(text("""
+        UPDATE stock_movimientos_turno
+        SET ingresos = ingresos + :ingresos,
+            salidas = salidas + :salidas,
+            devoluciones = devoluciones + :devoluciones,
+            fecha_actualizacion = :ahora
+        WHERE explosivo_id = :explosivo_id AND fecha = :fecha AND guardia = :guardia
+    """), text(f"""
+        INSERT INTO stock_movimientos_turno (explosivo_id, fecha, guardia, ingresos, salidas, devoluciones, fecha_actualizacion)
+        SELECT :explosivo_id, :fecha, :guardia, t.ingresos, t.salidas, t.devoluciones, :ahora
+        FROM (
+            SELECT
+                (SELECT COALESCE(SUM(cantidad), 0) FROM ingresos
+                 WHERE explosivo_id = :explosivo_id AND guardia = :guardia
+                 AND fecha_ingreso >= :inicio AND fecha_ingreso < :fin) AS ingresos,
+                (SELECT COALESCE(SUM(cantidad), 0) FROM salidas
+                 WHERE explosivo_id = :explosivo_id AND guardia = :guardia
+                 AND fecha_salida >= :inicio AND fecha_salida < :fin) AS salidas,
+                (SELECT COALESCE(SUM(d.cantidad_devuelta), 0) FROM devoluciones d
+                 LEFT JOIN salidas s ON d.salida_id = s.id
+                 WHERE COALESCE(d.explosivo_id, s.explosivo_id) = :explosivo_id AND d.guardia = :guardia
+                 AND d.fecha_devolucion >= :inicio AND d.fecha_devolucion < :fin) AS devoluciones
+        ) t
+        WHERE NOT EXISTS (
+            SELECT 1 FROM stock_movimientos_turno mt {bloqueo_comprobacion()}
+            WHERE mt.explosivo_id = :explosivo_id AND mt.fecha = :fecha AND mt.guardia = :guardia
+        )
+    """), params)
+
+def registrar_delta_stock(explosivo_id, ingresos=0, salidas=0, devoluciones=0, fecha=None, guardia=None):
+    """Actualizar el saldo acumulado de stock_saldos en la misma transacción del movimiento.
+
+    Se llama después de insertar, editar o eliminar un movimiento (con deltas negativos
+    para revertir). Con fecha y guardia también se actualiza el agregado por turno (stock_movimientos_turno).
+    """
+    marcar_movimientos_en_sesion({explosivo_id: float(ingresos or 0) - float(salidas or 0) + float(devoluciones or 0)})
+    params = {
+        'explosivo_id': explosivo_id,
+        'ingresos': float(ingresos or 0),
+        'salidas': float(salidas or 0),
+        'devoluciones': float(devoluciones or 0),
+        'ahora': datetime.now()
+    }
+
+    try:
+        # Asegurar que los cambios ORM pendientes (ediciones) estén en la transacción
+        db.session.flush()
+
+        with db.session.begin_nested():
+            sumar_saldo_explosivo(params)
+        ok = True
+
+    except Exception as e:
+        # El movimiento se conserva; el saldo se corrige con reconstruir_stock_saldos.py
+        print(f"⚠️ Error actualizando stock_saldos para explosivo {explosivo_id}: {e}")
+        ok = False
+
+    if fecha is not None and guardia:
+        registrar_delta_turno(explosivo_id, fecha, guardia, ingresos, salidas, devoluciones)
+    if fecha is not None:
+        marcar_recalculo_pendiente(explosivo_id, fecha)
+    return ok
+
+def registrar_delta_turno(explosivo_id, fecha, guardia, ingresos=0, salidas=0, devoluciones=0):
+    """Actualizar stock_movimientos_turno (totales por explosivo, fecha y guardia) en la transacción actual"""
+    if not obtener_capacidades()['stock_movimientos_turno']:
+        return False
+
+    if isinstance(fecha, datetime):
+        fecha = fecha.date()
+    inicio = datetime.combine(fecha, datetime.min.time())
+
+    params = {
+        'explosivo_id': explosivo_id,
+        'fecha': fecha,
+        'guardia': guardia,
+        'inicio': inicio,
+        'fin': inicio + timedelta(days=1),
+        'ingresos': float(ingresos or 0),
+        'salidas': float(salidas or 0),
+        'devoluciones': float(devoluciones or 0),
+        'ahora': datetime.now()
+    }
+
+    try:
+        with db.session.begin_nested():
+            sumar_turno_explosivo(params)
+        return True
+
+    except Exception as e:
+        # El movimiento se conserva; el agregado se corrige con reconstruir_stock_saldos.py
+        print(f"⚠️ Error actualizando stock_movimientos_turno para explosivo {explosivo_id} {fecha} {guardia}: {e}")
+        return False
+
+def marcar_explosivo(params):
+    """Marca "sucio desde" de un explosivo (params: explosivo_id, fecha, ahora).
+
+    fecha_actualizacion cambia siempre, aunque ya hubiera una marca más antigua: el
+    recálculo incremental adelanta o borra la marca comparando esa columna
+    (recalcular_stock_automatico.avanzar_marca), así que un movimiento confirmado
+    después de leerla hace fallar el compare-and-swap.
+    """
+    sumar_o_crear_fila(text("""
+        UPDATE stock_recalculo_pendiente
+        SET sucio_desde = CASE WHEN sucio_desde > :fecha THEN :fecha ELSE sucio_desde END,
+            fecha_actualizacion = :ahora
+        WHERE explosivo_id = :explosivo_id
+    """), text(f"""
+        INSERT INTO stock_recalculo_pendiente (explosivo_id, sucio_desde, fecha_actualizacion)
+        SELECT :explosivo_id, :fecha, :ahora
+        WHERE NOT EXISTS (
+            SELECT 1 FROM stock_recalculo_pendiente rp {bloqueo_comprobacion()} WHERE rp.explosivo_id = :explosivo_id
+        )
+    """), params)
+
+def marcar_recalculo_pendiente(explosivo_id, fecha):
+    """Bajar la marca "sucio desde" del explosivo a la fecha del movimiento (transacción actual).
+
+    Todo stock_diario del explosivo desde esa fecha queda pendiente de recálculo
+    incremental (python recalcular_stock_automatico.py --incremental).
+    """
+    if not obtener_capacidades()['stock_recalculo_pendiente']:
+        return False
+
+    if isinstance(fecha, datetime):
+        fecha = fecha.date()
+    params = {'explosivo_id': explosivo_id, 'fecha': fecha, 'ahora': datetime.now()}
+
+    try:
+        with db.session.begin_nested():
+            marcar_explosivo(params)
+        return True
+
+    except Exception as e:
+        # El movimiento se conserva; un recálculo completo cubre lo que falte
+        print(f"⚠️ Error marcando recálculo pendiente para explosivo {explosivo_id} desde {fecha}: {e}")
+        return False
+
+def registrar_edicion_stock(campo, explosivo_id_original, cantidad_original, explosivo_id_nuevo, cantidad_nueva,
+                            turno_original=(None, None), turno_nuevo=(None, None)):
+    """Reflejar en stock_saldos la edición de un movimiento ('ingresos', 'salidas' o 'devoluciones')
+
+    turno_original / turno_nuevo: (fecha, guardia) del movimiento antes y después de la edición,
+    para mantener stock_movimientos_turno.
+    """
+    fecha_original, guardia_original = turno_original
+    fecha_nueva, guardia_nueva = turno_nuevo
+    if isinstance(fecha_original, datetime):
+        fecha_original = fecha_original.date()
+    if isinstance(fecha_nueva, datetime):
+        fecha_nueva = fecha_nueva.date()
+
+    if explosivo_id_original == explosivo_id_nuevo and (fecha_original, guardia_original) == (fecha_nueva, guardia_nueva):
+        # Mismo explosivo y turno: aplicar solo la diferencia neta
+        delta = float(cantidad_nueva or 0) - float(cantidad_original or 0)
+        return registrar_delta_stock(explosivo_id_nuevo, fecha=fecha_nueva, guardia=guardia_nueva, **{campo: delta})
+
+    ok = True
+    if explosivo_id_original:
+        ok = registrar_delta_stock(explosivo_id_original, fecha=fecha_original, guardia=guardia_original,
+                                   **{campo: -float(cantidad_original or 0)})
+    return registrar_delta_stock(explosivo_id_nuevo, fecha=fecha_nueva, guardia=guardia_nueva,
+                                 **{campo: float(cantidad_nueva or 0)}) and ok
+
+# Escrituras en lote: SQL Server admite hasta 2100 parámetros y 1000 filas VALUES por sentencia
+MAX_PARAMETROS_SQL = 2000
+MAX_FILAS_VALUES = 1000
+# Cada explosivo aparece ~15 veces en las sentencias CASE de registrar_deltas_stock_lote
+MAX_EXPLOSIVOS_DELTA = MAX_PARAMETROS_SQL // 15
+
+def dividir_en_lotes(filas, parametros_por_fila, parametros_fijos=0):
+    """Lotes que respetan el límite de parámetros y de filas por sentencia"""
+    filas = list(filas)
+    tamano = max(1, min(MAX_FILAS_VALUES, (MAX_PARAMETROS_SQL - parametros_fijos) // parametros_por_fila))
+    for i in range(0, len(filas), tamano):
+        yield filas[i:i + tamano]
+
+def insertar_filas_en_lote(tabla, columnas, filas):
+    """INSERT de varias filas por sentencia (VALUES múltiple) en la transacción actual.
+
+    filas: lista de dicts con las columnas indicadas. Retorna los ids generados en orden
+    ascendente: OUTPUT ... INTO una variable de tabla en SQL Server (compatible con
+    triggers), RETURNING en los demás motores.
+    """
+    ids = []
+    es_sqlserver = db.engine.dialect.name == 'mssql'
+
+    for lote in dividir_en_lotes(filas, len(columnas)):
+        params = {}
+        valores = []
+        for i, fila in enumerate(lote):
+            for columna in columnas:
+                params[f'{columna}_{i}'] = fila[columna]
+            valores.append('(' + ', '.join(f':{columna}_{i}' for columna in columnas) + ')')
+
+        if es_sqlserver:
+            query = f"""
+                SET NOCOUNT ON;
+                DECLARE @insertados TABLE (id INT);
+                INSERT INTO {tabla} ({', '.join(columnas)})
+                OUTPUT INSERTED.id INTO @insertados
+                VALUES {', '.join(valores)};
+                SELECT id FROM @insertados ORDER BY id;
+            """
+        else:
+            query = f"""
+                INSERT INTO {tabla} ({', '.join(columnas)})
+                VALUES {', '.join(valores)}
+                RETURNING id
+            """
+
+        ids.extend(row[0] for row in db.session.execute(text(query), params).fetchall())
+
+    return sorted(ids)
+
+def ajustar_stock_final_lote(ajustes):
+    """Sumar a stock_final de varias filas de stock_diario en una sentencia por lote.
+
+    ajustes: {stock_diario_id: delta} (negativo para salidas).
+    """
+    for lote in dividir_en_lotes(sorted(ajustes.items()), parametros_por_fila=3):
+        params = {}
+        casos, ids = [], []
+        for i, (stock_diario_id, delta) in enumerate(lote):
+            params[f'sd_{i}'] = stock_diario_id
+            params[f'delta_{i}'] = delta
+            casos.append(f"WHEN :sd_{i} THEN :delta_{i}")
+            ids.append(f":sd_{i}")
+
+        db.session.execute(text(f"""
+            UPDATE stock_diario
+            SET stock_final = stock_final + CASE id {' '.join(casos)} END
+            WHERE id IN ({','.join(ids)})
+        """), params)
+
+def sumar_stock_diario_turno_lote(fecha, guardia, deltas):
+    """Upsert en lote del stock_diario de un turno para varios explosivos.
+
+    deltas: {explosivo_id: cantidad a sumar a stock_final}. Las filas existentes se
+    ajustan con ajustar_stock_final_lote; las que faltan se crean con el saldo actual
+    como stock inicial, por eso debe llamarse antes de registrar_deltas_stock_lote.
+    Retorna {explosivo_id: stock_diario_id}.
+    """
+    if isinstance(fecha, datetime):
+        fecha = fecha.date()
+
+    def leer_filas_turno(ids):
+        filas = {}
+        for lote in dividir_en_lotes(ids, 1, parametros_fijos=2):
+            for row in db.session.query(StockDiario.explosivo_id, StockDiario.id).filter(
+                StockDiario.fecha == fecha,
+                StockDiario.guardia == guardia,
+                StockDiario.explosivo_id.in_(lote)
+            ):
+                filas[row.explosivo_id] = row.id
+        return filas
+
+    ids = sorted(deltas)
+    filas = leer_filas_turno(ids)
+    faltantes = [explosivo_id for explosivo_id in ids if explosivo_id not in filas]
+
+    if faltantes:
+        # Saldo previo al movimiento: stock_saldos en una consulta, o el cálculo por explosivo
+        saldos = consultar_stock_saldos(faltantes)
+        if saldos is not None:
+            stock_base = {row.id: int(row.stock_actual) for row in saldos}
+        else:
+            stock_base = {explosivo_id: calcular_stock_explosivo(explosivo_id) for explosivo_id in faltantes}
+
+        ahora = datetime.utcnow()
+        insertar_filas_en_lote('stock_diario', [
+            'explosivo_id', 'fecha', 'guardia', 'stock_inicial', 'stock_final',
+            'responsable_guardia', 'observaciones', 'fecha_registro'
+        ], [{
+            'explosivo_id': explosivo_id,
+            'fecha': fecha,
+            'guardia': guardia,
+            'stock_inicial': stock_base.get(explosivo_id, 0),
+            'stock_final': stock_base.get(explosivo_id, 0) + int(deltas[explosivo_id]),
+            'responsable_guardia': 'Sistema',
+            'observaciones': f'Auto-inicializado {fecha}',
+            'fecha_registro': ahora
+        } for explosivo_id in faltantes])
+        filas.update(leer_filas_turno(faltantes))
+
+    ajustar_stock_final_lote({filas[explosivo_id]: deltas[explosivo_id]
+                              for explosivo_id in ids if explosivo_id not in faltantes and deltas[explosivo_id]})
+    return filas
+
+def sumar_o_crear_filas_lote(tabla, ids, existentes, sumar, crear, por_explosivo):
+    """Versión en lote de sumar_o_crear_fila para una tabla de agregados, en su propio savepoint.
+
+    existentes(): ids que ya tienen fila (leídos con bloqueo en SQL Server). sumar(ids) y
+    crear(ids) ejecutan el UPDATE y el INSERT ... WHERE NOT EXISTS; crear retorna las filas
+    insertadas. Si otra transacción crea alguna fila entretanto, o el lote falla, se
+    reintenta explosivo por explosivo con por_explosivo(explosivo_id): un error no descarta
+    los deltas de las otras tablas ni de los otros explosivos del vale.
+    """
+    try:
+        with db.session.begin_nested():
+            con_fila = existentes()
+            if con_fila:
+                sumar(con_fila)
+            faltantes = [explosivo_id for explosivo_id in ids if explosivo_id not in con_fila]
+            if faltantes and crear(faltantes) != len(faltantes):
+                raise RuntimeError('otra transacción creó filas faltantes')
+        return True
+    except Exception as e:
+        print(f"⚠️ {tabla} en lote ({len(ids)} explosivos), se reintenta por explosivo: {e}")
+
+    ok = True
+    for explosivo_id in ids:
+        try:
+            with db.session.begin_nested():
+                por_explosivo(explosivo_id)
+        except Exception as e:
+            # El movimiento se conserva; el agregado se corrige con reconstruir_stock_saldos.py
+            print(f"⚠️ Error actualizando {tabla} para explosivo {explosivo_id}: {e}")
+            ok = False
+    return ok
+
+def registrar_deltas_stock_lote(deltas, fecha, guardia):
+    """Versión en lote de registrar_delta_stock para varios explosivos de un mismo turno.
+
+    deltas: {explosivo_id: {'ingresos': x, 'salidas': y, 'devoluciones': z}}.
+    Actualiza stock_saldos, stock_movimientos_turno y la marca de recálculo con unas
+    pocas sentencias por conjunto, sin importar cuántos explosivos tenga el vale.
+    """
+    if not deltas:
+        return True
+    marcar_movimientos_en_sesion({
+        explosivo_id: float(d.get('ingresos') or 0) - float(d.get('salidas') or 0) + float(d.get('devoluciones') or 0)
+        for explosivo_id, d in deltas.items()
+    })
+    ids = sorted(deltas)
+    if len(ids) > MAX_EXPLOSIVOS_DELTA:
+        resultados = [registrar_deltas_stock_lote({e: deltas[e] for e in lote}, fecha, guardia)
+                      for lote in dividir_en_lotes(ids, 15)]
+        return all(resultados)
+
+    if isinstance(fecha, datetime):
+        fecha = fecha.date()
+    inicio = datetime.combine(fecha, datetime.min.time())
+    capacidades = obtener_capacidades()
+    params = {
+        'fecha': fecha,
+        'guardia': guardia,
+        'inicio': inicio,
+        'fin': inicio + timedelta(days=1),
+        'ahora': datetime.now()
+    }
+    casos = {'ingresos': [], 'salidas': [], 'devoluciones': []}
+    for i, explosivo_id in enumerate(ids):
+        params[f'exp_{i}'] = explosivo_id
+        for campo in casos:
+            params[f'{campo}_{i}'] = float(deltas[explosivo_id].get(campo) or 0)
+            casos[campo].append(f"WHEN :exp_{i} THEN :{campo}_{i}")
+    delta_sql = {campo: f"CASE explosivo_id {' '.join(casos[campo])} ELSE 0 END" for campo in casos}
+    indices = {explosivo_id: i for i, explosivo_id in enumerate(ids)}
+    bloqueo = bloqueo_comprobacion()
+
+    def en(subconjunto):
+        return ','.join(f':exp_{indices[explosivo_id]}' for explosivo_id in subconjunto)
+
+    def leer_existentes(tabla, filtro_turno=''):
+        return {row[0] for row in db.session.execute(text(f"""
+            SELECT explosivo_id FROM {tabla} {bloqueo} WHERE explosivo_id IN ({en(ids)}) {filtro_turno}
+        """), params)}
+
+    def params_explosivo(explosivo_id):
+        i = indices[explosivo_id]
+        return dict(params, explosivo_id=explosivo_id, **{campo: params[f'{campo}_{i}'] for campo in casos})
+
+    try:
+        db.session.flush()
+    except Exception as e:
+        print(f"⚠️ Error actualizando saldos en lote para {len(ids)} explosivos {fecha} {guardia}: {e}")
+        return False
+
+    ok = True
+    if capacidades['stock_saldos']:
+        ok = sumar_o_crear_filas_lote(
+            'stock_saldos', ids,
+            existentes=lambda: leer_existentes('stock_saldos'),
+            sumar=lambda con_fila: db.session.execute(text(f"""
+                UPDATE stock_saldos
+                SET total_ingresos = total_ingresos + {delta_sql['ingresos']},
+                    total_salidas = total_salidas + {delta_sql['salidas']},
+                    total_devoluciones = total_devoluciones + {delta_sql['devoluciones']},
+                    stock_actual = stock_actual + {delta_sql['ingresos']} - {delta_sql['salidas']} + {delta_sql['devoluciones']},
+                    fecha_actualizacion = :ahora
+                WHERE explosivo_id IN ({en(con_fila)})
+            """), params),
+            # Explosivos sin fila: se crean desde el historial (ya incluye estos movimientos)
+            crear=lambda faltantes: db.session.execute(text(f"""
+                INSERT INTO stock_saldos (explosivo_id, total_ingresos, total_salidas, total_devoluciones, stock_actual, fecha_actualizacion)
+                SELECT t.id, t.ingresos, t.salidas, t.devoluciones, t.ingresos - t.salidas + t.devoluciones, :ahora
+                FROM (
+                    SELECT
+                        e.id,
+                        (SELECT COALESCE(SUM(cantidad), 0) FROM ingresos WHERE explosivo_id = e.id) AS ingresos,
+                        (SELECT COALESCE(SUM(cantidad), 0) FROM salidas WHERE explosivo_id = e.id) AS salidas,
+                        (SELECT COALESCE(SUM(cantidad_devuelta), 0) FROM devoluciones WHERE explosivo_id = e.id) AS devoluciones
+                    FROM explosivos e
+                    WHERE e.id IN ({en(faltantes)})
+                    AND NOT EXISTS (SELECT 1 FROM stock_saldos ss {bloqueo} WHERE ss.explosivo_id = e.id)
+                ) t
+            """), params).rowcount,
+            por_explosivo=lambda explosivo_id: sumar_saldo_explosivo(params_explosivo(explosivo_id))
+        ) and ok
+
+    if capacidades['stock_movimientos_turno']:
+        ok = sumar_o_crear_filas_lote(
+            'stock_movimientos_turno', ids,
+            existentes=lambda: leer_existentes('stock_movimientos_turno', 'AND fecha = :fecha AND guardia = :guardia'),
+            sumar=lambda con_fila: db.session.execute(text(f"""
+                UPDATE stock_movimientos_turno
+                SET ingresos = ingresos + {delta_sql['ingresos']},
+                    salidas = salidas + {delta_sql['salidas']},
+                    devoluciones = devoluciones + {delta_sql['devoluciones']},
+                    fecha_actualizacion = :ahora
+                WHERE explosivo_id IN ({en(con_fila)}) AND fecha = :fecha AND guardia = :guardia
+            """), params),
+            crear=lambda faltantes: db.session.execute(text(f"""
+                INSERT INTO stock_movimientos_turno (explosivo_id, fecha, guardia, ingresos, salidas, devoluciones, fecha_actualizacion)
+                SELECT t.id, :fecha, :guardia, t.ingresos, t.salidas, t.devoluciones, :ahora
+                FROM (
+                    SELECT
+                        e.id,
+                        (SELECT COALESCE(SUM(cantidad), 0) FROM ingresos
+                         WHERE explosivo_id = e.id AND guardia = :guardia
+                         AND fecha_ingreso >= :inicio AND fecha_ingreso < :fin) AS ingresos,
+                        (SELECT COALESCE(SUM(cantidad), 0) FROM salidas
+                         WHERE explosivo_id = e.id AND guardia = :guardia
+                         AND fecha_salida >= :inicio AND fecha_salida < :fin) AS salidas,
+                        (SELECT COALESCE(SUM(d.cantidad_devuelta), 0) FROM devoluciones d
+                         LEFT JOIN salidas s ON d.salida_id = s.id
+                         WHERE COALESCE(d.explosivo_id, s.explosivo_id) = e.id AND d.guardia = :guardia
+                         AND d.fecha_devolucion >= :inicio AND d.fecha_devolucion < :fin) AS devoluciones
+                    FROM explosivos e
+                    WHERE e.id IN ({en(faltantes)})
+                    AND NOT EXISTS (
+                        SELECT 1 FROM stock_movimientos_turno mt {bloqueo}
+                        WHERE mt.explosivo_id = e.id AND mt.fecha = :fecha AND mt.guardia = :guardia
+                    )
+                ) t
+            """), params).rowcount,
+            por_explosivo=lambda explosivo_id: sumar_turno_explosivo(params_explosivo(explosivo_id))
+        ) and ok
+
+    if capacidades['stock_recalculo_pendiente']:
+        ok = sumar_o_crear_filas_lote(
+            'stock_recalculo_pendiente', ids,
+            existentes=lambda: leer_existentes('stock_recalculo_pendiente'),
+            sumar=lambda con_fila: db.session.execute(text(f"""
+                UPDATE stock_recalculo_pendiente
+                SET sucio_desde = CASE WHEN sucio_desde > :fecha THEN :fecha ELSE sucio_desde END,
+                    fecha_actualizacion = :ahora
+                WHERE explosivo_id IN ({en(con_fila)})
+            """), params),
+            crear=lambda faltantes: db.session.execute(text(f"""
+                INSERT INTO stock_recalculo_pendiente (explosivo_id, sucio_desde, fecha_actualizacion)
+                SELECT e.id, :fecha, :ahora
+                FROM explosivos e
+                WHERE e.id IN ({en(faltantes)})
+                AND NOT EXISTS (SELECT 1 FROM stock_recalculo_pendiente rp {bloqueo} WHERE rp.explosivo_id = e.id)
+            """), params).rowcount,
+            por_explosivo=lambda explosivo_id: marcar_explosivo(params_explosivo(explosivo_id))
+        ) and ok
+
+    return ok
+
+def procesar_movimientos_confirmados(claves):
+    """Tareas posteriores al commit de movimientos: sincronización consolidada de stock_diario.
+
+    claves: conjunto de (explosivo_id, fecha, guardia) afectados en la petición.
+    El recálculo se encola para el hilo trabajador; la respuesta no lo espera.
+    """
+    if not claves:
+        return
+
+    # 🔄 SINCRONIZACIÓN AUTOMÁTICA (una sola pasada por turno afectado, en segundo plano)
+    try:
+        encolar_sincronizacion(claves)
+    except Exception as sync_error:
+        print(f"⚠️ Error sincronización automática: {sync_error}")
+
+def consultar_stock_saldos(explosivos_ids=None):
+    """Leer stock actual desde stock_saldos (O(1) por explosivo). Retorna None si no está disponible"""
+    if not obtener_capacidades()['stock_saldos']:
+        return None
+
+    try:
+        query = """
+            SELECT
+                e.id,
+                e.codigo,
+                e.descripcion,
+                e.unidad,
+                e.grupo,
+                COALESCE(ss.stock_actual, 0) as stock_actual
+            FROM explosivos e
+            LEFT JOIN stock_saldos ss ON ss.explosivo_id = e.id
+        """
+        params = {}
+
+        if explosivos_ids is not None:
+            if not explosivos_ids:
+                return []
+            for i, exp_id in enumerate(explosivos_ids):
+                params[f'id_{i}'] = exp_id
+            placeholders = ','.join([f':id_{i}' for i in range(len(explosivos_ids))])
+            query += f" WHERE e.id IN ({placeholders})"
+
+        return db.session.execute(text(query), params).fetchall()
+
+    except Exception as e:
+        print(f"Error leyendo stock_saldos, fallback a vistas: {e}")
+        return None
+
 def calcular_stock_explosivo(explosivo_id):
     """Calcular stock actual de un explosivo usando vistas optimizadas o cálculo directo"""
     try:
+        # Usar saldo mantenido en stock_saldos
+        saldos = consultar_stock_saldos([explosivo_id])
+        if saldos:
+            return int(saldos[0].stock_actual)
+
         # Intentar usar vista_stock_powerbi si está disponible
         if usar_vista_stock_powerbi():
             stock_vista = obtener_stock_via_vista(explosivo_id)
@@ -402,6 +1336,7 @@ def calcular_stock_explosivo(explosivo_id):
 
 def calcular_stock_explosivo_original(explosivo_id):
     """Método original de cálculo como fallback"""
+    registrar_estrategia('calculo_directo')
     try:
         # Calcular total de ingresos
         total_ingresos = db.session.query(db.func.sum(Ingreso.cantidad)).filter_by(explosivo_id=explosivo_id).scalar() or 0
@@ -425,7 +1360,37 @@ def calcular_stock_explosivo_original(explosivo_id):
 def obtener_stock_todos_explosivos_optimizado():
     """Obtener stock de todos los explosivos usando vistas optimizadas o cálculo directo"""
     try:
-        # OPCIÓN 1: Usar vista v_stock_actual (más eficiente y recién corregida)
+        # OPCIÓN 1: Usar saldos mantenidos en stock_saldos (sin re-agregar historial)
+        saldos = consultar_stock_saldos()
+        if saldos is not None:
+            def orden_grupo(row):
+                grupo = (row.grupo or '').upper()
+                if grupo == 'EXPLOSIVOS':
+                    prioridad = 1
+                elif 'FANEL' in grupo and 'MS' in grupo.split('FANEL', 1)[1]:
+                    prioridad = 2
+                elif 'FANEL' in grupo and 'LP' in grupo.split('FANEL', 1)[1]:
+                    prioridad = 3
+                elif 'FANEL' in grupo:
+                    prioridad = 4
+                else:
+                    prioridad = 5
+                return (prioridad, row.codigo)
+
+            stocks = {}
+            for row in sorted(saldos, key=orden_grupo):
+                stocks[row.descripcion] = {
+                    'stock': int(row.stock_actual),
+                    'explosivo_id': row.id,
+                    'descripcion': row.descripcion,
+                    'unidad': row.unidad,
+                    'codigo': row.codigo,
+                    'grupo': row.grupo or 'Sin grupo'
+                }
+
+            return stocks
+
+        # OPCIÓN 2: Usar vista v_stock_actual
         if usar_vista_stock_powerbi():
             try:
                 result = db.session.execute(text("""
@@ -505,21 +1470,37 @@ def obtener_stock_diario_actual(explosivo_id, fecha_objetivo=None, retornar_obje
     if stock_diario:
         return stock_diario if retornar_objeto else stock_diario.stock_inicial
     
-    # Si no existe stock diario para esta fecha, inicializar AMBOS TURNOS automáticamente
-    try:
-        inicializar_ambos_turnos_fecha(fecha_objetivo)
-        
-        # Buscar nuevamente después de la inicialización
-        stock_diario = StockDiario.query.filter_by(
-            explosivo_id=explosivo_id,
-            fecha=fecha_objetivo,
-            guardia=guardia
-        ).first()
-        
-        if stock_diario:
-            return stock_diario if retornar_objeto else stock_diario.stock_inicial
-    except Exception as e:
-        print(f"Error inicializando stock para fecha {fecha_objetivo}: {e}")
+    # Con stock_diario disperso un turno sin movimientos no tiene fila: basta con que la
+    # fecha esté en el calendario una vez por proceso
+    disperso = stock_diario_disperso()
+    
+    # Si no existe stock diario para esta fecha, el pre-inicializador crea AMBOS TURNOS
+    # en segundo plano; esta petición no espera y sigue con el cálculo directo
+    if disperso and fecha_objetivo in _fechas_calendario_aseguradas:
+        pass
+    elif PREINICIALIZACION_TURNOS:
+        preinicializador_turnos.solicitar(fecha_objetivo)
+    else:
+        try:
+            inicializar_ambos_turnos_fecha(fecha_objetivo)
+            
+            # Buscar nuevamente después de la inicialización
+            stock_diario = StockDiario.query.filter_by(
+                explosivo_id=explosivo_id,
+                fecha=fecha_objetivo,
+                guardia=guardia
+            ).first()
+            
+            if stock_diario:
+                return stock_diario if retornar_objeto else stock_diario.stock_inicial
+        except Exception as e:
+            print(f"Error inicializando stock para fecha {fecha_objetivo}: {e}")
+    
+    if disperso:
+        _fechas_calendario_aseguradas.add(fecha_objetivo)
+        derivado = obtener_turno_derivado(explosivo_id, fecha_objetivo, guardia)
+        if derivado is not None:
+            return derivado if retornar_objeto else derivado.stock_inicial
     
     if retornar_objeto:
         return None
@@ -527,42 +1508,91 @@ def obtener_stock_diario_actual(explosivo_id, fecha_objetivo=None, retornar_obje
     # Como último recurso, calcular usando el método original
     return calcular_stock_explosivo_original(explosivo_id)
 
+# Registro de capacidades del esquema (tablas/vistas opcionales disponibles).
+# Se detecta una vez y se reutiliza hasta que vence el TTL o se refresca
+# desde /admin/capacidades/refrescar; las rutas calientes no consultan INFORMATION_SCHEMA.
+CAPACIDADES_TTL = int(os.environ.get('CAPACIDADES_TTL', 600))
+OBJETOS_STOCK = ('stock_saldos', 'stock_movimientos_turno', 'stock_recalculo_pendiente', 'v_stock_actual', 'vw_stock_diario_powerbi')
+OBJETOS_OPCIONALES = OBJETOS_STOCK + ('idempotencia_respuestas', 'turnos_calendario')
+
+_capacidades_esquema = {'datos': None, 'detectado': 0.0}
+_capacidades_lock = threading.Lock()
+
+def detectar_capacidades_esquema():
+    """Consultar INFORMATION_SCHEMA una sola vez por los objetos opcionales conocidos"""
+    placeholders = ','.join([f':obj_{i}' for i in range(len(OBJETOS_OPCIONALES))])
+    params = {f'obj_{i}': nombre for i, nombre in enumerate(OBJETOS_OPCIONALES)}
+
+    if db.engine.dialect.name == 'sqlite':
+        # Base local de benchmarks (DATABASE_URL): SQLite no tiene INFORMATION_SCHEMA
+        query = f"""
+            SELECT name AS TABLE_NAME
+            FROM sqlite_master
+            WHERE type IN ('table', 'view') AND name IN ({placeholders})
+        """
+    else:
+        query = f"""
+            SELECT TABLE_NAME
+            FROM INFORMATION_SCHEMA.TABLES
+            WHERE TABLE_NAME IN ({placeholders})
+        """
+
+    # Conexión propia: la detección puede ocurrir dentro de la transacción de un movimiento
+    with db.engine.connect() as conn:
+        result = conn.execute(text(query), params).fetchall()
+
+    existentes = {row.TABLE_NAME.lower() for row in result}
+    capacidades = {nombre: nombre in existentes for nombre in OBJETOS_OPCIONALES}
+
+    # Estrategia de lectura de stock actual, en el mismo orden que los fallbacks
+    if capacidades['stock_saldos']:
+        estrategia = 'stock_saldos'
+    elif capacidades['v_stock_actual']:
+        estrategia = 'v_stock_actual'
+    elif capacidades['vw_stock_diario_powerbi']:
+        estrategia = 'vw_stock_diario_powerbi'
+    else:
+        estrategia = 'calculo_directo'
+
+    capacidades['vistas_stock'] = capacidades['v_stock_actual'] or capacidades['vw_stock_diario_powerbi']
+    capacidades['estrategia_stock'] = estrategia
+    capacidades['detectado_en'] = datetime.now().isoformat(timespec='seconds')
+    return capacidades
+
+def obtener_capacidades(forzar=False):
+    """Capacidades del esquema desde el registro en memoria (re-detecta al vencer el TTL)"""
+    datos = _capacidades_esquema['datos']
+    if not forzar and datos is not None and time.time() - _capacidades_esquema['detectado'] < CAPACIDADES_TTL:
+        return datos
+
+    with _capacidades_lock:
+        datos = _capacidades_esquema['datos']
+        if not forzar and datos is not None and time.time() - _capacidades_esquema['detectado'] < CAPACIDADES_TTL:
+            return datos
+
+        try:
+            datos = detectar_capacidades_esquema()
+            _capacidades_esquema['datos'] = datos
+            _capacidades_esquema['detectado'] = time.time()
+            print(f"🔎 Capacidades de esquema detectadas: estrategia de stock '{datos['estrategia_stock']}'")
+            return datos
+        except Exception as e:
+            print(f"Error detectando capacidades de esquema: {e}")
+            if datos is not None:
+                # Conservar la última detección válida
+                return datos
+            # Sin detección previa: asumir solo cálculo directo, sin cachear
+            datos = {nombre: False for nombre in OBJETOS_OPCIONALES}
+            datos.update({
+                'vistas_stock': False,
+                'estrategia_stock': 'calculo_directo',
+                'detectado_en': None
+            })
+            return datos
+
 def usar_vista_stock_powerbi():
-    """Verificar si las vistas de stock están disponibles"""
-    try:
-        # Verificar vista principal v_stock_actual (recién creada)
-        result = db.session.execute(text("""
-            SELECT COUNT(*) as count
-            FROM INFORMATION_SCHEMA.VIEWS 
-            WHERE TABLE_NAME = 'v_stock_actual'
-        """)).fetchone()
-        
-        if result and result.count > 0:
-            # Verificar que la vista tiene datos
-            try:
-                result = db.session.execute(text("SELECT COUNT(*) as count FROM v_stock_actual")).fetchone()
-                return result and result.count > 0
-            except:
-                return False
-        
-        # Fallback: verificar vista vw_stock_diario_powerbi
-        result = db.session.execute(text("""
-            SELECT COUNT(*) as count
-            FROM INFORMATION_SCHEMA.VIEWS 
-            WHERE TABLE_NAME = 'vw_stock_diario_powerbi'
-        """)).fetchone()
-        
-        if result and result.count > 0:
-            try:
-                result = db.session.execute(text("SELECT COUNT(*) as count FROM vw_stock_diario_powerbi WHERE fecha >= DATEADD(day, -1, GETDATE())")).fetchone()
-                return result and result.count > 0
-            except:
-                return False
-            
-        return False
-    except Exception as e:
-        print(f"Error verificando vistas de stock: {e}")
-        return False
+    """Verificar si las vistas de stock están disponibles (desde el registro de capacidades)"""
+    return obtener_capacidades()['vistas_stock']
 
 def obtener_stock_via_vista(explosivo_id, fecha_objetivo=None):
     """Obtener stock usando vistas optimizadas disponibles"""
@@ -596,8 +1626,8 @@ def obtener_stock_via_vista(explosivo_id, fecha_objetivo=None):
                 FROM vw_stock_diario_powerbi 
                 WHERE explosivo_id = :explosivo_id 
                 AND fecha = :fecha 
-                AND guardia = :guardia
-                ORDER BY fecha_registro DESC
+                AND turno = :guardia
+                ORDER BY stock_diario_creado DESC
             """), {
                 'explosivo_id': explosivo_id,
                 'fecha': fecha_objetivo,
@@ -638,10 +1668,11 @@ def inicializar_stock_fecha_si_necesario(fecha_objetivo, guardia, explosivos_ids
         if not explosivos_faltantes:
             return
         
-        # Crear stock solo para los faltantes usando vista optimizada
+        # Crear stock solo para los faltantes usando stock_saldos o vista optimizada
         registros_creados = 0
         try:
-            if usar_vista_stock_powerbi():
+            result = consultar_stock_saldos(explosivos_faltantes)
+            if result is None and usar_vista_stock_powerbi():
                 # Consulta optimizada para explosivos específicos
                 params = {}
                 for i, exp_id in enumerate(explosivos_faltantes):
@@ -652,7 +1683,8 @@ def inicializar_stock_fecha_si_necesario(fecha_objetivo, guardia, explosivos_ids
                     SELECT id, stock_actual FROM v_stock_actual 
                     WHERE id IN ({placeholders})
                 """), params).fetchall()
-                
+
+            if result is not None:
                 # Crear registros en lote
                 nuevos_registros = []
                 for row in result:
@@ -693,18 +1725,31 @@ def inicializar_stock_fecha_si_necesario(fecha_objetivo, guardia, explosivos_ids
         db.session.commit()
         return
     
+    # Modo disperso: el turno queda en el calendario y solo se crean las filas base
+    if stock_diario_disperso():
+        try:
+            if preinicializar_turnos_disperso(fecha_objetivo, f'Auto-inicializado {fecha_objetivo}', (guardia,)):
+                db.session.commit()
+                incrementar_version_datos()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error inicializando turno disperso {fecha_objetivo} {guardia}: {e}")
+        return
+    
     # Modo original para todos los explosivos (solo si no se especifican IDs)
     existe_stock = StockDiario.query.filter_by(fecha=fecha_objetivo, guardia=guardia).first()
     if existe_stock:
         return
     
-    # Crear para todos usando vista optimizada
+    # Crear para todos usando stock_saldos o vista optimizada
     try:
-        if usar_vista_stock_powerbi():
+        result = consultar_stock_saldos()
+        if result is None and usar_vista_stock_powerbi():
             result = db.session.execute(text("""
                 SELECT id, stock_actual FROM v_stock_actual ORDER BY id
             """)).fetchall()
-            
+
+        if result is not None:
             nuevos_registros = []
             for row in result:
                 nuevos_registros.append(StockDiario(
@@ -743,106 +1788,272 @@ def inicializar_stock_fecha_si_necesario(fecha_objetivo, guardia, explosivos_ids
     
     db.session.commit()
 
-def inicializar_ambos_turnos_fecha(fecha_objetivo):
-    """Inicializar AMBOS turnos (día y noche) para una fecha específica"""
-    from sqlalchemy import text
-    
-    # Convertir fecha_objetivo a date si es datetime
+def inicializar_ambos_turnos_fecha(fecha_objetivo):
+    """Inicializar AMBOS turnos (día y noche) para una fecha específica"""
+    try:
+        creadas = preinicializar_turnos_fecha(fecha_objetivo)
+        if creadas:
+            print(f"✅ Inicializados {creadas} registros de turno para fecha {fecha_objetivo}")
+    except Exception as e:
+        print(f"❌ Error inicializando turnos para fecha {fecha_objetivo}: {e}")
+        db.session.rollback()
+
+# Pre-inicialización de turnos: un hilo crea los turnos de la fecha que empieza unos minutos
+# antes de cada cambio de turno (preinicializacion_turnos.py), fuera de las peticiones.
+# PREINICIALIZACION_TURNOS=false vuelve a inicializar dentro de la petición que encuentra el turno vacío.
+PREINICIALIZACION_TURNOS = os.environ.get('PREINICIALIZACION_TURNOS', 'true').lower() not in ('0', 'false', 'no')
+PREINICIALIZACION_ANTELACION_SEG = int(os.environ.get('PREINICIALIZACION_ANTELACION_SEG', 300))
+MARCA_PREINICIALIZADO = 'Pre-inicializado'
+
+def observaciones_turnos(fecha_objetivo, anticipado=False):
+    """Observaciones de las filas creadas por la inicialización automática, por guardia"""
+    if anticipado:
+        return {guardia: f'{MARCA_PREINICIALIZADO} {fecha_objetivo}' for guardia in ('dia', 'noche')}
+    return {guardia: observaciones_derivadas(fecha_objetivo, guardia) for guardia in ('dia', 'noche')}
+
+# Stock_diario disperso (stock_diario_disperso.py): con la tabla turnos_calendario solo se
+# guardan los turnos con movimientos y una fila base por explosivo; vw_stock_diario_simple
+# deriva el resto. La migración es compactar_stock_diario.py.
+_fechas_calendario_aseguradas = set()
+
+def stock_diario_disperso():
+    """Modo disperso activo (existe turnos_calendario, desde el registro de capacidades)"""
+    return obtener_capacidades()['turnos_calendario']
+
+def ultima_fila_stock_diario(explosivo_id, fecha_objetivo, guardia):
+    """Última fila guardada de un explosivo antes del turno (fecha, guardia), o None"""
+    return StockDiario.query.filter(
+        StockDiario.explosivo_id == explosivo_id,
+        or_(StockDiario.fecha < fecha_objetivo,
+            and_(StockDiario.fecha == fecha_objetivo, StockDiario.guardia < guardia))
+    ).order_by(StockDiario.fecha.desc(), StockDiario.guardia.desc(), StockDiario.id.desc()).first()
+
+def obtener_turno_derivado(explosivo_id, fecha_objetivo, guardia):
+    """Turno sin fila en modo disperso: stock inicial y final = final de la fila anterior"""
+    anterior = ultima_fila_stock_diario(explosivo_id, fecha_objetivo, guardia)
+    if anterior is None:
+        return None
+    return TurnoDerivado(explosivo_id, fecha_objetivo, guardia, anterior.stock_final, anterior.stock_final)
+
+def registrar_turnos_calendario(fecha_objetivo, guardias=('dia', 'noche')):
+    """Agregar los turnos de una fecha a turnos_calendario; retorna cuántos eran nuevos"""
+    bloqueo = 'WITH (UPDLOCK, HOLDLOCK)' if db.engine.dialect.name == 'mssql' else ''
+    params = {'fecha': fecha_objetivo}
+    params.update({f'g_{i}': guardia for i, guardia in enumerate(guardias)})
+    return db.session.execute(text(f"""
+        INSERT INTO turnos_calendario (fecha, guardia)
+        SELECT :fecha, g.guardia
+        FROM (SELECT 'dia' AS guardia UNION ALL SELECT 'noche') g
+        WHERE g.guardia IN ({','.join(f':g_{i}' for i in range(len(guardias)))})
+        AND NOT EXISTS (
+            SELECT 1 FROM turnos_calendario tc {bloqueo}
+            WHERE tc.fecha = :fecha AND tc.guardia = g.guardia
+        )
+    """), params).rowcount
+
+def preinicializar_turnos_disperso(fecha_objetivo, observacion_base, guardias=('dia', 'noche')):
+    """Inicialización en modo disperso, sin commit: registra los turnos en el calendario y
+    crea la fila base (primer turno) de los explosivos que aún no tienen ninguna fila.
+    Retorna turnos + filas creadas.
+    """
+    creadas = registrar_turnos_calendario(fecha_objetivo, guardias)
+
+    bloqueo = 'WITH (UPDLOCK, HOLDLOCK)' if db.engine.dialect.name == 'mssql' else ''
+    sin_filas = [row[0] for row in db.session.execute(text(f"""
+        SELECT e.id FROM explosivos e
+        WHERE NOT EXISTS (SELECT 1 FROM stock_diario sd {bloqueo} WHERE sd.explosivo_id = e.id)
+    """)).fetchall()]
+    if not sin_filas:
+        return creadas
+
+    saldos = consultar_stock_saldos(sin_filas)
+    if saldos is not None:
+        stock_base = {row.id: int(row.stock_actual) for row in saldos}
+    else:
+        stock_base = {explosivo_id: calcular_stock_explosivo_original(explosivo_id) for explosivo_id in sin_filas}
+
+    ahora = datetime.utcnow()
+    insertar_filas_en_lote('stock_diario', [
+        'explosivo_id', 'fecha', 'guardia', 'stock_inicial', 'stock_final',
+        'responsable_guardia', 'observaciones', 'fecha_registro'
+    ], [{
+        'explosivo_id': explosivo_id,
+        'fecha': fecha_objetivo,
+        'guardia': guardias[0],
+        'stock_inicial': stock_base.get(explosivo_id, 0),
+        'stock_final': stock_base.get(explosivo_id, 0),
+        'responsable_guardia': RESPONSABLE_DERIVADO,
+        'observaciones': observacion_base,
+        'fecha_registro': ahora
+    } for explosivo_id in sin_filas])
+    return creadas + len(sin_filas)
+
+def preinicializar_turnos_fecha(fecha_objetivo, anticipado=False):
+    """Crear los turnos día y noche que falten de una fecha para todos los explosivos.
+
+    Con stock_saldos es un solo INSERT ... SELECT; si no, un INSERT en lote con el stock
+    base calculado. El turno noche parte del stock final del día si ya existe.
+    En modo disperso solo se registra la fecha en el calendario (y las filas base).
+    anticipado: filas creadas antes del cambio de turno (se realinean después).
+    Retorna cuántas filas se crearon.
+    """
     if isinstance(fecha_objetivo, datetime):
         fecha_objetivo = fecha_objetivo.date()
-    
+
+    observaciones = observaciones_turnos(fecha_objetivo, anticipado)
+    params = {
+        'fecha': fecha_objetivo,
+        'ahora': datetime.utcnow(),
+        'obs_dia': observaciones['dia'],
+        'obs_noche': observaciones['noche']
+    }
+
     try:
-        # Verificar qué turnos ya existen para esta fecha
-        turnos_existentes = db.session.query(StockDiario.guardia).filter_by(fecha=fecha_objetivo).distinct().all()
-        turnos_existentes = [t[0] for t in turnos_existentes]
-        
-        turnos_a_crear = []
-        if 'dia' not in turnos_existentes:
-            turnos_a_crear.append('dia')
-        if 'noche' not in turnos_existentes:
-            turnos_a_crear.append('noche')
-        
-        if not turnos_a_crear:
-            return  # Ya existen ambos turnos
-            
-        # Obtener stock base para cálculos
-        if usar_vista_stock_powerbi():
-            try:
-                result = db.session.execute(text("""
-                    SELECT id, stock_actual 
-                    FROM v_stock_actual
-                    ORDER BY id
-                """)).fetchall()
-                stock_base = {row.id: int(row.stock_actual) for row in result}
-                
-            except Exception as e:
-                # Fallback al cálculo directo
-                explosivos = Explosivo.query.all()
-                stock_base = {}
-                for explosivo in explosivos:
-                    try:
-                        stock_base[explosivo.id] = calcular_stock_explosivo_original(explosivo.id)
-                    except:
-                        stock_base[explosivo.id] = 0
+        if stock_diario_disperso():
+            creadas = preinicializar_turnos_disperso(fecha_objetivo, observaciones['dia'])
+        elif obtener_capacidades()['stock_saldos']:
+            # En SQL Server el rango queda bloqueado: dos workers no crean el mismo turno a la vez
+            bloqueo = 'WITH (UPDLOCK, HOLDLOCK)' if db.engine.dialect.name == 'mssql' else ''
+            stock_base = """
+                CASE WHEN g.guardia = 'noche' AND dia.stock_final IS NOT NULL
+                     THEN dia.stock_final
+                     ELSE CAST(COALESCE(ss.stock_actual, 0) AS INT) END
+            """
+            creadas = db.session.execute(text(f"""
+                INSERT INTO stock_diario (explosivo_id, fecha, guardia, stock_inicial, stock_final,
+                                          responsable_guardia, observaciones, fecha_registro)
+                SELECT e.id, :fecha, g.guardia, {stock_base}, {stock_base}, 'Sistema Auto',
+                       CASE g.guardia WHEN 'dia' THEN :obs_dia ELSE :obs_noche END, :ahora
+                FROM explosivos e
+                CROSS JOIN (SELECT 'dia' AS guardia UNION ALL SELECT 'noche') g
+                LEFT JOIN stock_saldos ss ON ss.explosivo_id = e.id
+                LEFT JOIN (
+                    SELECT explosivo_id, MAX(stock_final) AS stock_final
+                    FROM stock_diario
+                    WHERE fecha = :fecha AND guardia = 'dia'
+                    GROUP BY explosivo_id
+                ) dia ON dia.explosivo_id = e.id
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM stock_diario sd {bloqueo}
+                    WHERE sd.explosivo_id = e.id AND sd.fecha = :fecha AND sd.guardia = g.guardia
+                )
+            """), params).rowcount
         else:
-            explosivos = Explosivo.query.all()
-            stock_base = {}
-            for explosivo in explosivos:
-                try:
-                    stock_base[explosivo.id] = calcular_stock_explosivo_original(explosivo.id)
-                except:
-                    stock_base[explosivo.id] = 0
-        
-        # Crear turnos faltantes
-        for guardia in turnos_a_crear:
-            for explosivo_id, stock_actual in stock_base.items():
+            # Sin stock_saldos: turnos existentes en una consulta y un INSERT en lote
+            existentes = {}
+            for row in db.session.query(StockDiario.explosivo_id, StockDiario.guardia, StockDiario.stock_final).filter(
+                StockDiario.fecha == fecha_objetivo
+            ):
+                existentes[(row.explosivo_id, row.guardia)] = row.stock_final
+
+            explosivos_ids = [e.id for e in obtener_explosivos_ordenados()]
+            faltantes = [(explosivo_id, guardia) for explosivo_id in explosivos_ids for guardia in ('dia', 'noche')
+                         if (explosivo_id, guardia) not in existentes]
+            if not faltantes:
+                return 0
+
+            stock_base = None
+            if usar_vista_stock_powerbi():
                 try:
-                    # Para turno DÍA: stock inicial = stock actual
-                    # Para turno NOCHE: stock inicial = stock final del día (si existe) o stock actual
-                    if guardia == 'dia':
-                        stock_inicial = stock_actual
-                        stock_final = stock_actual
-                    else:  # noche
-                        # Buscar stock final del turno día para esta fecha
-                        stock_dia = StockDiario.query.filter_by(
-                            explosivo_id=explosivo_id,
-                            fecha=fecha_objetivo,
-                            guardia='dia'
-                        ).first()
-                        
-                        if stock_dia:
-                            stock_inicial = stock_dia.stock_final
-                            stock_final = stock_dia.stock_final
-                        else:
-                            stock_inicial = stock_actual
-                            stock_final = stock_actual
-                    
-                    nuevo_stock = StockDiario(
-                        explosivo_id=explosivo_id,
-                        fecha=fecha_objetivo,
-                        guardia=guardia,
-                        stock_inicial=stock_inicial,
-                        stock_final=stock_final,
-                        responsable_guardia='Sistema Auto',
-                        observaciones=f'Turno {guardia.upper()} inicializado automáticamente - {fecha_objetivo}'
-                    )
-                    
-                    db.session.add(nuevo_stock)
-                    
+                    result = db.session.execute(text("SELECT id, stock_actual FROM v_stock_actual")).fetchall()
+                    stock_base = {row.id: int(row.stock_actual) for row in result}
                 except Exception as e:
-                    continue
-        
-        try:
-            db.session.commit()
-            if turnos_a_crear:
-                print(f"✅ Inicializados turnos {', '.join(turnos_a_crear)} para fecha {fecha_objetivo}")
-        except Exception as e:
-            db.session.rollback()
-            raise
-            
-    except Exception as e:
-        print(f"❌ Error inicializando turnos para fecha {fecha_objetivo}: {e}")
+                    print(f"Error usando v_stock_actual: {e}")
+            if stock_base is None:
+                stock_base = {}
+                for explosivo_id in {explosivo_id for explosivo_id, _ in faltantes}:
+                    try:
+                        stock_base[explosivo_id] = calcular_stock_explosivo_original(explosivo_id)
+                    except Exception:
+                        stock_base[explosivo_id] = 0
+
+            filas = []
+            for explosivo_id, guardia in faltantes:
+                stock = stock_base.get(explosivo_id, 0)
+                if guardia == 'noche' and (explosivo_id, 'dia') in existentes:
+                    stock = existentes[(explosivo_id, 'dia')]
+                filas.append({
+                    'explosivo_id': explosivo_id,
+                    'fecha': fecha_objetivo,
+                    'guardia': guardia,
+                    'stock_inicial': stock,
+                    'stock_final': stock,
+                    'responsable_guardia': 'Sistema Auto',
+                    'observaciones': observaciones[guardia],
+                    'fecha_registro': params['ahora']
+                })
+            insertar_filas_en_lote('stock_diario', list(filas[0]), filas)
+            creadas = len(filas)
+
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    if creadas:
+        incrementar_version_datos()
+    return creadas
+
+def realinear_turnos_preinicializados(fecha_objetivo):
+    """Después del cambio de turno: llevar al saldo vigente las filas anticipadas sin movimientos.
+
+    Una fila anticipada con stock_inicial = stock_final no recibió movimientos del turno
+    nuevo, así que su inicio es el saldo actual (incluye lo registrado en los últimos
+    minutos del turno anterior). Una sola sentencia UPDATE; retorna las filas realineadas.
+    """
+    if not obtener_capacidades()['stock_saldos']:
+        return 0
+
+    observaciones = observaciones_turnos(fecha_objetivo)
+    try:
+        realineadas = db.session.execute(text("""
+            UPDATE stock_diario
+            SET stock_inicial = (SELECT CAST(ss.stock_actual AS INT) FROM stock_saldos ss WHERE ss.explosivo_id = stock_diario.explosivo_id),
+                stock_final = (SELECT CAST(ss.stock_actual AS INT) FROM stock_saldos ss WHERE ss.explosivo_id = stock_diario.explosivo_id),
+                observaciones = CASE guardia WHEN 'dia' THEN :obs_dia ELSE :obs_noche END
+            WHERE fecha = :fecha
+            AND observaciones = :marca
+            AND stock_inicial = stock_final
+            AND EXISTS (SELECT 1 FROM stock_saldos ss WHERE ss.explosivo_id = stock_diario.explosivo_id)
+        """), {
+            'fecha': fecha_objetivo,
+            'marca': observaciones_turnos(fecha_objetivo, anticipado=True)['dia'],
+            'obs_dia': observaciones['dia'],
+            'obs_noche': observaciones['noche']
+        }).rowcount
+        db.session.commit()
+    except Exception:
         db.session.rollback()
+        raise
+
+    if realineadas:
+        incrementar_version_datos()
+    return realineadas
+
+def preinicializar_turnos(fecha_objetivo, anticipado=False):
+    """Tarea del hilo pre-inicializador (con su propio contexto de aplicación)"""
+    with app.app_context():
+        creadas = preinicializar_turnos_fecha(fecha_objetivo, anticipado)
+    if creadas:
+        print(f"🗓️ Pre-inicializados {creadas} registros de turno para {fecha_objetivo}")
+    return creadas
+
+def realinear_turnos(fecha_objetivo):
+    """Tarea del hilo pre-inicializador tras el cambio de turno"""
+    with app.app_context():
+        return realinear_turnos_preinicializados(fecha_objetivo)
+
+preinicializador_turnos = PreinicializadorTurnos(
+    preinicializar_turnos,
+    realinear_turnos,
+    antelacion_seg=PREINICIALIZACION_ANTELACION_SEG
+)
+
+@app.before_request
+def arrancar_preinicializador_turnos():
+    # Se arranca con la primera petición del worker (después del fork de gunicorn)
+    if PREINICIALIZACION_TURNOS:
+        preinicializador_turnos.asegurar_hilo()
 
 # Rutas de la aplicación
 
@@ -1061,6 +2272,7 @@ def listar_salidas():
 
 @app.route('/salidas/nueva', methods=['GET', 'POST'])
 @require_login
+@con_idempotencia
 def nueva_salida():
     """Registrar nueva salida de explosivos"""
     
@@ -1086,13 +2298,6 @@ def nueva_salida():
         if 'user_id' not in session:
             return jsonify({'error': 'Sesión expirada. Por favor, inicie sesión nuevamente.'}), 401
         
-        transaction_id = str(uuid.uuid4())[:16]
-        session_key = f'transaction_{transaction_id}'
-        if session.get(session_key):
-            return jsonify({'error': 'Esta transacción ya fue procesada. Evite hacer doble clic.'}), 400
-        
-        session[session_key] = True
-        
         try:
             # Obtener turno y calcular guardia
             turno = request.form.get('turno', '')  # DIA o NOCHE
@@ -1149,10 +2354,14 @@ def nueva_salida():
             except (KeyError, ValueError) as e:
                 return jsonify({'error': f'Error en formato de explosivos: {str(e)}'}), 400
             
-            # OPTIMIZACIÓN 2: Obtener todos los stocks en lote usando vista
+            # OPTIMIZACIÓN 2: Obtener todos los stocks en lote desde stock_saldos (o vista)
             stocks_lote = {}
-            
-            if usar_vista_stock_powerbi():
+
+            saldos = consultar_stock_saldos(explosivos_ids)
+            if saldos:
+                for row in saldos:
+                    stocks_lote[row.id] = float(row.stock_actual)
+            elif usar_vista_stock_powerbi():
                 try:
                     # Crear parámetros para SQL Server
                     params = {}
@@ -1242,45 +2451,43 @@ def nueva_salida():
             
             # OPTIMIZACIÓN 5: Insertar todas las salidas válidas en lote
             salidas_registradas = []
+            ids_salidas = []
             if salidas_validas:
                 
                 try:
-                    # Preparar inserción en lote
-                    sql_insert_lote = text("""
-                    INSERT INTO salidas (explosivo_id, stock_diario_id, labor, tipo_actividad, cantidad, fecha_salida, guardia, responsable, autorizado_por, observaciones)
-                    VALUES (:explosivo_id, :stock_diario_id, :labor, :tipo_actividad, :cantidad, :fecha_salida, :guardia, :responsable, :autorizado_por, :observaciones)
-                    """)
+                    # Una sola sentencia INSERT con todas las líneas del vale
+                    ids_salidas = insertar_filas_en_lote('salidas', [
+                        'explosivo_id', 'stock_diario_id', 'labor', 'tipo_actividad', 'cantidad',
+                        'fecha_salida', 'guardia', 'responsable', 'autorizado_por', 'observaciones'
+                    ], [{
+                        'explosivo_id': salida['explosivo_id'],
+                        'stock_diario_id': salida['stock_diario_id'],
+                        'labor': labor,
+                        'tipo_actividad': tipo_actividad,
+                        'cantidad': salida['cantidad'],
+                        'fecha_salida': fecha_salida,
+                        'guardia': guardia,
+                        'responsable': responsable,
+                        'autorizado_por': autorizado_por,
+                        'observaciones': observaciones
+                    } for salida in salidas_validas])
                     
-                    # Ejecutar todas las inserciones en una sola transacción
+                    # ACTUALIZAR STOCK_FINAL de los stock_diario del turno en una sola sentencia
+                    descuentos = {}
+                    totales_explosivo = {}
                     for salida in salidas_validas:
-                        db.session.execute(sql_insert_lote, {
-                            'explosivo_id': salida['explosivo_id'],
-                            'stock_diario_id': salida['stock_diario_id'],
-                            'labor': labor,
-                            'tipo_actividad': tipo_actividad,
-                            'cantidad': salida['cantidad'],
-                            'fecha_salida': fecha_salida,
-                            'guardia': guardia,
-                            'responsable': responsable,
-                            'autorizado_por': autorizado_por,
-                            'observaciones': observaciones
-                        })
-                        
-                        # ACTUALIZAR STOCK_FINAL del stock_diario correspondiente
-                        stock_diario_obj = stocks_diario_lote[salida['explosivo_id']]
-                        stock_diario_obj.stock_final -= salida['cantidad']
-                        
-                        salidas_registradas.append({
-                            'explosivo_id': salida['explosivo_id'],
-                            'cantidad': salida['cantidad']
-                        })
-                        
-                        # 🔄 SINCRONIZACIÓN AUTOMÁTICA 
-                        try:
-                            trigger_sincronizacion_stock('salida', salida['explosivo_id'], fecha_salida.date(), guardia)
-                        except Exception as sync_error:
-                            print(f"⚠️ Error sincronización automática: {sync_error}")
-                    
+                        descuentos[salida['stock_diario_id']] = descuentos.get(salida['stock_diario_id'], 0) - salida['cantidad']
+                        totales = totales_explosivo.setdefault(salida['explosivo_id'], {'salidas': 0})
+                        totales['salidas'] += salida['cantidad']
+                    ajustar_stock_final_lote(descuentos)
+
+                    # Actualizar saldos acumulados en la misma transacción
+                    registrar_deltas_stock_lote(totales_explosivo, fecha_salida, guardia)
+
+                    salidas_registradas = [{
+                        'explosivo_id': salida['explosivo_id'],
+                        'cantidad': salida['cantidad']
+                    } for salida in salidas_validas]
                     
                 except Exception as e:
                     error_msg = f'Error procesando salidas en lote: {str(e)}'
@@ -1290,6 +2497,14 @@ def nueva_salida():
             # Si hay salidas válidas, confirmar transacción
             if salidas_registradas:
                 db.session.commit()
+
+                procesar_movimientos_confirmados({
+                    (s['explosivo_id'], fecha_salida.date(), guardia) for s in salidas_registradas
+                })
+
+                # Frecuencias de uso del autocompletado
+                indice_labores.registrar_uso(labor)
+                indice_tipos_actividad.registrar_uso(tipo_actividad)
                 
                 mensaje_exito = f'Se registraron {len(salidas_registradas)} salidas exitosamente'
                 if errores:
@@ -1298,19 +2513,14 @@ def nueva_salida():
                 response_data = {
                     'success': mensaje_exito,
                     'salidas_registradas': len(salidas_registradas),
+                    'ids': ids_salidas,
                     'errores': errores
                 }
                 
-                # Marcar transacción como completada exitosamente
-                session[f'transaction_{transaction_id}_completed'] = True
-                
                 return jsonify(response_data)
             else:
                 db.session.rollback()
                 
-                # Limpiar transacción fallida
-                session.pop(session_key, None)
-                
                 return jsonify({
                     'error': 'No se pudo registrar ninguna salida',
                     'errores': errores
@@ -1319,9 +2529,6 @@ def nueva_salida():
         except Exception as e:
             db.session.rollback()
             
-            # Limpiar transacción fallida
-            session.pop(session_key, None)
-            
             return jsonify({'error': f'Error general al registrar salidas: {str(e)}'}), 500
 
 @app.route('/devoluciones')
@@ -1344,6 +2551,7 @@ def listar_devoluciones():
 
 @app.route('/devoluciones/nueva', methods=['GET', 'POST'])
 @require_login
+@con_idempotencia
 def nueva_devolucion():
     """Registrar nueva devolución de explosivos"""
     usuario_actual = obtener_usuario_actual()
@@ -1397,17 +2605,6 @@ def nueva_devolucion():
         if 'user_id' not in session:
             return jsonify({'error': 'Sesión expirada. Por favor, inicie sesión nuevamente.'}), 401
         
-        # Generar ID único para esta transacción basado en timestamp y datos básicos
-        transaction_id = str(uuid.uuid4())[:16]  # ID único más simple
-        
-        # Verificar si esta transacción ya fue procesada (evitar duplicados)
-        session_key = f'transaction_devolucion_{transaction_id}'
-        if session.get(session_key):
-            return jsonify({'error': 'Esta transacción ya fue procesada. Evite hacer doble clic.'}), 400
-        
-        # Marcar transacción como en proceso
-        session[session_key] = True
-        
         try:
             # Obtener turno y calcular guardia
             turno = request.form.get('turno', '').strip()
@@ -1456,94 +2653,103 @@ def nueva_devolucion():
             if not explosivos_seleccionados:
                 return jsonify({'error': 'Debe seleccionar al menos un explosivo para devolver'}), 400
             
-            # Procesar cada explosivo seleccionado
+            # Resolver todos los códigos con el catálogo en memoria (código → explosivo)
             devoluciones_registradas = []
             errores = []
+            codigos = {item['codigo'] for item in explosivos_seleccionados}
+            catalogo = obtener_catalogo_explosivos().mapa_codigos()
+            if not codigos <= catalogo.keys():
+                # Código desconocido: puede ser un alta reciente hecha desde otro proceso
+                catalogo = obtener_catalogo_explosivos(forzar=True).mapa_codigos()
             
+            columnas = [
+                'explosivo_id', 'cantidad_devuelta', 'motivo', 'fecha_devolucion', 'guardia',
+                'responsable', 'recibido_por', 'labor', 'estado_material', 'observaciones'
+            ]
+            lineas = []
             for item in explosivos_seleccionados:
                 codigo = item['codigo']
-                cantidad = item['cantidad']
+                explosivo = catalogo.get(codigo)
+                if not explosivo:
+                    errores.append(f'Explosivo {codigo} no encontrado')
+                    continue
+                
+                # Crear observaciones descriptivas completas
+                obs_completas = f"Devolución de {explosivo.descripcion} ({codigo}) - Labor: {labor_origen}"
+                if numero_vale:
+                    obs_completas += f" - Vale: {numero_vale}"
+                if motivo_devolucion:
+                    obs_completas += f" - Motivo: {motivo_devolucion}"
+                if observaciones:
+                    obs_completas += f" - {observaciones}"
                 
+                lineas.append((item, explosivo, {
+                    'explosivo_id': explosivo.id,
+                    'cantidad_devuelta': item['cantidad'],
+                    'motivo': motivo_devolucion,
+                    'fecha_devolucion': fecha_devolucion,
+                    'guardia': guardia,
+                    'responsable': supervisor_responsable,
+                    'recibido_por': recibido_por,
+                    'labor': labor_origen,
+                    'estado_material': 'bueno',
+                    'observaciones': obs_completas
+                }))
+            
+            insertadas = []
+            if lineas:
                 try:
-                    # Obtener el explosivo
-                    explosivo = db.session.query(Explosivo).filter_by(codigo=codigo).first()
-                    if not explosivo:
-                        errores.append(f'Explosivo {codigo} no encontrado')
-                        continue
-                    
-                    # Crear observaciones descriptivas completas
-                    obs_completas = f"Devolución de {explosivo.descripcion} ({codigo}) - Labor: {labor_origen}"
-                    if numero_vale:
-                        obs_completas += f" - Vale: {numero_vale}"
-                    if motivo_devolucion:
-                        obs_completas += f" - Motivo: {motivo_devolucion}"
-                    if observaciones:
-                        obs_completas += f" - {observaciones}"
-                    
-                    # Inserción directa usando SQL para activar triggers (evitar OUTPUT clause)
-                    from sqlalchemy import text
-                    query = text("""
-                        INSERT INTO devoluciones (
-                            explosivo_id, cantidad_devuelta, motivo, fecha_devolucion, 
-                            guardia, responsable, recibido_por, labor, estado_material, observaciones
-                        ) VALUES (
-                            :explosivo_id, :cantidad_devuelta, :motivo, :fecha_devolucion, 
-                            :guardia, :responsable, :recibido_por, :labor, :estado_material, :observaciones
-                        )
-                    """)
-                    
-                    db.session.execute(query, {
-                        'explosivo_id': explosivo.id,
-                        'cantidad_devuelta': cantidad,
-                        'motivo': motivo_devolucion,
-                        'fecha_devolucion': fecha_devolucion,
-                        'guardia': guardia,
-                        'responsable': supervisor_responsable,
-                        'recibido_por': recibido_por,
-                        'labor': labor_origen,
-                        'estado_material': 'bueno',
-                        'observaciones': obs_completas
-                    })
-                    
+                    # Todas las líneas en una sola sentencia INSERT
+                    with db.session.begin_nested():
+                        insertar_filas_en_lote('devoluciones', columnas, [fila for _, _, fila in lineas])
+                    insertadas = lineas
+                except Exception as e:
+                    # Una línea inválida no descarta las demás: cada una en su propio savepoint
+                    print(f"⚠️ Inserción en lote de devoluciones falló, reintentando por línea: {e}")
+                    for linea in lineas:
+                        item, explosivo, fila = linea
+                        try:
+                            with db.session.begin_nested():
+                                insertar_filas_en_lote('devoluciones', columnas, [fila])
+                            insertadas.append(linea)
+                        except Exception as e:
+                            errores.append(f'Error procesando explosivo {item["codigo"]}: {str(e)}')
+            
+            if insertadas:
+                totales_explosivo = {}
+                for item, explosivo, _ in insertadas:
+                    totales = totales_explosivo.setdefault(explosivo.id, {'devoluciones': 0})
+                    totales['devoluciones'] += item['cantidad']
                     devoluciones_registradas.append({
-                        'codigo': codigo,
-                        'cantidad': cantidad,
+                        'explosivo_id': explosivo.id,
+                        'codigo': item['codigo'],
+                        'cantidad': item['cantidad'],
                         'descripcion': explosivo.descripcion
                     })
-                    
-                    # 🔄 SINCRONIZACIÓN AUTOMÁTICA
-                    try:
-                        trigger_sincronizacion_stock('devolucion', explosivo.id, fecha_devolucion.date(), guardia)
-                    except Exception as sync_error:
-                        print(f"⚠️ Error sincronización automática: {sync_error}")
-                    
-                except Exception as e:
-                    db.session.rollback()  # Rollback en caso de error individual
-                    errores.append(f'Error procesando explosivo {codigo}: {str(e)}')
+                
+                # Actualizar saldos acumulados en la misma transacción
+                registrar_deltas_stock_lote(totales_explosivo, fecha_devolucion, guardia)
             
             # Confirmar transacción
             if devoluciones_registradas:
                 db.session.commit()
+
+                procesar_movimientos_confirmados({
+                    (d['explosivo_id'], fecha_devolucion.date(), guardia) for d in devoluciones_registradas
+                })
                 mensaje = f"✅ Devolución registrada exitosamente. {len(devoluciones_registradas)} explosivos procesados."
-                
-                # Marcar transacción como completada y limpiar session
-                session[f'transaction_devolucion_{transaction_id}_completed'] = True
-                session.pop(session_key, None)
+                if errores:
+                    mensaje += f" {len(errores)} con errores: " + '; '.join(errores)
                 
                 return jsonify({'success': mensaje})
             else:
                 db.session.rollback()
-                # Limpiar session en caso de error
-                session.pop(session_key, None)
                 
                 return jsonify({'error': 'Errores: ' + '; '.join(errores)}), 400
                 
         except Exception as e:
             db.session.rollback()
             
-            # Limpiar session en caso de error
-            session.pop(session_key, None)
-            
             # Reiniciar la sesión para próximas operaciones
             db.session.close()
             return jsonify({'error': f'Error interno: {str(e)}'}), 500
@@ -1569,6 +2775,7 @@ def listar_ingresos():
 
 @app.route('/ingresos/nuevo', methods=['GET', 'POST'])
 @require_login
+@con_idempotencia
 def nuevo_ingreso():
     """Registrar nuevo ingreso de explosivos"""
     usuario_actual = obtener_usuario_actual()
@@ -1597,17 +2804,6 @@ def nuevo_ingreso():
         if 'user_id' not in session:
             return jsonify({'error': 'Sesión expirada. Por favor, inicie sesión nuevamente.'}), 401
         
-        # Generar ID único para esta transacción basado en timestamp y datos básicos
-        transaction_id = str(uuid.uuid4())[:16]  # ID único más simple
-        
-        # Verificar si esta transacción ya fue procesada (evitar duplicados)
-        session_key = f'transaction_ingreso_{transaction_id}'
-        if session.get(session_key):
-            return jsonify({'error': 'Esta transacción ya fue procesada. Evite hacer doble clic.'}), 400
-        
-        # Marcar transacción como en proceso
-        session[session_key] = True
-        
         # Asegurar que no hay transacciones pendientes
         try:
             db.session.rollback()
@@ -1660,64 +2856,69 @@ def nuevo_ingreso():
         
         resultados = []
         errores = []
+        lineas = []
         
-        # Procesar cada explosivo
+        # Validar formato de todas las líneas antes de tocar la base de datos
         for item in explosivos_data:
             try:
-                explosivo_id = int(item['explosivo_id'])
-                cantidad = int(item['cantidad'])
-                
-                # Verificar que el explosivo existe
-                explosivo = db.session.get(Explosivo, explosivo_id)
-                if not explosivo:
-                    errores.append(f'Explosivo ID {explosivo_id} no existe')
-                    continue
-                
-                # Crear nuevo ingreso usando SQL directo (compatible con triggers)
-                query = text("""
-                    INSERT INTO ingresos (explosivo_id, numero_vale, cantidad, fecha_ingreso, guardia, recibido_por, observaciones)
-                    VALUES (:explosivo_id, :numero_vale, :cantidad, :fecha_ingreso, :guardia, :recibido_por, :observaciones)
-                """)
-                
-                db.session.execute(query, {
-                    'explosivo_id': explosivo_id,
-                    'numero_vale': numero_vale,
-                    'cantidad': cantidad,
-                    'fecha_ingreso': fecha_ingreso,
-                    'guardia': guardia,
-                    'recibido_por': recibido_por,
-                    'observaciones': observaciones
-                })
-                
-                # Actualizar stock diario (crear o actualizar registro del día)
-                stock_diario = obtener_stock_diario_actual(explosivo_id, retornar_objeto=True)
-                if stock_diario:
-                    stock_diario.stock_final += cantidad
-                else:
-                    # Crear nuevo registro de stock diario si no existe
-                    nuevo_stock = StockDiario(
-                        explosivo_id=explosivo_id,
-                        fecha=date.today(),
-                        stock_inicial=cantidad,
-                        stock_final=cantidad
-                    )
-                    db.session.add(nuevo_stock)
-                
-                resultados.append(f'{cantidad} {explosivo.unidad} de {explosivo.descripcion}')
-                
-                # 🔄 SINCRONIZACIÓN AUTOMÁTICA
-                try:
-                    trigger_sincronizacion_stock('ingreso', explosivo_id, fecha_ingreso.date(), guardia)
-                except Exception as sync_error:
-                    print(f"⚠️ Error sincronización automática: {sync_error}")
-                
-            except ValueError as e:
+                lineas.append((int(item['explosivo_id']), int(item['cantidad'])))
+            except (KeyError, ValueError):
                 errores.append(f'Error en explosivo {item.get("explosivo_id", "desconocido")}: valores inválidos')
-            except Exception as e:
-                errores.append(f'Error en explosivo {item.get("explosivo_id", "desconocido")}: {str(e)}')
+        
+        # Validar todos los explosivos del vale contra el catálogo en memoria
+        explosivos_ids = {explosivo_id for explosivo_id, _ in lineas}
+        catalogo = obtener_catalogo_explosivos().mapa_ids()
+        if not explosivos_ids <= catalogo.keys():
+            # Id desconocido: puede ser un alta reciente hecha desde otro proceso
+            catalogo = obtener_catalogo_explosivos(forzar=True).mapa_ids()
+        
+        lineas_validas = []
+        for explosivo_id, cantidad in lineas:
+            if explosivo_id not in catalogo:
+                errores.append(f'Explosivo ID {explosivo_id} no existe')
+                continue
+            lineas_validas.append((explosivo_id, cantidad))
+        
+        ids_ingresos = []
+        if lineas_validas:
+            totales_explosivo = {}
+            for explosivo_id, cantidad in lineas_validas:
+                totales = totales_explosivo.setdefault(explosivo_id, {'ingresos': 0})
+                totales['ingresos'] += cantidad
+            
+            # stock_diario del turno elegido en el formulario (no el del reloj), en lote
+            stock_diario_ids = sumar_stock_diario_turno_lote(
+                fecha_ingreso, guardia, {e: t['ingresos'] for e, t in totales_explosivo.items()}
+            )
+            
+            # Una sola sentencia INSERT con todas las líneas (compatible con triggers)
+            ids_ingresos = insertar_filas_en_lote('ingresos', [
+                'explosivo_id', 'stock_diario_id', 'numero_vale', 'cantidad', 'fecha_ingreso',
+                'guardia', 'recibido_por', 'observaciones'
+            ], [{
+                'explosivo_id': explosivo_id,
+                'stock_diario_id': stock_diario_ids.get(explosivo_id),
+                'numero_vale': numero_vale,
+                'cantidad': cantidad,
+                'fecha_ingreso': fecha_ingreso,
+                'guardia': guardia,
+                'recibido_por': recibido_por,
+                'observaciones': observaciones
+            } for explosivo_id, cantidad in lineas_validas])
+            
+            # Actualizar saldos acumulados en la misma transacción
+            registrar_deltas_stock_lote(totales_explosivo, fecha_ingreso, guardia)
+            
+            for explosivo_id, cantidad in lineas_validas:
+                explosivo = catalogo[explosivo_id]
+                resultados.append(f'{cantidad} {explosivo.unidad} de {explosivo.descripcion}')
         
         # Confirmar cambios en la base de datos
         db.session.commit()
+
+        procesar_movimientos_confirmados({
+            (explosivo_id, fecha_ingreso.date(), guardia) for explosivo_id, _ in lineas_validas
+        })
         
         # Preparar respuesta
         if resultados:
@@ -1725,27 +2926,17 @@ def nuevo_ingreso():
             if errores:
                 mensaje += f'\n\nErrores encontrados:\n' + '\n'.join(f'• {e}' for e in errores)
             
-            # Marcar transacción como completada y limpiar session
-            session[f'transaction_ingreso_{transaction_id}_completed'] = True
-            session.pop(session_key, None)
-            
-            return jsonify({'success': mensaje})
+            return jsonify({'success': mensaje, 'ids': ids_ingresos})
         else:
             mensaje_error = 'No se pudo registrar ningún ingreso.\n' + '\n'.join(f'• {e}' for e in errores)
-            # Limpiar session en caso de error
-            session.pop(session_key, None)
             return jsonify({'error': mensaje_error}), 400
     
     except ValueError as e:
         db.session.rollback()
-        # Limpiar session en caso de error
-        session.pop(session_key, None)
         return jsonify({'error': 'Valores numéricos inválidos'}), 400
     except Exception as e:
         import traceback
         db.session.rollback()
-        # Limpiar session en caso de error
-        session.pop(session_key, None)
         return jsonify({'error': f'Error interno del servidor: {str(e)}'}), 500
 
 @app.route('/stock')
@@ -1816,6 +3007,49 @@ def resumen_stock():
     
     return redirect(url_for('simple_dashboard'))
 
+# Conexiones SSE: latido para mantener vivos proxies y balanceadores, y duración máxima
+# para liberar el hilo del worker (EventSource reconecta solo y el cliente se resincroniza).
+# Cada conexión ocupa un hilo: gunicorn.conf.py usa workers gthread, no el worker sync,
+# y pasado SSE_MAX_CONEXIONES el stream responde 503 y el cliente pasa a sondear
+SSE_LATIDO_SEG = int(os.environ.get('SSE_LATIDO_SEG', 15))
+SSE_DURACION_MAX_SEG = int(os.environ.get('SSE_DURACION_MAX_SEG', 300))
+
+@app.route('/api/stock/stream')
+@require_login_api
+def api_stock_stream():
+    """Server-Sent Events con los deltas de stock de los explosivos pedidos (?ids=1,2,3)"""
+    ids_texto = request.args.get('ids', '')
+    explosivos_ids = [int(i) for i in ids_texto.split(',') if i.strip().isdigit()]
+    if ids_texto and not explosivos_ids:
+        return jsonify({'error': 'IDs malformados'}), 400
+    
+    suscripcion = hub_stock.suscribir(explosivos_ids)
+    if suscripcion is None:
+        return jsonify({'error': 'Sin conexiones en vivo disponibles, use /api/stock-masivo'}), 503, {'Retry-After': str(SSE_DURACION_MAX_SEG)}
+    sondeo_saldos.asegurar_hilo()
+    # El stream no consulta la base: no retener una conexión del pool mientras dura
+    db.session.close()
+    
+    def eventos():
+        try:
+            yield "retry: 3000\n\n"
+            yield f"event: conectado\ndata: {json.dumps({'version': _version_datos['version']})}\n\n"
+            fin = time.time() + SSE_DURACION_MAX_SEG
+            while time.time() < fin:
+                evento = suscripcion.siguiente(SSE_LATIDO_SEG)
+                if evento is None:
+                    yield ": latido\n\n"
+                    continue
+                yield f"event: {evento['tipo']}\ndata: {json.dumps(evento)}\n\n"
+        finally:
+            hub_stock.cancelar(suscripcion)
+    
+    return Response(
+        stream_with_context(eventos()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/api/stock/<int:explosivo_id>')
 @require_login_api
 def api_stock_explosivo(explosivo_id):
@@ -1865,6 +3099,7 @@ def api_stock_explosivo(explosivo_id):
 
 @app.route('/api/stock-masivo')
 @require_login_api
+@con_version_datos
 def api_stock_masivo():
     """API optimizada para obtener stock usando vistas híbridas"""
     try:
@@ -1888,7 +3123,20 @@ def api_stock_masivo():
             ids_list = [row.id for row in explosivos_query]
 
         stocks = {}
-        
+
+        # Usar saldos mantenidos en stock_saldos
+        saldos = consultar_stock_saldos(ids_list)
+        if saldos is not None:
+            for row in saldos:
+                stocks[str(row.id)] = {
+                    'stock_disponible': int(row.stock_actual),
+                    'codigo': row.codigo,
+                    'descripcion': row.descripcion,
+                    'metodo': 'stock_saldos'
+                }
+
+            return jsonify(stocks)
+
         # Intentar usar vista optimizada si está disponible
         if usar_vista_stock_powerbi():
             try:
@@ -2054,18 +3302,35 @@ def api_stock_masivo_simple():
 # Ruta simple para mostrar lista de explosivos en JSON
 @app.route('/api/explosivos')
 @require_login_api
+@con_version_datos
 def api_explosivos():
     """API para obtener lista de explosivos"""
-    explosivos = obtener_explosivos_ordenados()
+    catalogo = obtener_catalogo_explosivos()
     result = []
-    for explosivo in explosivos:
+    for explosivo in catalogo.ordenados():
         result.append({
             'id': explosivo.id,
             'codigo': explosivo.codigo,
             'descripcion': explosivo.descripcion,
             'unidad': explosivo.unidad
         })
-    return jsonify(result)
+    response = jsonify(result)
+    response.headers['X-Catalogo-Version'] = str(catalogo.version)
+    response.headers['X-Catalogo-Checksum'] = catalogo.checksum or ''
+    return response
+
+@app.route('/api/explosivos/version')
+@require_login_api
+def api_explosivos_version():
+    """Versión del catálogo: el cliente solo recarga /api/explosivos si cambió el checksum"""
+    catalogo = obtener_catalogo_explosivos()
+    estado = catalogo.estado()
+    return jsonify({
+        'version': estado['version'],
+        'checksum': estado['checksum'],
+        'explosivos': estado['explosivos'],
+        'sin_cambios': request.args.get('checksum') == estado['checksum']
+    })
 
 
 
@@ -2144,53 +3409,69 @@ def simple_dashboard():
 def not_found_error(error):
     return jsonify({'error': 'Endpoint no encontrado'}), 404
 
-@app.route('/api/stock-actual')
-@require_login_api
-def obtener_stock_actual():
-    """Obtener stock actual de todos los explosivos usando vistas optimizadas o cálculo directo"""
-    try:
-        # Intentar usar v_stock_actual si está disponible
-        if usar_vista_stock_powerbi():
-            from sqlalchemy import text
-            
-            result = db.session.execute(text("""
-                SELECT 
-                    id,
-                    descripcion,
-                    codigo,
-                    unidad,
-                    stock_actual as stock_disponible
-                FROM v_stock_actual
-                ORDER BY descripcion
-            """)).fetchall()
-            
-            resultado = []
-            for row in result:
-                resultado.append({
-                    'id': row.id,
-                    'codigo': row.codigo or row.descripcion,
-                    'descripcion': row.descripcion,
-                    'stock_disponible': int(row.stock_disponible),
-                    'unidad': row.unidad
-                })
-            
-            return jsonify(resultado)
-        
-        # Fallback: usar cálculo directo
-        explosivos = Explosivo.query.all()
+def datos_stock_actual():
+    """Stock actual de todos los explosivos usando stock_saldos, vistas optimizadas o cálculo directo"""
+    # Usar saldos mantenidos en stock_saldos
+    saldos = consultar_stock_saldos()
+    if saldos is not None:
         resultado = []
+        for row in sorted(saldos, key=lambda r: r.descripcion):
+            resultado.append({
+                'id': row.id,
+                'codigo': row.codigo or row.descripcion,
+                'descripcion': row.descripcion,
+                'stock_disponible': int(row.stock_actual),
+                'unidad': row.unidad
+            })
+
+        return resultado
+
+    # Intentar usar v_stock_actual si está disponible
+    if usar_vista_stock_powerbi():
+        result = db.session.execute(text("""
+            SELECT 
+                id,
+                descripcion,
+                codigo,
+                unidad,
+                stock_actual as stock_disponible
+            FROM v_stock_actual
+            ORDER BY descripcion
+        """)).fetchall()
         
-        for explosivo in explosivos:
-            stock = calcular_stock_explosivo_original(explosivo.id)
+        resultado = []
+        for row in result:
             resultado.append({
-                'id': explosivo.id,
-                'codigo': explosivo.codigo or explosivo.descripcion,
-                'descripcion': explosivo.descripcion,
-                'stock_disponible': int(stock),
-                'unidad': explosivo.unidad
+                'id': row.id,
+                'codigo': row.codigo or row.descripcion,
+                'descripcion': row.descripcion,
+                'stock_disponible': int(row.stock_disponible),
+                'unidad': row.unidad
             })
         
-        return jsonify(resultado)
+        return resultado
+    
+    # Fallback: usar cálculo directo
+    resultado = []
+    for explosivo in sorted(obtener_catalogo_explosivos().ordenados(), key=lambda e: e.descripcion):
+        stock = calcular_stock_explosivo_original(explosivo.id)
+        resultado.append({
+            'id': explosivo.id,
+            'codigo': explosivo.codigo or explosivo.descripcion,
+            'descripcion': explosivo.descripcion,
+            'stock_disponible': int(stock),
+            'unidad': explosivo.unidad
+        })
+    
+    return resultado
+
+@app.route('/api/stock-actual')
+@require_login_api
+@con_version_datos
+def obtener_stock_actual():
+    """Obtener stock actual de todos los explosivos usando vistas optimizadas o cálculo directo"""
+    try:
+        return jsonify(datos_stock_actual())
         
     except Exception as e:
         print(f"Error en obtener_stock_actual: {e}")
@@ -2227,106 +3508,142 @@ def obtener_stock_actual_original():
     
     return jsonify(resultado)
 
+def datos_resumen_dia(hoy=None):
+    """Conteo de salidas, ingresos y devoluciones del día en una sola consulta"""
+    hoy = hoy or date.today()
+    inicio = datetime.combine(hoy, datetime.min.time())
+    
+    # Rangos semiabiertos sobre la fecha (aprovechan los índices, a diferencia de CAST)
+    row = db.session.execute(text("""
+        SELECT
+            (SELECT COUNT(*) FROM salidas WHERE fecha_salida >= :inicio AND fecha_salida < :fin) AS salidas,
+            (SELECT COUNT(*) FROM ingresos WHERE fecha_ingreso >= :inicio AND fecha_ingreso < :fin) AS ingresos,
+            (SELECT COUNT(*) FROM devoluciones WHERE fecha_devolucion >= :inicio AND fecha_devolucion < :fin) AS devoluciones
+    """), {'inicio': inicio, 'fin': inicio + timedelta(days=1)}).fetchone()
+    
+    return {
+        'salidas': row.salidas,
+        'ingresos': row.ingresos,
+        'devoluciones': row.devoluciones,
+        'fecha': hoy.isoformat()
+    }
+
 @app.route('/api/resumen-dia')
 @require_login_api
 def obtener_resumen_dia():
     """Obtener resumen del día actual"""
-    hoy = date.today()
-    
-    # Contar salidas del día
-    salidas = Salida.query.filter(
-        db.func.cast(Salida.fecha_salida, db.Date) == hoy
-    ).count()
-    
-    # Contar ingresos del día
-    ingresos = Ingreso.query.filter(
-        db.func.cast(Ingreso.fecha_ingreso, db.Date) == hoy
-    ).count()
-    
-    # Contar devoluciones del día (si existe la tabla)
-    try:
-        devoluciones = Devolucion.query.filter(
-            db.func.cast(Devolucion.fecha_devolucion, db.Date) == hoy
-        ).count()
-    except:
-        devoluciones = 0
+    return jsonify(datos_resumen_dia())
+
+def datos_historial_reciente():
+    """Últimas 10 salidas y 5 ingresos en una sola consulta (UNION ALL), del más reciente al más antiguo"""
+    # Obtener últimas 10 salidas
+    salidas = select(
+        Salida.fecha_salida.label('fecha'),
+        literal('salida').label('tipo'),
+        Explosivo.descripcion.label('explosivo'),
+        Salida.cantidad.label('cantidad'),
+        Explosivo.unidad.label('unidad'),
+        Salida.labor.label('destino')
+    ).join(Explosivo, Salida.explosivo_id == Explosivo.id).order_by(Salida.fecha_salida.desc()).limit(10).subquery()
+    
+    # Obtener últimos 5 ingresos
+    ingresos = select(
+        Ingreso.fecha_ingreso.label('fecha'),
+        literal('ingreso').label('tipo'),
+        Explosivo.descripcion.label('explosivo'),
+        Ingreso.cantidad.label('cantidad'),
+        Explosivo.unidad.label('unidad'),
+        Ingreso.recibido_por.label('destino')  # Usar recibido_por en lugar de proveedor
+    ).join(Explosivo, Ingreso.explosivo_id == Explosivo.id).order_by(Ingreso.fecha_ingreso.desc()).limit(5).subquery()
+    
+    movimientos = db.session.execute(union_all(select(salidas), select(ingresos))).fetchall()
+    
+    # Ordenar por fecha descendente (más reciente primero)
+    todos_movimientos = []
+    for m in sorted(movimientos, key=lambda m: m.fecha or datetime.min, reverse=True):
+        if m.tipo == 'ingreso':
+            # Usar recibido_por o un valor por defecto
+            destino = f'Recibido por: {m.destino if m.destino else "Almacén"}'
+        else:
+            destino = m.destino
+        todos_movimientos.append({
+            'fecha': m.fecha.strftime('%d/%m/%Y %H:%M'),
+            'tipo': m.tipo,
+            'explosivo': m.explosivo,
+            'cantidad': int(m.cantidad),
+            'unidad': m.unidad,
+            'destino': destino
+        })
     
-    return jsonify({
-        'salidas': salidas,
-        'ingresos': ingresos,
-        'devoluciones': devoluciones,
-        'fecha': hoy.isoformat()
-    })
+    return todos_movimientos[:15]
 
 @app.route('/api/historial-reciente')
 @require_login_api
 def obtener_historial_reciente():
-    """Obtener historial reciente de movimientos"""
-    try:
-        # Obtener últimas 10 salidas
-        salidas = db.session.query(
-            Salida.fecha_salida.label('fecha'),
-            db.literal('salida').label('tipo'),
-            Explosivo.descripcion.label('explosivo'),
-            Salida.cantidad,
-            Explosivo.unidad,
-            Salida.labor.label('destino')
-        ).join(Explosivo).order_by(Salida.fecha_salida.desc()).limit(10).all()
-        
-        # Obtener últimas 5 ingresos
-        ingresos = db.session.query(
-            Ingreso.fecha_ingreso.label('fecha'),
-            db.literal('ingreso').label('tipo'),
-            Explosivo.descripcion.label('explosivo'),
-            Ingreso.cantidad,
-            Explosivo.unidad,
-            Ingreso.recibido_por.label('destino')  # Usar recibido_por en lugar de proveedor
-        ).join(Explosivo).order_by(Ingreso.fecha_ingreso.desc()).limit(5).all()
-        
-        # Combinar movimientos
-        todos_movimientos = []
-        
-        for s in salidas:
-            todos_movimientos.append({
-                'fecha': s.fecha.strftime('%d/%m/%Y %H:%M'),
-                'tipo': s.tipo,
-                'explosivo': s.explosivo,
-                'cantidad': int(s.cantidad),
-                'unidad': s.unidad,
-                'destino': s.destino
-            })
-        
-        for i in ingresos:
-            # Usar recibido_por o un valor por defecto
-            destino_ingreso = i.destino if i.destino else 'Almacén'
-            todos_movimientos.append({
-                'fecha': i.fecha.strftime('%d/%m/%Y %H:%M'),
-                'tipo': i.tipo,
-                'explosivo': i.explosivo,
-                'cantidad': int(i.cantidad),
-                'unidad': i.unidad,
-                'destino': f'Recibido por: {destino_ingreso}'
-            })
-        
-        # Ordenar por fecha descendente (más reciente primero)
-        # Convertir fecha string a datetime para ordenar correctamente
-        from datetime import datetime
-        
-        def parse_fecha(fecha_str):
-            try:
-                return datetime.strptime(fecha_str, '%d/%m/%Y %H:%M')
-            except:
-                return datetime.min
-        
-        todos_movimientos.sort(key=lambda x: parse_fecha(x['fecha']), reverse=True)
-        
-        return jsonify(todos_movimientos[:15])
+    """Obtener historial reciente de movimientos"""
+    try:
+        return jsonify(datos_historial_reciente())
     except Exception as e:
         print(f"Error en historial reciente: {e}")
         import traceback
         traceback.print_exc()
         return jsonify([])
 
+# Instantánea del dashboard por guardia: se sirve desde memoria durante DASHBOARD_TTL
+# segundos y se descarta al confirmarse cualquier movimiento (_tras_commit_movimientos).
+# Es del proceso, como la versión del ETag: un movimiento confirmado en otro worker o por
+# un script no la descarta, y ese worker puede mostrar datos de hasta DASHBOARD_TTL segundos.
+DASHBOARD_TTL = int(os.environ.get('DASHBOARD_TTL', 30))
+
+_cache_dashboard = {'clave': None, 'datos': None, 'generado': 0.0, 'invalidaciones': 0}
+_cache_dashboard_lock = threading.Lock()
+
+def invalidar_cache_dashboard():
+    with _cache_dashboard_lock:
+        _cache_dashboard['datos'] = None
+        _cache_dashboard['invalidaciones'] += 1
+
+def obtener_datos_dashboard():
+    """Resumen del día, stock actual e historial reciente; (datos, desde_cache)
+
+    Sin caché son tres consultas (conteos, saldos, UNION ALL del historial): cada parte tiene
+    otra forma de resultado y reusa la función de su API, así que no se unen en una sola.
+    """
+    clave = (date.today(), obtener_guardia_actual())
+    with _cache_dashboard_lock:
+        if (_cache_dashboard['datos'] is not None and _cache_dashboard['clave'] == clave
+                and time.time() - _cache_dashboard['generado'] < DASHBOARD_TTL):
+            return _cache_dashboard['datos'], True
+        invalidaciones = _cache_dashboard['invalidaciones']
+    
+    generado = time.time()
+    datos = {
+        'fecha': clave[0].isoformat(),
+        'guardia': clave[1],
+        'resumen': datos_resumen_dia(clave[0]),
+        'stock': datos_stock_actual(),
+        'historial': datos_historial_reciente(),
+        'generado_en': datetime.now().isoformat(timespec='seconds')
+    }
+    
+    with _cache_dashboard_lock:
+        # Un movimiento confirmado mientras se armaba la instantánea la deja sin cachear
+        if _cache_dashboard['invalidaciones'] == invalidaciones:
+            _cache_dashboard.update({'clave': clave, 'datos': datos, 'generado': generado})
+    return datos, False
+
+@app.route('/api/dashboard')
+@require_login_api
+def api_dashboard():
+    """Resumen del día, stock actual e historial reciente en una sola respuesta (caché por guardia)"""
+    try:
+        datos, desde_cache = obtener_datos_dashboard()
+        return jsonify(dict(datos, cache=desde_cache))
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error en api_dashboard: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.errorhandler(404)
 def page_not_found(error):
     """Maneja errores 404 - página no encontrada"""
@@ -2342,6 +3659,134 @@ def ruta_nueva_incorrecta():
     """Redirige /nueva a la página principal"""
     return redirect(url_for('index'))
 
+# =====================================================
+# MOTOR DE PIVOTE DE LABORES
+# =====================================================
+
+# Rango máximo (días) de la exportación de stock diario
+EXPORTACION_MAX_DIAS = int(os.environ.get('EXPORTACION_MAX_DIAS', 93))
+
+def normalizar_nombre_labor(nombre):
+    """Clave de comparación de labores: mayúsculas y espacios simples"""
+    return ' '.join((nombre or '').upper().split())
+
+def crear_resolutor_labores():
+    """Construir una función que asigna el texto libre de salidas.labor a una labor del catálogo
+
+    - Coincidencia exacta (sin distinguir mayúsculas/espacios) con labores.nombre
+    - Si no, la labor más larga del catálogo contenida en el texto (equivale al antiguo LIKE '%labor%')
+    - Si no hay coincidencia, el texto original se conserva como su propia labor
+    """
+    try:
+        nombres = [row.nombre for row in db.session.execute(text("SELECT nombre FROM labores")).fetchall() if row.nombre]
+    except Exception as e:
+        print(f"Error leyendo catálogo de labores, se usa el texto de salidas: {e}")
+        db.session.rollback()
+        nombres = []
+
+    exactas = {normalizar_nombre_labor(nombre): nombre for nombre in nombres}
+    por_longitud = sorted(exactas.items(), key=lambda item: len(item[0]), reverse=True)
+    resueltas = {}
+
+    def resolver(labor_texto):
+        if labor_texto not in resueltas:
+            clave = normalizar_nombre_labor(labor_texto)
+            nombre = exactas.get(clave)
+            if nombre is None:
+                nombre = next((nombre for clave_labor, nombre in por_longitud if clave_labor and clave_labor in clave),
+                              labor_texto.strip())
+            resueltas[labor_texto] = nombre
+        return resueltas[labor_texto]
+
+    return resolver
+
+def sql_fecha(columna):
+    """Expresión que trunca un DATETIME a su fecha: en SQLite CAST(x AS DATE) devuelve el año
+    como entero, DATE(x) devuelve 'AAAA-MM-DD' (normalizar_fecha lo convierte a date)"""
+    if db.engine.dialect.name == 'sqlite':
+        return f'DATE({columna})'
+    return f'CAST({columna} AS DATE)'
+
+def normalizar_fecha(valor):
+    """Convertir la fecha devuelta por el driver (date, datetime o texto) a date"""
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, str):
+        return datetime.strptime(valor[:10], '%Y-%m-%d').date()
+    return valor
+
+def calcular_matriz_labores(fecha_desde, fecha_hasta=None, explosivos_ids=None):
+    """Consumo por labor en una sola pasada agrupada sobre salidas
+
+    Retorna una matriz dispersa:
+        {
+            'celdas': {(explosivo_id, fecha, guardia): {labor: cantidad}},
+            'labores_por_turno': {'dia': [labor, ...], 'noche': [labor, ...]}
+        }
+    Solo existen celdas con consumo; las labores se ordenan alfabéticamente.
+    """
+    if fecha_hasta is None:
+        fecha_hasta = fecha_desde
+
+    params = {
+        'inicio': datetime.combine(fecha_desde, datetime.min.time()),
+        'fin': datetime.combine(fecha_hasta, datetime.min.time()) + timedelta(days=1)
+    }
+
+    fecha_salida = sql_fecha('s.fecha_salida')
+    query = f"""
+        SELECT
+            s.explosivo_id,
+            {fecha_salida} as fecha,
+            s.guardia,
+            s.labor,
+            SUM(s.cantidad) as cantidad_total
+        FROM salidas s
+        WHERE s.fecha_salida >= :inicio
+        AND s.fecha_salida < :fin
+        AND s.labor IS NOT NULL
+        AND s.labor != ''
+        AND s.cantidad > 0
+    """
+
+    if explosivos_ids is not None:
+        if not explosivos_ids:
+            return {'celdas': {}, 'labores_por_turno': {'dia': [], 'noche': []}}
+        for i, exp_id in enumerate(explosivos_ids):
+            params[f'id_{i}'] = exp_id
+        placeholders = ','.join([f':id_{i}' for i in range(len(explosivos_ids))])
+        query += f" AND s.explosivo_id IN ({placeholders})"
+
+    query += f" GROUP BY s.explosivo_id, {fecha_salida}, s.guardia, s.labor"
+
+    filas = db.session.execute(text(query), params).fetchall()
+
+    resolver = crear_resolutor_labores()
+    celdas = {}
+    labores_turno = {'dia': set(), 'noche': set()}
+
+    for fila in filas:
+        guardia = 'dia' if fila.guardia == 'dia' else 'noche'
+        fecha = normalizar_fecha(fila.fecha)
+
+        labor = resolver(fila.labor)
+        celda = celdas.setdefault((fila.explosivo_id, fecha, guardia), {})
+        celda[labor] = celda.get(labor, 0.0) + float(fila.cantidad_total or 0)
+        labores_turno[guardia].add(labor)
+
+    return {
+        'celdas': celdas,
+        'labores_por_turno': {guardia: sorted(labores) for guardia, labores in labores_turno.items()}
+    }
+
+def labores_en_columnas(consumo, columnas):
+    """Convertir {labor: cantidad} al formato indexado labor_1..labor_n alineado con las columnas"""
+    labores = {}
+    for i, nombre in enumerate(columnas, 1):
+        if nombre in consumo:
+            labores[f'labor_{i}'] = {'nombre': nombre, 'cantidad': consumo[nombre]}
+    return labores
+
 @app.route('/stock-diario')
 @require_login
 def ver_stock_diario():
@@ -2407,6 +3852,21 @@ def ver_stock_diario():
         
         explosivos = obtener_explosivos_ordenados()
         
+        # Consumo por labor de la fecha en una sola consulta (matriz dispersa)
+        try:
+            matriz_labores = calcular_matriz_labores(fecha_obj)
+        except Exception as e:
+            print(f"Error calculando matriz de labores: {e}")
+            db.session.rollback()
+            matriz_labores = {'celdas': {}, 'labores_por_turno': {'dia': [], 'noche': []}}
+        
+        # Columnas de labores: las que realmente se usaron en cada turno de la fecha
+        labores_por_turno = matriz_labores['labores_por_turno']
+        max_labores_por_turno = {
+            'dia': len(labores_por_turno['dia']),
+            'noche': len(labores_por_turno['noche'])
+        }
+        
         datos_organizados = {}
         resumen_data = {
             'total_explosivos': 0,
@@ -2442,47 +3902,9 @@ def ver_stock_diario():
                 tipo_diferencia = 'cero'
                 resumen_data['total_diferencias_cero'] += 1
             
-            # Procesar las labores (simplificado ya que la vista no tiene detalle de labores)
-            labores_del_turno = {}
-            
-            # Solo agregar labores si realmente hay salidas registradas
-            if salidas > 0:
-                # Buscar las labores específicas para este explosivo en esta fecha/turno
-                try:
-                    query_labores_explosivo = """
-                        SELECT s.labor, SUM(s.cantidad) as cantidad_total
-                        FROM salidas s
-                        WHERE s.explosivo_id = :explosivo_id
-                        AND CAST(s.fecha_salida AS DATE) = :fecha
-                        AND s.guardia = :guardia
-                        AND s.labor IS NOT NULL
-                        AND s.labor != ''
-                        GROUP BY s.labor
-                        ORDER BY s.labor
-                    """
-                    
-                    result_labores_exp = db.session.execute(text(query_labores_explosivo), {
-                        'explosivo_id': stock.explosivo_id,
-                        'fecha': fecha_obj,
-                        'guardia': stock.guardia
-                    })
-                    labores_explosivo = result_labores_exp.fetchall()
-                    result_labores_exp.close()
-                    
-                    # Crear las labores específicas
-                    for i, labor_data in enumerate(labores_explosivo, 1):
-                        labor_key = f'labor_{i}'
-                        labores_del_turno[labor_key] = {
-                            'nombre': labor_data.labor,
-                            'cantidad': float(labor_data.cantidad_total)
-                        }
-                        
-                except Exception as e:
-                    # Si hay error consultando labores específicas, crear entrada genérica
-                    labores_del_turno['labor_1'] = {
-                        'nombre': 'Salidas del turno',
-                        'cantidad': salidas
-                    }
+            # Labores del turno alineadas con las columnas de la tabla
+            consumo_labores = matriz_labores['celdas'].get((stock.explosivo_id, fecha_obj, turno_key), {})
+            labores_del_turno = labores_en_columnas(consumo_labores, labores_por_turno[turno_key])
             
             if codigo not in datos_organizados:
                 datos_organizados[codigo] = {
@@ -2520,46 +3942,6 @@ def ver_stock_diario():
         resumen_data['diferencia_total'] = resumen_data['stock_final_total'] - resumen_data['stock_inicial_total']
         resumen = type('obj', (object,), resumen_data)
         
-        # Obtener labores que realmente se usaron en esta fecha específica
-        try:
-            query_labores_usadas = """
-                SELECT DISTINCT 
-                    s.guardia as turno,
-                    s.labor
-                FROM salidas s
-                WHERE CAST(s.fecha_salida AS DATE) = :fecha
-                AND s.labor IS NOT NULL
-                AND s.labor != ''
-                AND s.cantidad > 0
-                ORDER BY s.guardia DESC, s.labor
-            """
-            
-            result_labores = db.session.execute(text(query_labores_usadas), {'fecha': fecha_obj})
-            labores_usadas = result_labores.fetchall()
-            result_labores.close()
-            
-            # Organizar labores por turno (solo las que se usaron realmente)
-            labores_por_turno = {'dia': [], 'noche': []}
-            for labor_data in labores_usadas:
-                turno_key = 'dia' if labor_data.turno == 'dia' else 'noche'
-                if labor_data.labor and labor_data.labor not in labores_por_turno[turno_key]:
-                    labores_por_turno[turno_key].append(labor_data.labor)
-            
-            # Calcular máximo de labores por turno
-            max_labores_por_turno = {
-                'dia': len(labores_por_turno['dia']),
-                'noche': len(labores_por_turno['noche'])
-            }
-            
-            # Si no hay labores específicas, no mostrar columnas de labores
-            if max_labores_por_turno['dia'] == 0 and max_labores_por_turno['noche'] == 0:
-                max_labores_por_turno = {'dia': 0, 'noche': 0}
-                
-        except Exception as e:
-            # En caso de error, no mostrar columnas de labores
-            labores_por_turno = {'dia': [], 'noche': []}
-            max_labores_por_turno = {'dia': 0, 'noche': 0}
-        
         return render_template('stock_diario_dinamico.html', 
                              datos=datos_organizados,
                              fecha_seleccionada=fecha_obj,
@@ -2592,6 +3974,7 @@ def ver_stock_diario():
 
 @app.route('/api/stock-diario-datos')
 @require_login_api
+@con_version_datos
 def api_stock_diario_datos():
     """API para obtener datos de stock diario usando las vistas optimizadas"""
     fecha_filtro = request.args.get('fecha', date.today().isoformat())
@@ -2607,6 +3990,7 @@ def api_stock_diario_datos():
         # Usar la nueva vista vw_stock_diario_simple que incluye validación de consistencia
         query = """
             SELECT 
+                explosivo_id,
                 codigo,
                 descripcion,
                 unidad,
@@ -2643,6 +4027,8 @@ def api_stock_diario_datos():
         stocks = result.fetchall()
         result.close()
         
+        matriz_labores = calcular_matriz_labores(fecha_obj)
+        
         resultado = []
         for stock in stocks:
             # Calcular diferencia (stock final - inicial)
@@ -2671,7 +4057,8 @@ def api_stock_diario_datos():
                 'devoluciones': float(stock.devoluciones),
                 'responsable_guardia': stock.responsable_guardia or 'Sistema',
                 'observaciones': stock.observaciones or f'Vista dinámica - {fecha_obj}',
-                'estado_consistencia': stock.estado_consistencia
+                'estado_consistencia': stock.estado_consistencia,
+                'labores': matriz_labores['celdas'].get((stock.explosivo_id, fecha_obj, stock.guardia), {})
             })
         
         return jsonify(resultado)
@@ -2687,213 +4074,67 @@ def api_stock_diario_datos():
         return jsonify({'error': 'Error al obtener datos de stock diario'}), 500
 
 def obtener_stock_historico_por_fecha(fecha_obj):
-    """Obtener stock histórico calculado desde movimientos para una fecha específica"""
+    """Obtener stock histórico calculado desde movimientos para una fecha específica
+
+    Una sola consulta agrupada devuelve, para todos los explosivos con movimientos
+    hasta la fecha, el saldo acumulado anterior y los totales por turno; el consumo
+    por labor sale de la matriz de labores.
+    """
     from sqlalchemy import text
     
     try:
-        # Obtener todos los explosivos que tuvieron movimientos hasta la fecha solicitada
-        query_explosivos = """
-            SELECT DISTINCT e.id, e.codigo, e.descripcion, e.unidad
-            FROM explosivos e
-            WHERE EXISTS (
-                SELECT 1 FROM salidas WHERE explosivo_id = e.id AND CAST(fecha_salida AS DATE) <= :fecha
-                UNION
-                SELECT 1 FROM ingresos WHERE explosivo_id = e.id AND CAST(fecha_ingreso AS DATE) <= :fecha
-                UNION
-                SELECT 1 FROM devoluciones d 
-                INNER JOIN salidas s ON d.salida_id = s.id
-                WHERE s.explosivo_id = e.id AND CAST(d.fecha_devolucion AS DATE) <= :fecha
-            )
+        # Rangos semiabiertos sobre las columnas datetime (sin CAST, aprovechan índices)
+        inicio_dia = datetime.combine(fecha_obj, datetime.min.time())
+        fin_dia = inicio_dia + timedelta(days=1)
+        
+        params = {'inicio_dia': inicio_dia, 'fin_dia': fin_dia}
+        columnas_turno = []
+        
+        for guardia in ['dia', 'noche']:
+            for tipo, nombre in [('I', 'ingresos'), ('S', 'salidas'), ('D', 'devoluciones')]:
+                columnas_turno.append(f"""
+                    SUM(CASE WHEN m.fecha >= :inicio_dia AND m.tipo = '{tipo}' AND m.guardia = '{guardia}'
+                        THEN m.cantidad ELSE 0 END) as {nombre}_{guardia}""")
+        
+        query_historico = f"""
+            SELECT 
+                e.id, e.codigo, e.descripcion, e.unidad,
+                -- Stock acumulado hasta el día anterior (ingresos - salidas + devoluciones)
+                SUM(CASE WHEN m.fecha < :inicio_dia THEN
+                    CASE WHEN m.tipo = 'S' THEN -m.cantidad ELSE m.cantidad END
+                    ELSE 0 END) as stock_anterior,
+                {','.join(columnas_turno)}
+            FROM (
+                SELECT explosivo_id, fecha_ingreso as fecha, guardia, cantidad, 'I' as tipo
+                FROM ingresos WHERE fecha_ingreso < :fin_dia
+                UNION ALL
+                SELECT explosivo_id, fecha_salida, guardia, cantidad, 'S'
+                FROM salidas WHERE fecha_salida < :fin_dia
+                UNION ALL
+                SELECT COALESCE(d.explosivo_id, s.explosivo_id), d.fecha_devolucion, d.guardia, d.cantidad_devuelta, 'D'
+                FROM devoluciones d
+                LEFT JOIN salidas s ON d.salida_id = s.id
+                WHERE d.fecha_devolucion < :fin_dia
+            ) m
+            INNER JOIN explosivos e ON e.id = m.explosivo_id
+            GROUP BY e.id, e.codigo, e.descripcion, e.unidad
             ORDER BY e.codigo
         """
         
-        result = db.session.execute(text(query_explosivos), {'fecha': fecha_obj})
-        explosivos = result.fetchall()
+        result = db.session.execute(text(query_historico), params)
+        filas = result.fetchall()
         result.close()
         
+        matriz_labores = calcular_matriz_labores(fecha_obj)
+        
         resultado = []
         
-        for explosivo in explosivos:
-            # Calcular stock acumulado hasta el día anterior (final del turno noche del día anterior)
-            dia_anterior = fecha_obj - timedelta(days=1)
-            
-            query_stock_anterior = """
-                SELECT 
-                    -- Total ingresos hasta día anterior
-                    COALESCE((
-                        SELECT SUM(cantidad) 
-                        FROM ingresos 
-                        WHERE explosivo_id = :explosivo_id 
-                        AND CAST(fecha_ingreso AS DATE) <= :fecha_anterior
-                    ), 0) as total_ingresos_anterior,
-                    -- Total salidas hasta día anterior
-                    COALESCE((
-                        SELECT SUM(cantidad) 
-                        FROM salidas 
-                        WHERE explosivo_id = :explosivo_id 
-                        AND CAST(fecha_salida AS DATE) <= :fecha_anterior
-                    ), 0) as total_salidas_anterior,
-                    -- Total devoluciones hasta día anterior
-                    COALESCE((
-                        SELECT SUM(d.cantidad_devuelta) 
-                        FROM devoluciones d
-                        INNER JOIN salidas s ON d.salida_id = s.id
-                        WHERE s.explosivo_id = :explosivo_id 
-                        AND CAST(d.fecha_devolucion AS DATE) <= :fecha_anterior
-                    ), 0) as total_devoluciones_anterior
-            """
-            
-            result_anterior = db.session.execute(text(query_stock_anterior), {
-                'explosivo_id': explosivo.id,
-                'fecha_anterior': dia_anterior
-            })
-            stock_anterior = result_anterior.fetchone()
-            result_anterior.close()
+        for movimientos in filas:
+            # Cada fila trae los datos del explosivo junto con sus totales
+            explosivo = movimientos
             
             # Stock inicial del día = stock acumulado hasta día anterior
-            stock_inicial_dia = (float(stock_anterior.total_ingresos_anterior) - 
-                               float(stock_anterior.total_salidas_anterior) + 
-                               float(stock_anterior.total_devoluciones_anterior))
-            
-            # Obtener movimientos del día específico separados por turno usando la columna guardia
-            query_movimientos_turnos = """
-                SELECT 
-                    -- TURNO DÍA (usando columna guardia = 'dia')
-                    COALESCE((
-                        SELECT SUM(cantidad) 
-                        FROM ingresos 
-                        WHERE explosivo_id = :explosivo_id 
-                        AND CAST(fecha_ingreso AS DATE) = :fecha
-                        AND guardia = 'dia'
-                    ), 0) as ingresos_dia,
-                    COALESCE((
-                        SELECT SUM(cantidad) 
-                        FROM salidas 
-                        WHERE explosivo_id = :explosivo_id 
-                        AND CAST(fecha_salida AS DATE) = :fecha
-                        AND guardia = 'dia'
-                    ), 0) as salidas_dia,
-                    COALESCE((
-                        SELECT SUM(d.cantidad_devuelta) 
-                        FROM devoluciones d
-                        INNER JOIN salidas s ON d.salida_id = s.id
-                        WHERE s.explosivo_id = :explosivo_id 
-                        AND CAST(d.fecha_devolucion AS DATE) = :fecha
-                        AND d.guardia = 'dia'
-                    ), 0) as devoluciones_dia,
-                    -- TURNO NOCHE (usando columna guardia = 'noche')
-                    COALESCE((
-                        SELECT SUM(cantidad) 
-                        FROM ingresos 
-                        WHERE explosivo_id = :explosivo_id 
-                        AND CAST(fecha_ingreso AS DATE) = :fecha
-                        AND guardia = 'noche'
-                    ), 0) as ingresos_noche,
-                    COALESCE((
-                        SELECT SUM(cantidad) 
-                        FROM salidas 
-                        WHERE explosivo_id = :explosivo_id 
-                        AND CAST(fecha_salida AS DATE) = :fecha
-                        AND guardia = 'noche'
-                    ), 0) as salidas_noche,
-                    COALESCE((
-                        SELECT SUM(d.cantidad_devuelta) 
-                        FROM devoluciones d
-                        INNER JOIN salidas s ON d.salida_id = s.id
-                        WHERE s.explosivo_id = :explosivo_id 
-                        AND CAST(d.fecha_devolucion AS DATE) = :fecha
-                        AND d.guardia = 'noche'
-                    ), 0) as devoluciones_noche,
-                    -- SALIDAS POR LABOR (divididas por turno)
-                    COALESCE((
-                        SELECT SUM(cantidad) 
-                        FROM salidas 
-                        WHERE explosivo_id = :explosivo_id 
-                        AND CAST(fecha_salida AS DATE) = :fecha
-                        AND guardia = 'dia'
-                        AND labor LIKE '%M-1005%'
-                    ), 0) as labor_m1005_dia,
-                    COALESCE((
-                        SELECT SUM(cantidad) 
-                        FROM salidas 
-                        WHERE explosivo_id = :explosivo_id 
-                        AND CAST(fecha_salida AS DATE) = :fecha
-                        AND guardia = 'dia'
-                        AND labor LIKE '%P-554%'
-                    ), 0) as labor_p554_dia,
-                    COALESCE((
-                        SELECT SUM(cantidad) 
-                        FROM salidas 
-                        WHERE explosivo_id = :explosivo_id 
-                        AND CAST(fecha_salida AS DATE) = :fecha
-                        AND guardia = 'dia'
-                        AND labor LIKE '%N-830%'
-                    ), 0) as labor_n830_dia,
-                    COALESCE((
-                        SELECT SUM(cantidad) 
-                        FROM salidas 
-                        WHERE explosivo_id = :explosivo_id 
-                        AND CAST(fecha_salida AS DATE) = :fecha
-                        AND guardia = 'dia'
-                        AND labor LIKE '%M-535 V55%'
-                    ), 0) as labor_m535v55_dia,
-                    COALESCE((
-                        SELECT SUM(cantidad) 
-                        FROM salidas 
-                        WHERE explosivo_id = :explosivo_id 
-                        AND CAST(fecha_salida AS DATE) = :fecha
-                        AND guardia = 'dia'
-                        AND labor LIKE '%M-535 V5 N%'
-                    ), 0) as labor_m535v5n_dia,
-                    -- SALIDAS POR LABOR TURNO NOCHE
-                    COALESCE((
-                        SELECT SUM(cantidad) 
-                        FROM salidas 
-                        WHERE explosivo_id = :explosivo_id 
-                        AND CAST(fecha_salida AS DATE) = :fecha
-                        AND guardia = 'noche'
-                        AND labor LIKE '%M-1005%'
-                    ), 0) as labor_m1005_noche,
-                    COALESCE((
-                        SELECT SUM(cantidad) 
-                        FROM salidas 
-                        WHERE explosivo_id = :explosivo_id 
-                        AND CAST(fecha_salida AS DATE) = :fecha
-                        AND guardia = 'noche'
-                        AND labor LIKE '%P-554%'
-                    ), 0) as labor_p554_noche,
-                    COALESCE((
-                        SELECT SUM(cantidad) 
-                        FROM salidas 
-                        WHERE explosivo_id = :explosivo_id 
-                        AND CAST(fecha_salida AS DATE) = :fecha
-                        AND guardia = 'noche'
-                        AND labor LIKE '%N-830%'
-                    ), 0) as labor_n830_noche,
-                    COALESCE((
-                        SELECT SUM(cantidad) 
-                        FROM salidas 
-                        WHERE explosivo_id = :explosivo_id 
-                        AND CAST(fecha_salida AS DATE) = :fecha
-                        AND guardia = 'noche'
-                        AND labor LIKE '%M-535 V55%'
-                    ), 0) as labor_m535v55_noche,
-                    COALESCE((
-                        SELECT SUM(cantidad) 
-                        FROM salidas 
-                        WHERE explosivo_id = :explosivo_id 
-                        AND CAST(fecha_salida AS DATE) = :fecha
-                        AND guardia = 'noche'
-                        AND labor LIKE '%M-535 V5 N%'
-                    ), 0) as labor_m535v5n_noche
-            """
-            
-            result_turnos = db.session.execute(text(query_movimientos_turnos), {
-                'explosivo_id': explosivo.id,
-                'fecha': fecha_obj
-            })
-            movimientos = result_turnos.fetchone()
-            result_turnos.close()
+            stock_inicial_dia = float(movimientos.stock_anterior or 0)
             
             # Verificar si hubo movimientos en este día
             total_movimientos = (float(movimientos.ingresos_dia) + float(movimientos.salidas_dia) + float(movimientos.devoluciones_dia) +
@@ -2938,11 +4179,7 @@ def obtener_stock_historico_por_fecha(fecha_obj):
                     # Datos específicos para el nuevo formato
                     'salidas_total': float(movimientos.salidas_dia),
                     'devoluciones_dia': float(movimientos.devoluciones_dia),
-                    'labor_m1005': float(movimientos.labor_m1005_dia),
-                    'labor_p554': float(movimientos.labor_p554_dia),
-                    'labor_n830': float(movimientos.labor_n830_dia),
-                    'labor_m535v55': float(movimientos.labor_m535v55_dia),
-                    'labor_m535v5n': float(movimientos.labor_m535v5n_dia)
+                    'labores': matriz_labores['celdas'].get((explosivo.id, fecha_obj, 'dia'), {})
                 })
                 
                 # TURNO NOCHE
@@ -2982,11 +4219,7 @@ def obtener_stock_historico_por_fecha(fecha_obj):
                     # Datos específicos para el nuevo formato
                     'salidas_total': float(movimientos.salidas_noche),
                     'devoluciones_dia': float(movimientos.devoluciones_noche),
-                    'labor_m1005': float(movimientos.labor_m1005_noche),
-                    'labor_p554': float(movimientos.labor_p554_noche),
-                    'labor_n830': float(movimientos.labor_n830_noche),
-                    'labor_m535v55': float(movimientos.labor_m535v55_noche),
-                    'labor_m535v5n': float(movimientos.labor_m535v5n_noche)
+                    'labores': matriz_labores['celdas'].get((explosivo.id, fecha_obj, 'noche'), {})
                 })
         
         return resultado
@@ -3001,144 +4234,126 @@ def obtener_stock_historico_por_fecha(fecha_obj):
 @app.route('/api/stock-diario-excel')
 @require_login
 def descargar_stock_diario_excel():
-    """Generar y descargar reporte de stock diario en Excel (CSV formato Excel)"""
+    """Exportar stock diario en CSV o XLSX, en streaming, para un día o un rango de fechas
+
+    Parámetros: fecha (un día) o fecha_desde/fecha_hasta, grupo, explosivo_id, formato=csv|xlsx
+    """
+    fecha_unica = request.args.get('fecha', '').strip()
+    
     try:
-        from datetime import datetime
-        import io
-        
-        # Obtener parámetros
-        fecha_filtro = request.args.get('fecha', date.today().isoformat())
-        explosivo_filtro = request.args.get('explosivo_id', '')
-        
-        try:
-            fecha_obj = datetime.strptime(fecha_filtro, '%Y-%m-%d').date()
-        except:
-            fecha_obj = date.today()
-        
-        # Obtener datos usando la nueva vista dinámica
-        from sqlalchemy import text
-        
-        query_base = """
-            SELECT 
-                codigo,
-                descripcion,
-                unidad,
-                stock_inicial,
-                ingresos,
-                salidas as total_sal_guardia,
-                devoluciones as retorno,
-                stock_final as stock_final_de_guardia,
-                fecha,
-                guardia as turno,
-                responsable_guardia,
-                observaciones,
-                estado_consistencia
-            FROM vw_stock_diario_simple
-            WHERE fecha = :fecha
-        """
-        
-        params = {'fecha': fecha_obj}
-        
-        if explosivo_filtro:
-            explosivo_query = "SELECT codigo FROM explosivos WHERE id = :explosivo_id"
-            explosivo_result = db.session.execute(text(explosivo_query), {'explosivo_id': int(explosivo_filtro)})
-            explosivo_codigo = explosivo_result.fetchone()
-            explosivo_result.close()
-            
-            if explosivo_codigo:
-                query_base += " AND codigo = :codigo_explosivo"
-                params['codigo_explosivo'] = explosivo_codigo[0]
-        
-        query_base += " ORDER BY codigo, guardia DESC"
-        
-        result = db.session.execute(text(query_base), params)
-        stocks_data = result.fetchall()
-        result.close()
-        
-        # Crear CSV que Excel puede abrir
-        csv_content = ""
-        
-        # Procesar datos para determinar el número máximo de labores
-        datos_procesados = []
-        max_labores = 0
-        
-        for stock in stocks_data:
-            labores = {}
-            if hasattr(stock, 'labores_detalle') and stock.labores_detalle:
-                # Formato: "M-1005 V3:25|M-535 V5 N:15"
-                for labor_detalle in stock.labores_detalle.split('|'):
-                    if ':' in labor_detalle:
-                        nombre_labor, cantidad_str = labor_detalle.split(':', 1)
-                        try:
-                            cantidad_labor = float(cantidad_str)
-                            labor_key = f'labor_{len(labores) + 1}'
-                            labores[labor_key] = {
-                                'nombre': nombre_labor.strip(),
-                                'cantidad': cantidad_labor
-                            }
-                        except ValueError:
-                            continue
-            
-            # Actualizar el máximo número de labores
-            max_labores = max(max_labores, len(labores))
-            
-            datos_procesados.append({
-                'stock': stock,
-                'labores': labores
-            })
-        
-        # Si no hay labores en ningún registro, establecer mínimo de 1
-        if max_labores == 0:
-            max_labores = 1
-        
-        # Headers dinámicos
-        csv_content += "Turno,Código,Descripción,Unidad,Stock Inicial,Total Salidas,"
-        for i in range(1, max_labores + 1):
-            csv_content += f"Labor {i} Nombre,Labor {i} Cantidad,"
-        csv_content += "Retorno,Stock Final\n"
-        
-        # Datos con labores dinámicas
-        for item in datos_procesados:
-            stock = item['stock']
-            labores = item['labores']
-            
-            csv_content += f"{stock.turno},"
-            csv_content += f'"{stock.codigo}",'
-            csv_content += f'"{stock.descripcion}",'
-            csv_content += f'"{stock.unidad}",'
-            csv_content += f"{stock.stock_inicial or 0},"
-            csv_content += f"{stock.total_sal_guardia or 0},"
-            
-            # Agregar labores dinámicamente
-            for i in range(1, max_labores + 1):
-                labor_key = f'labor_{i}'
-                if labor_key in labores:
-                    csv_content += f'"{labores[labor_key]["nombre"]}",'
-                    csv_content += f"{labores[labor_key]['cantidad']},"
-                else:
-                    csv_content += '"N/A",'
-                    csv_content += "0,"
-            
-            csv_content += f"{stock.retorno or 0},"
-            csv_content += f"{stock.stock_final_de_guardia or 0}\n"
-        
-        # Crear respuesta
-        output = io.BytesIO()
-        output.write(csv_content.encode('utf-8-sig'))  # BOM para Excel
-        output.seek(0)
-        
-        filename = f"stock_diario_{fecha_obj.strftime('%Y-%m-%d')}.csv"
+        fecha_desde = datetime.strptime(request.args.get('fecha_desde') or fecha_unica or date.today().isoformat(), '%Y-%m-%d').date()
+        fecha_hasta = datetime.strptime(request.args.get('fecha_hasta') or fecha_unica or fecha_desde.isoformat(), '%Y-%m-%d').date()
+    except ValueError:
+        return jsonify({'error': 'Formato de fecha inválido (use AAAA-MM-DD)'}), 400
+    
+    if fecha_hasta < fecha_desde:
+        return jsonify({'error': 'fecha_hasta no puede ser anterior a fecha_desde'}), 400
+    
+    if (fecha_hasta - fecha_desde).days + 1 > EXPORTACION_MAX_DIAS:
+        return jsonify({'error': f'El rango máximo de exportación es de {EXPORTACION_MAX_DIAS} días'}), 400
+    
+    formato = request.args.get('formato', 'csv').strip().lower()
+    if formato not in ('csv', 'xlsx'):
+        return jsonify({'error': 'Formato no soportado (csv o xlsx)'}), 400
+    
+    grupo_filtro = request.args.get('grupo', '').strip()
+    explosivo_filtro = request.args.get('explosivo_id', '').strip()
+    
+    try:
+        explosivos_ids = [int(explosivo_filtro)] if explosivo_filtro else None
+    except ValueError:
+        return jsonify({'error': 'explosivo_id inválido'}), 400
+    
+    query = """
+        SELECT 
+            vs.explosivo_id,
+            vs.fecha,
+            vs.guardia,
+            e.grupo,
+            vs.codigo,
+            vs.descripcion,
+            vs.unidad,
+            vs.stock_inicial,
+            vs.ingresos,
+            vs.salidas,
+            vs.devoluciones,
+            vs.stock_final,
+            vs.responsable_guardia,
+            vs.estado_consistencia
+        FROM vw_stock_diario_simple vs
+        JOIN explosivos e ON e.id = vs.explosivo_id
+        WHERE vs.fecha >= :fecha_desde
+        AND vs.fecha <= :fecha_hasta
+    """
+    params = {'fecha_desde': fecha_desde, 'fecha_hasta': fecha_hasta}
+    
+    if explosivos_ids:
+        query += " AND vs.explosivo_id = :explosivo_id"
+        params['explosivo_id'] = explosivos_ids[0]
+    
+    if grupo_filtro:
+        query += " AND e.grupo = :grupo"
+        params['grupo'] = grupo_filtro
+    
+    query += " ORDER BY vs.fecha, CASE WHEN vs.guardia = 'dia' THEN 1 ELSE 2 END, vs.codigo"
+    
+    try:
+        # Consumo por labor del rango completo (matriz dispersa, una sola consulta)
+        matriz_labores = calcular_matriz_labores(fecha_desde, fecha_hasta, explosivos_ids)
+        labores = sorted(set(matriz_labores['labores_por_turno']['dia']) | set(matriz_labores['labores_por_turno']['noche']))
         
-        return send_file(
-            output,
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name=filename
-        )
+        # Ejecutar antes de empezar a responder para poder devolver un error limpio;
+        # las filas se leen por bloques mientras se envía la respuesta
+        result = db.session.execute(text(query).execution_options(yield_per=FILAS_POR_BLOQUE), params)
         
     except Exception as e:
-        print(f"Error generando Excel: {e}")
-        return jsonify({'error': f'Error generando Excel: {str(e)}'}), 500
+        db.session.rollback()
+        print(f"Error preparando exportación de stock diario: {e}")
+        return jsonify({'error': f'Error generando exportación: {str(e)}'}), 500
+    
+    encabezados = ['Fecha', 'Turno', 'Grupo', 'Código', 'Descripción', 'Unidad',
+                   'Stock Inicial', 'Ingresos', 'Total Salidas'] + labores + \
+                  ['Retorno', 'Stock Final', 'Responsable', 'Estado']
+    
+    def filas_exportacion():
+        try:
+            for stock in result:
+                fecha = normalizar_fecha(stock.fecha)
+                consumo = matriz_labores['celdas'].get((stock.explosivo_id, fecha, stock.guardia), {})
+                
+                yield [
+                    fecha,
+                    stock.guardia,
+                    stock.grupo or 'Sin grupo',
+                    stock.codigo,
+                    stock.descripcion,
+                    stock.unidad,
+                    float(stock.stock_inicial or 0),
+                    float(stock.ingresos or 0),
+                    float(stock.salidas or 0)
+                ] + [consumo.get(labor, 0) for labor in labores] + [
+                    float(stock.devoluciones or 0),
+                    float(stock.stock_final or 0),
+                    stock.responsable_guardia or '',
+                    stock.estado_consistencia
+                ]
+        finally:
+            result.close()
+    
+    sufijo = fecha_desde.isoformat() if fecha_desde == fecha_hasta else f"{fecha_desde.isoformat()}_a_{fecha_hasta.isoformat()}"
+    
+    if formato == 'xlsx':
+        contenido = generar_xlsx(encabezados, filas_exportacion(), nombre_hoja='Stock diario')
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    else:
+        contenido = generar_csv(encabezados, filas_exportacion())
+        mimetype = 'text/csv'
+    
+    return Response(
+        stream_with_context(contenido),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="stock_diario_{sufijo}.{formato}"'}
+    )
 
 # =====================================================
 # RUTAS DE EDICIÓN Y CORRECCIÓN DE DATOS
@@ -3182,7 +4397,7 @@ def listar_salidas_edicion():
             query = query.filter(Salida.explosivo_id == int(explosivo_id))
         
         salidas = query.order_by(Salida.fecha_salida.desc()).limit(500).all()
-        explosivos = Explosivo.query.order_by(Explosivo.codigo).all()
+        explosivos = obtener_explosivos_por_codigo()
         
         return render_template('editar_salidas.html', 
                              salidas=salidas, 
@@ -3206,9 +4421,11 @@ def editar_salida(salida_id):
     
     try:
         salida = Salida.query.get_or_404(salida_id)
-        explosivos = Explosivo.query.order_by(Explosivo.codigo).all()
+        explosivos = obtener_explosivos_por_codigo()
         
         if request.method == 'POST':
+            turno_original = (salida.fecha_salida, salida.guardia)
+
             # Crear backup antes de editar
             backup_data = {
                 'id': salida.id,
@@ -3233,7 +4450,12 @@ def editar_salida(salida_id):
             salida.responsable = request.form.get('responsable', '').strip()
             salida.observaciones = f"EDITADO: {datetime.now().strftime('%Y-%m-%d %H:%M')} por {session.get('username', 'admin')}. " + \
                                  f"Original: {backup_data['cantidad_original']} KG, {backup_data['fecha_salida_original']}, {backup_data['labor_original']}"
-            
+
+            # Revertir el movimiento original y aplicar el editado en stock_saldos
+            registrar_edicion_stock('salidas', backup_data['explosivo_id_original'], backup_data['cantidad_original'],
+                                    salida.explosivo_id, salida.cantidad,
+                                    turno_original, (salida.fecha_salida, salida.guardia))
+
             db.session.commit()
             
             flash(f'Salida editada exitosamente. ID: {salida_id}', 'success')
@@ -3275,7 +4497,7 @@ def listar_ingresos_edicion():
             query = query.filter(Ingreso.explosivo_id == int(explosivo_id))
         
         ingresos = query.order_by(Ingreso.fecha_ingreso.desc()).limit(500).all()
-        explosivos = Explosivo.query.order_by(Explosivo.codigo).all()
+        explosivos = obtener_explosivos_por_codigo()
         
         return render_template('editar_ingresos.html', 
                              ingresos=ingresos, 
@@ -3299,9 +4521,13 @@ def editar_ingreso(ingreso_id):
     
     try:
         ingreso = Ingreso.query.get_or_404(ingreso_id)
-        explosivos = Explosivo.query.order_by(Explosivo.codigo).all()
+        explosivos = obtener_explosivos_por_codigo()
         
         if request.method == 'POST':
+            explosivo_id_original = ingreso.explosivo_id
+            cantidad_original = float(ingreso.cantidad)
+            turno_original = (ingreso.fecha_ingreso, ingreso.guardia)
+
             # Aplicar cambios solo a campos que existen en la tabla ingresos
             ingreso.explosivo_id = int(request.form['explosivo_id'])
             ingreso.cantidad = float(request.form['cantidad'])
@@ -3323,7 +4549,12 @@ def editar_ingreso(ingreso_id):
                     ingreso.observaciones = f"{observaciones_form}\n{observaciones_edicion}"
                 else:
                     ingreso.observaciones = observaciones_edicion
-            
+
+            # Revertir el movimiento original y aplicar el editado en stock_saldos
+            registrar_edicion_stock('ingresos', explosivo_id_original, cantidad_original,
+                                    ingreso.explosivo_id, ingreso.cantidad,
+                                    turno_original, (ingreso.fecha_ingreso, ingreso.guardia))
+
             db.session.commit()
             
             flash(f'Ingreso editado exitosamente. ID: {ingreso_id}', 'success')
@@ -3365,7 +4596,7 @@ def listar_devoluciones_edicion():
             query = query.filter(Devolucion.explosivo_id == int(explosivo_id))
         
         devoluciones = query.order_by(Devolucion.fecha_devolucion.desc()).limit(500).all()
-        explosivos = Explosivo.query.order_by(Explosivo.codigo).all()
+        explosivos = obtener_explosivos_por_codigo()
         
         return render_template('editar_devoluciones.html', 
                              devoluciones=devoluciones, 
@@ -3389,9 +4620,13 @@ def editar_devolucion(devolucion_id):
     
     try:
         devolucion = Devolucion.query.get_or_404(devolucion_id)
-        explosivos = Explosivo.query.order_by(Explosivo.codigo).all()
+        explosivos = obtener_explosivos_por_codigo()
         
         if request.method == 'POST':
+            explosivo_id_original = devolucion.explosivo_id
+            cantidad_original = float(devolucion.cantidad_devuelta)
+            turno_original = (devolucion.fecha_devolucion, devolucion.guardia)
+
             # Aplicar cambios
             devolucion.explosivo_id = int(request.form['explosivo_id'])
             devolucion.cantidad_devuelta = float(request.form['cantidad_devuelta'])
@@ -3402,7 +4637,12 @@ def editar_devolucion(devolucion_id):
             devolucion.recibido_por = request.form.get('recibido_por', '').strip()
             devolucion.estado_material = request.form.get('estado_material', 'bueno')
             devolucion.observaciones = request.form.get('observaciones', '').strip()
-            
+
+            # Revertir el movimiento original y aplicar el editado en stock_saldos
+            registrar_edicion_stock('devoluciones', explosivo_id_original, cantidad_original,
+                                    devolucion.explosivo_id, devolucion.cantidad_devuelta,
+                                    turno_original, (devolucion.fecha_devolucion, devolucion.guardia))
+
             db.session.commit()
             
             flash(f'Devolución editada exitosamente. ID: {devolucion_id}', 'success')
@@ -3444,6 +4684,8 @@ def eliminar_salida(salida_id):
         
         # ELIMINAR FÍSICAMENTE el registro de la base de datos
         db.session.delete(salida)
+        registrar_delta_stock(backup_info['explosivo_id'], salidas=-float(backup_info['cantidad']),
+                              fecha=salida.fecha_salida, guardia=salida.guardia)
         db.session.commit()
         
         return jsonify({'success': True, 'message': f'Salida {salida_id} eliminada exitosamente de la base de datos'})
@@ -3481,6 +4723,8 @@ def eliminar_ingreso(ingreso_id):
         
         # ELIMINAR FÍSICAMENTE el registro de la base de datos
         db.session.delete(ingreso)
+        registrar_delta_stock(backup_info['explosivo_id'], ingresos=-float(backup_info['cantidad']),
+                              fecha=ingreso.fecha_ingreso, guardia=ingreso.guardia)
         db.session.commit()
         
         return jsonify({'success': True, 'message': f'Ingreso {ingreso_id} eliminado exitosamente de la base de datos'})
@@ -3520,6 +4764,9 @@ def eliminar_devolucion(devolucion_id):
         
         # ELIMINAR FÍSICAMENTE el registro de la base de datos
         db.session.delete(devolucion)
+        if backup_info['explosivo_id']:
+            registrar_delta_stock(backup_info['explosivo_id'], devoluciones=-float(backup_info['cantidad_devuelta']),
+                                  fecha=devolucion.fecha_devolucion, guardia=devolucion.guardia)
         db.session.commit()
         
         return jsonify({'success': True, 'message': f'Devolución {devolucion_id} eliminada exitosamente de la base de datos'})
@@ -3554,14 +4801,21 @@ def limpiar_registros_eliminados():
         for salida in salidas_eliminadas:
             print(f"Eliminando salida ID {salida.id}: {salida.cantidad} KG, {salida.labor}")
             db.session.delete(salida)
+            registrar_delta_stock(salida.explosivo_id, salidas=-float(salida.cantidad),
+                                  fecha=salida.fecha_salida, guardia=salida.guardia)
             
         for ingreso in ingresos_eliminados:
             print(f"Eliminando ingreso ID {ingreso.id}: {ingreso.cantidad} KG")
             db.session.delete(ingreso)
+            registrar_delta_stock(ingreso.explosivo_id, ingresos=-float(ingreso.cantidad),
+                                  fecha=ingreso.fecha_ingreso, guardia=ingreso.guardia)
             
         for devolucion in devoluciones_eliminadas:
             print(f"Eliminando devolución ID {devolucion.id}: {devolucion.cantidad_devuelta} KG")
             db.session.delete(devolucion)
+            if devolucion.explosivo_id:
+                registrar_delta_stock(devolucion.explosivo_id, devoluciones=-float(devolucion.cantidad_devuelta),
+                                      fecha=devolucion.fecha_devolucion, guardia=devolucion.guardia)
         
         db.session.commit()
         
@@ -3580,6 +4834,87 @@ def limpiar_registros_eliminados():
         print(f"Error limpiando registros eliminados: {e}")
         return jsonify({'error': 'Error limpiando registros eliminados'}), 500
 
+@app.route('/admin/sincronizacion')
+@require_login
+def estado_sincronizacion():
+    """Estado de la cola de sincronización de stock_diario (profundidad y lag)"""
+    if not es_admin():
+        return jsonify({'error': 'Acceso denegado'}), 403
+    
+    return jsonify(dict(
+        estado_cola_sincronizacion(),
+        difusion_stock=dict(hub_stock.estado(), sondeo=sondeo_saldos.estado()),
+        preinicializacion_turnos=preinicializador_turnos.estado()
+    ))
+
+@app.route('/admin/capacidades')
+@require_login
+def diagnostico_capacidades():
+    """Diagnóstico: capacidades del esquema y estrategia de stock en uso"""
+    if not es_admin():
+        return jsonify({'error': 'Acceso denegado'}), 403
+    
+    capacidades = obtener_capacidades()
+    edad = time.time() - _capacidades_esquema['detectado'] if _capacidades_esquema['datos'] else None
+    
+    return jsonify({
+        'capacidades': capacidades,
+        'ttl_segundos': CAPACIDADES_TTL,
+        'edad_segundos': round(edad, 1) if edad is not None else None
+    })
+
+@app.route('/admin/capacidades/refrescar', methods=['POST'])
+@require_login
+def refrescar_capacidades():
+    """Forzar una nueva detección de capacidades del esquema"""
+    if not es_admin():
+        return jsonify({'error': 'Acceso denegado'}), 403
+    
+    capacidades = obtener_capacidades(forzar=True)
+    return jsonify({'success': True, 'capacidades': capacidades})
+
+@app.route('/admin/catalogo/refrescar', methods=['POST'])
+@require_login
+def refrescar_catalogo():
+    """Recargar el catálogo de explosivos (p. ej. tras editarlo directamente en la base)"""
+    if not es_admin():
+        return jsonify({'error': 'Acceso denegado'}), 403
+    
+    catalogo = obtener_catalogo_explosivos(forzar=True)
+    return jsonify({'success': True, 'catalogo': catalogo.estado()})
+
+@app.route('/admin/metrics')
+@require_login
+def admin_metricas():
+    """Métricas por endpoint: percentiles de duración, consultas SQL, tiempo de BD y estrategias"""
+    if not es_admin():
+        if request.args.get('format') == 'json':
+            return jsonify({'error': 'Acceso denegado'}), 403
+        flash('Solo los administradores pueden ver las métricas', 'error')
+        return redirect(url_for('index'))
+    
+    metricas = obtener_metricas()
+    
+    if request.args.get('format') == 'json':
+        return jsonify({
+            'generado_en': datetime.now().isoformat(timespec='seconds'),
+            'ventana': VENTANA_PETICIONES,
+            'endpoints': metricas,
+            'idempotencia': almacen_idempotencia.estado()
+        })
+    
+    return render_template('admin_metricas.html', metricas=metricas, ventana=VENTANA_PETICIONES)
+
+@app.route('/admin/metrics/reiniciar', methods=['POST'])
+@require_login
+def reiniciar_admin_metricas():
+    """Vaciar las ventanas de métricas (p. ej. antes de medir un cambio)"""
+    if not es_admin():
+        return jsonify({'error': 'Acceso denegado'}), 403
+    
+    reiniciar_metricas()
+    return jsonify({'success': True, 'mensaje': 'Métricas reiniciadas'})
+
 @app.route('/api/estadisticas-edicion')
 @require_login
 def estadisticas_edicion():
@@ -3635,38 +4970,82 @@ def gestionar_labores():
         flash('Error cargando las labores', 'danger')
         return redirect(url_for('index'))
 
+# =====================================================
+# ÍNDICES DE AUTOCOMPLETADO (LABORES Y TIPOS DE ACTIVIDAD)
+# =====================================================
+
+# Los índices viven en memoria del proceso: se cargan al inicio (o en el primer uso),
+# se invalidan al modificar el catálogo y se recargan tras INDICE_BUSQUEDA_TTL segundos
+# para refrescar las frecuencias de uso (y cambios hechos desde otros procesos).
+INDICE_BUSQUEDA_TTL = int(os.environ.get('INDICE_BUSQUEDA_TTL', 900))
+USO_RECIENTE_DIAS = 90
+
+indice_labores = IndiceBusqueda('labores')
+indice_tipos_actividad = IndiceBusqueda('tipos_actividad')
+_indices_lock = threading.Lock()
+
+def cargar_indice_busqueda(indice, modelo, columna_uso):
+    """Cargar catálogo y frecuencias de uso recientes (columna de salidas) en el índice"""
+    registros = []
+    for item in modelo.query.all():
+        registros.append({
+            'id': item.id,
+            'nombre': item.nombre,
+            'descripcion': item.descripcion or '',
+            'fecha_creacion': item.fecha_creacion.strftime('%Y-%m-%d %H:%M') if item.fecha_creacion else ''
+        })
+
+    usos = db.session.execute(text(f"""
+        SELECT {columna_uso} as nombre, COUNT(*) as usos
+        FROM salidas
+        WHERE fecha_salida >= :desde
+        AND {columna_uso} IS NOT NULL
+        GROUP BY {columna_uso}
+    """), {'desde': datetime.now() - timedelta(days=USO_RECIENTE_DIAS)}).fetchall()
+
+    indice.cargar(registros, {row.nombre: row.usos for row in usos}, cargado_en=time.time())
+    print(f"🔎 Índice de {indice.nombre} cargado: {len(registros)} registros")
+
+def obtener_indice_busqueda(indice, modelo, columna_uso):
+    """Índice listo para buscar; se (re)carga si fue invalidado o venció el TTL"""
+    vencido = indice.cargado_en is None or time.time() - indice.cargado_en >= INDICE_BUSQUEDA_TTL
+    if indice.cargado and not vencido:
+        return indice
+
+    with _indices_lock:
+        vencido = indice.cargado_en is None or time.time() - indice.cargado_en >= INDICE_BUSQUEDA_TTL
+        if indice.cargado and not vencido:
+            return indice
+
+        try:
+            cargar_indice_busqueda(indice, modelo, columna_uso)
+        except Exception as e:
+            db.session.rollback()
+            if not indice.cargado:
+                raise
+            # Conservar el índice anterior hasta el próximo intento
+            print(f"⚠️ Error recargando índice de {indice.nombre}, se mantiene el anterior: {e}")
+
+    return indice
+
+def obtener_indice_labores():
+    return obtener_indice_busqueda(indice_labores, Labor, 'labor')
+
+def obtener_indice_tipos_actividad():
+    return obtener_indice_busqueda(indice_tipos_actividad, TipoActividad, 'tipo_actividad')
+
 @app.route('/api/labores')
 @require_login
+@con_version_datos
 def api_labores():
     """API para obtener labores con filtros y búsqueda"""
     try:
         # Parámetros de búsqueda
         buscar = request.args.get('buscar', '').strip()
         
-        # Query base
-        query = Labor.query
-        
-        # Aplicar filtro de búsqueda
-        if buscar:
-            query = query.filter(
-                db.or_(
-                    Labor.nombre.ilike(f'%{buscar}%'),
-                    Labor.descripcion.ilike(f'%{buscar}%')
-                )
-            )
-        
-        # Ordenar
-        labores = query.order_by(Labor.nombre).all()
-        
-        # Convertir a JSON
-        result = []
-        for labor in labores:
-            result.append({
-                'id': labor.id,
-                'nombre': labor.nombre,
-                'descripcion': labor.descripcion or '',
-                'fecha_creacion': labor.fecha_creacion.strftime('%Y-%m-%d %H:%M') if labor.fecha_creacion else ''
-            })
+        # Búsqueda en el índice en memoria (sin consultar la base de datos)
+        indice = obtener_indice_labores()
+        result = indice.buscar(buscar, limite=None) if buscar else indice.todos()
         
         return jsonify({
             'success': True,
@@ -3685,25 +5064,16 @@ def buscar_labores():
     try:
         termino = request.args.get('q', '').strip()
         
-        if len(termino) < 1:
-            # Si no hay término, devolver todas las labores
-            labores = Labor.query.order_by(Labor.nombre).limit(10).all()
-        else:
-            # Buscar labores que coincidan
-            labores = Labor.query.filter(
-                db.or_(
-                    Labor.nombre.ilike(f'%{termino}%'),
-                    Labor.descripcion.ilike(f'%{termino}%')
-                )
-            ).order_by(Labor.nombre).limit(10).all()
+        # Sin término: las labores más usadas; con término: coincidencias por relevancia y uso
+        labores = obtener_indice_labores().buscar(termino, limite=10)
         
         # Formato para autocomplete
         result = []
         for labor in labores:
             result.append({
-                'id': labor.id,
-                'nombre': labor.nombre,
-                'text': labor.nombre
+                'id': labor['id'],
+                'nombre': labor['nombre'],
+                'text': labor['nombre']
             })
         
         return jsonify({'labores': result})
@@ -3742,6 +5112,8 @@ def agregar_labor():
         
         db.session.add(nueva_labor)
         db.session.commit()
+        indice_labores.invalidar()
+        incrementar_version_datos()
         
         flash(f'Labor {nombre} agregada exitosamente', 'success')
         return jsonify({'success': True, 'message': 'Labor agregada exitosamente'})
@@ -3782,6 +5154,8 @@ def editar_labor(labor_id):
         labor.descripcion = descripcion
         
         db.session.commit()
+        indice_labores.invalidar()
+        incrementar_version_datos()
         
         flash(f'Labor {nombre} actualizada exitosamente', 'success')
         return jsonify({'success': True, 'message': 'Labor actualizada exitosamente'})
@@ -3805,6 +5179,8 @@ def eliminar_labor(labor_id):
         # Eliminar la labor
         db.session.delete(labor)
         db.session.commit()
+        indice_labores.invalidar()
+        incrementar_version_datos()
         
         flash(f'Labor {labor.nombre} eliminada exitosamente', 'success')
         return jsonify({'success': True, 'message': 'Labor eliminada exitosamente'})
@@ -3848,30 +5224,9 @@ def api_tipos_actividad():
         # Usar el parámetro que esté presente
         termino = buscar or q
         
-        # Query base
-        query = TipoActividad.query
-        
-        # Aplicar filtro de búsqueda
-        if termino:
-            query = query.filter(
-                db.or_(
-                    TipoActividad.nombre.ilike(f'%{termino}%'),
-                    TipoActividad.descripcion.ilike(f'%{termino}%')
-                )
-            )
-        
-        # Ordenar
-        tipos_actividad = query.order_by(TipoActividad.nombre).all()
-        
-        # Convertir a JSON
-        result = []
-        for tipo in tipos_actividad:
-            result.append({
-                'id': tipo.id,
-                'nombre': tipo.nombre,
-                'descripcion': tipo.descripcion or '',
-                'fecha_creacion': tipo.fecha_creacion.strftime('%Y-%m-%d %H:%M') if tipo.fecha_creacion else ''
-            })
+        # Búsqueda en el índice en memoria (sin consultar la base de datos)
+        indice = obtener_indice_tipos_actividad()
+        result = indice.buscar(termino, limite=None) if termino else indice.todos()
         
         return jsonify({
             'success': True,
@@ -3890,25 +5245,20 @@ def buscar_tipos_actividad():
     try:
         termino = request.args.get('q', '').strip()
         
+        indice = obtener_indice_tipos_actividad()
         if len(termino) < 2:
-            # Si no hay término, devolver todos los tipos
-            tipos_actividad = TipoActividad.query.order_by(TipoActividad.nombre).limit(10).all()
+            # Sin término suficiente: los tipos más usados
+            tipos_actividad = indice.mas_usados(10)
         else:
-            # Buscar tipos que coincidan
-            tipos_actividad = TipoActividad.query.filter(
-                db.or_(
-                    TipoActividad.nombre.ilike(f'%{termino}%'),
-                    TipoActividad.descripcion.ilike(f'%{termino}%')
-                )
-            ).order_by(TipoActividad.nombre).limit(10).all()
+            tipos_actividad = indice.buscar(termino, limite=10)
         
         # Formato para autocomplete
         result = []
         for tipo in tipos_actividad:
             result.append({
-                'id': tipo.id,
-                'nombre': tipo.nombre,
-                'text': tipo.nombre
+                'id': tipo['id'],
+                'nombre': tipo['nombre'],
+                'text': tipo['nombre']
             })
         
         return jsonify({'tipos_actividad': result})
@@ -3947,6 +5297,7 @@ def agregar_tipo_actividad():
         
         db.session.add(nuevo_tipo)
         db.session.commit()
+        indice_tipos_actividad.invalidar()
         
         flash(f'Tipo de actividad {nombre} agregado exitosamente', 'success')
         return jsonify({'success': True, 'message': 'Tipo de actividad agregado exitosamente'})
@@ -3987,6 +5338,7 @@ def editar_tipo_actividad(tipo_id):
         tipo.descripcion = descripcion
         
         db.session.commit()
+        indice_tipos_actividad.invalidar()
         
         flash(f'Tipo de actividad {nombre} actualizado exitosamente', 'success')
         return jsonify({'success': True, 'message': 'Tipo de actividad actualizado exitosamente'})
@@ -4015,6 +5367,7 @@ def eliminar_tipo_actividad(tipo_id):
         # Eliminar el tipo de actividad
         db.session.delete(tipo)
         db.session.commit()
+        indice_tipos_actividad.invalidar()
         
         flash(f'Tipo de actividad {tipo.nombre} eliminado exitosamente', 'success')
         return jsonify({'success': True, 'message': 'Tipo de actividad eliminado exitosamente'})
@@ -4136,6 +5489,14 @@ if __name__ == '__main__':
         # db.create_all()
         # Crear usuario administrador inicial
         crear_usuario_admin_inicial()
+        # Detectar tablas/vistas de stock disponibles antes de atender peticiones
+        obtener_capacidades(forzar=True)
+        # Cargar índices de autocompletado
+        try:
+            obtener_indice_labores()
+            obtener_indice_tipos_actividad()
+        except Exception as e:
+            print(f"⚠️ Índices de autocompletado se cargarán en el primer uso: {e}")
     
     # Configuración flexible para desarrollo/producción
     debug_mode = os.environ.get('FLASK_DEBUG', 'True').lower() == 'true'
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark reproducible de las rutas críticas sobre una base local con datos sintéticos
+Levanta app.py contra DATABASE_URL (por defecto un archivo SQLite temporal), la
+puebla con datos_sinteticos.py y mide las rutas clave con el cliente de pruebas
+de Flask. Los resultados se guardan en JSON para comparar entre commits.
+
+Uso:
+    python benchmarks/benchmark_rutas.py --explosivos 40 --anios 1 --repeticiones 5
+    python benchmarks/benchmark_rutas.py --comparar resultados/base.json resultados/nuevo.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+DIRECTORIO_RESULTADOS = os.path.join(DIRECTORIO, 'resultados')
+
+# Umbral para marcar una regresión al comparar dos ejecuciones
+UMBRAL_REGRESION = 1.20
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    if not ordenados:
+        return 0
+    indice = max(0, min(len(ordenados) - 1, int(round(p / 100.0 * len(ordenados) + 0.5)) - 1))
+    return ordenados[indice]
+
+def error_corto(error, largo=160):
+    return ' '.join(str(error).split())[:largo] if error else None
+
+def resumir(tiempos, extra=None):
+    resumen = {
+        'repeticiones': len(tiempos),
+        'min_ms': round(min(tiempos) * 1000, 2),
+        'p50_ms': round(percentil(tiempos, 50) * 1000, 2),
+        'p90_ms': round(percentil(tiempos, 90) * 1000, 2),
+        'max_ms': round(max(tiempos) * 1000, 2),
+        'promedio_ms': round(sum(tiempos) / len(tiempos) * 1000, 2)
+    }
+    resumen.update(extra or {})
+    return resumen
+
+def commit_actual():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=DIRECTORIO,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def medir_ruta(cliente, metodo, url, repeticiones, datos=None):
+    """Medir una ruta: tiempos, códigos HTTP y consultas SQL (desde Server-Timing)"""
+    tiempos, estados, consultas, tiempos_db = [], {}, [], []
+
+    # Una ejecución de calentamiento (cachés de capacidades, índices, plantillas)
+    getattr(cliente, metodo)(url, data=datos() if datos else None).close()
+
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        respuesta = getattr(cliente, metodo)(url, data=datos() if datos else None)
+        respuesta.get_data()
+        tiempos.append(time.perf_counter() - inicio)
+        respuesta.close()
+
+        estados[str(respuesta.status_code)] = estados.get(str(respuesta.status_code), 0) + 1
+        server_timing = respuesta.headers.get('Server-Timing', '')
+        coincidencia = re.search(r'db;dur=([\d.]+);desc="(\d+) consultas"', server_timing)
+        if coincidencia:
+            tiempos_db.append(float(coincidencia.group(1)))
+            consultas.append(int(coincidencia.group(2)))
+
+    # Una ruta que responde 5xx mide un error, no la ruta: se marca y no se compara
+    errores = sorted(estado for estado in estados if estado.startswith('5'))
+    return resumir(tiempos, {
+        'metodo': metodo.upper(),
+        'url': url,
+        'estados': estados,
+        'error': f"HTTP {', '.join(errores)}" if errores else None,
+        'consultas_p50': percentil(consultas, 50) if consultas else None,
+        'tiempo_db_p50_ms': round(percentil(tiempos_db, 50), 2) if tiempos_db else None
+    })
+
+def ejecutar_benchmark(args):
+    if not os.environ.get('DATABASE_URL'):
+        archivo = os.path.join(tempfile.gettempdir(), 'polvorin_benchmark.db')
+        os.environ['DATABASE_URL'] = f'sqlite:///{archivo}'
+    # Sincronización en línea: sin hilo de fondo compitiendo con las mediciones
+    os.environ.setdefault('SINCRONIZACION_ASINCRONA', 'false')
+
+    sys.path.insert(0, os.path.dirname(DIRECTORIO))
+    from datos_sinteticos import generar_datos, USUARIO_BENCHMARK
+    from app import app, db, Usuario, obtener_capacidades, calcular_matriz_labores
+    from recalcular_stock_automatico import recalcular_stock_diario_completo, recalcular_stock_acumulado
+
+    print(f"🗄️ Base de benchmark: {os.environ['DATABASE_URL']}")
+    inicio = time.perf_counter()
+    datos = generar_datos(args.explosivos, args.labores, args.anios, args.semilla,
+                          permitir_destruir=args.permitir_destruir)
+    segundos_carga = round(time.perf_counter() - inicio, 2)
+
+    with app.app_context():
+        usuario_id = Usuario.query.filter_by(username=USUARIO_BENCHMARK).first().id
+        capacidades = obtener_capacidades(forzar=True)
+
+    cliente = app.test_client()
+    with cliente.session_transaction() as sesion:
+        sesion['user_id'] = usuario_id
+        sesion['username'] = USUARIO_BENCHMARK
+        sesion['nombre_completo'] = 'Benchmark'
+        sesion['cargo'] = 'administrador'
+
+    hoy = date.today()
+    mes_desde = (hoy - timedelta(days=30)).isoformat()
+
+    # Las exportaciones sin columnas de labores medirían un camino que devuelve ceros
+    with app.app_context():
+        matriz_mes = calcular_matriz_labores(hoy - timedelta(days=30), hoy)
+    error_labores = None if matriz_mes['celdas'] else 'calcular_matriz_labores sin consumo por labor en el último mes'
+    ids_masivo = ','.join(str(i) for i in range(1, min(args.explosivos, 20) + 1))
+
+    def datos_salida():
+        return {
+            'turno': 'DIA',
+            'fecha_salida': hoy.isoformat(),
+            'labor': 'M-100',
+            'tipo_actividad': 'AVANCE',
+            'responsable': 'Trabajador benchmark',
+            'observaciones': '',
+            'explosivos': json.dumps([{'explosivo_id': i, 'cantidad': 1} for i in range(1, 4)])
+        }
+
+    rutas = {
+        'salidas_nueva_post': ('post', '/salidas/nueva', datos_salida),
+        'api_stock_masivo': ('get', '/api/stock-masivo', None),
+        'api_stock_masivo_ids': ('get', f'/api/stock-masivo?ids={ids_masivo}', None),
+        'stock_diario': ('get', f'/stock-diario?fecha={hoy.isoformat()}', None),
+        'api_stock_diario_excel_dia': ('get', f'/api/stock-diario-excel?fecha={hoy.isoformat()}&formato=csv', None),
+        'api_stock_diario_excel_mes': ('get', f'/api/stock-diario-excel?fecha_desde={mes_desde}&fecha_hasta={hoy.isoformat()}&formato=xlsx', None),
+    }
+
+    resultados = {}
+    for nombre, (metodo, url, generador) in rutas.items():
+        print(f"⏱️ {nombre}: {metodo.upper()} {url}")
+        resultados[nombre] = medir_ruta(cliente, metodo, url, args.repeticiones, generador)
+        if nombre.startswith('api_stock_diario_excel') and error_labores:
+            resultados[nombre]['error'] = error_labores
+        print(f"   p50 {resultados[nombre]['p50_ms']} ms | estados {resultados[nombre]['estados']}")
+
+    # Recálculos completos: funciones de mantenimiento, no rutas (se miden una sola vez).
+    # Cada una informa cuántos turnos recorrió: cero con datos generados es un camino roto
+    for nombre, funcion, turnos in (
+            ('recalcular_stock_diario_completo', recalcular_stock_diario_completo, lambda procesados: procesados),
+            ('recalcular_stock_acumulado', recalcular_stock_acumulado, lambda resumen: resumen['turnos'])):
+        print(f"⏱️ {nombre}")
+        inicio = time.perf_counter()
+        error = None
+        try:
+            if not turnos(funcion()):
+                error = 'no recorrió ningún turno'
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        if error:
+            # Sin tiempos: una ejecución que falla no es una medición
+            resultados[nombre] = {'repeticiones': 0, 'error': error}
+            print(f"   ❌ falló, excluido de la comparación: {error_corto(error)}")
+        else:
+            resultados[nombre] = resumir([time.perf_counter() - inicio], {'error': None})
+
+    return {
+        'generado_en': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit_actual(),
+        'python': platform.python_version(),
+        'dialecto': os.environ['DATABASE_URL'].split(':', 1)[0],
+        'parametros': {
+            'explosivos': args.explosivos,
+            'labores': args.labores,
+            'anios': args.anios,
+            'semilla': args.semilla,
+            'repeticiones': args.repeticiones
+        },
+        'datos': datos,
+        'segundos_carga': segundos_carga,
+        'estrategia_stock': capacidades.get('estrategia_stock'),
+        'rutas': resultados
+    }
+
+def comparar(base, nuevo):
+    """Imprimir la variación de p50 por ruta entre dos archivos de resultados"""
+    with open(base, encoding='utf-8') as archivo:
+        datos_base = json.load(archivo)
+    with open(nuevo, encoding='utf-8') as archivo:
+        datos_nuevo = json.load(archivo)
+
+    print(f"📊 {datos_base.get('commit')} → {datos_nuevo.get('commit')}")
+    regresiones = 0
+    for nombre, resultado in datos_nuevo['rutas'].items():
+        anterior = datos_base['rutas'].get(nombre)
+        if resultado.get('error') or (anterior and anterior.get('error')):
+            # No se comparan tiempos de ejecuciones fallidas; fallar donde antes no fallaba es regresión
+            nuevo_error = bool(resultado.get('error')) and not (anterior and anterior.get('error'))
+            regresiones += nuevo_error
+            print(f"   ⚠️ {nombre}: excluida (error antes: {error_corto((anterior or {}).get('error'))}, "
+                  f"ahora: {error_corto(resultado.get('error'))})")
+            continue
+        if not anterior:
+            print(f"   {nombre}: {resultado['p50_ms']} ms (nueva)")
+            continue
+        factor = resultado['p50_ms'] / anterior['p50_ms'] if anterior['p50_ms'] else 1
+        marca = '❌' if factor > UMBRAL_REGRESION else '✅'
+        regresiones += factor > UMBRAL_REGRESION
+        print(f"   {marca} {nombre}: {anterior['p50_ms']} → {resultado['p50_ms']} ms (x{factor:.2f})")
+    return 1 if regresiones else 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de rutas del polvorín con datos sintéticos')
+    parser.add_argument('--explosivos', type=int, default=40)
+    parser.add_argument('--labores', type=int, default=60)
+    parser.add_argument('--anios', type=float, default=1)
+    parser.add_argument('--semilla', type=int, default=2025)
+    parser.add_argument('--repeticiones', type=int, default=5)
+    parser.add_argument('--permitir-destruir', action='store_true',
+                        help='Permitir borrar el esquema de una DATABASE_URL que no es SQLite')
+    parser.add_argument('--salida', help='Archivo JSON de resultados (por defecto benchmarks/resultados/<fecha>_<commit>.json)')
+    parser.add_argument('--comparar', nargs=2, metavar=('BASE', 'NUEVO'), help='Comparar dos archivos de resultados')
+    args = parser.parse_args()
+
+    if args.comparar:
+        return comparar(*args.comparar)
+
+    try:
+        resultado = ejecutar_benchmark(args)
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        return 1
+
+    salida = args.salida
+    if not salida:
+        os.makedirs(DIRECTORIO_RESULTADOS, exist_ok=True)
+        salida = os.path.join(DIRECTORIO_RESULTADOS,
+                              f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{resultado['commit'] or 'local'}.json")
+    with open(salida, 'w', encoding='utf-8') as archivo:
+        json.dump(resultado, archivo, indent=2, ensure_ascii=False)
+
+    print(f"\n💾 Resultados guardados en {salida}")
+    fallidas = sorted(nombre for nombre, datos in resultado['rutas'].items() if datos.get('error'))
+    if fallidas:
+        print(f"⚠️ Sin medición válida (error): {', '.join(fallidas)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
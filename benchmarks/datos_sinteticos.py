@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Generador de datos sintéticos de mina para benchmarks locales
+Crea el esquema con los modelos de app.py y lo puebla con N explosivos, M labores
+y Y años de movimientos por guardia (ingresos, salidas y devoluciones) en
+proporciones parecidas a las del polvorín real. Rellena también stock_saldos,
+stock_movimientos_turno y stock_diario para que las rutas usen sus caminos rápidos.
+
+Uso (la base se toma de DATABASE_URL; fuera de SQLite exige --permitir-destruir):
+    DATABASE_URL=sqlite:///benchmark.db python benchmarks/datos_sinteticos.py --explosivos 40 --labores 60 --anios 1
+"""
+
+import argparse
+import os
+import random
+import sys
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import insert, text
+
+from app import (app, db, Explosivo, Labor, TipoActividad, Usuario, Ingreso, Salida, Devolucion,
+                 StockDiario, StockSaldo, StockMovimientoTurno, obtener_hora_estandar_turno)
+
+GRUPOS = ('EXPLOSIVOS', 'ACCESORIOS', 'EMULSIONES', 'CORDONES')
+TIPOS_ACTIVIDAD = ('AVANCE', 'PRODUCCION', 'DESQUINCHE', 'SOSTENIMIENTO', 'CHIMENEA', 'SUBNIVEL')
+PREFIJOS_LABOR = ('M', 'P', 'N', 'CH', 'SN', 'TJ')
+GUARDIAS = ('dia', 'noche')
+
+USUARIO_BENCHMARK = 'benchmark_admin'
+
+# Proporciones por guardia y explosivo (aprox. las del polvorín real)
+PROB_SALIDA = 0.35        # probabilidad de que un explosivo tenga salidas en una guardia
+SALIDAS_POR_TURNO = (1, 3)
+PROB_DEVOLUCION = 0.15    # fracción de salidas con devolución parcial
+DIAS_ENTRE_INGRESOS = 7
+LOTE_INSERCION = 5000
+
+# Vistas de stock que usan las rutas, en SQL portable (las originales son T-SQL:
+# crear_vista_simple.py y database_scripts/crear_vista_stock_actual.sql)
+VISTAS_PORTABLES = {
+    'v_stock_actual': """
+        CREATE VIEW v_stock_actual AS
+        SELECT e.id, e.codigo, e.descripcion, e.unidad,
+               CASE WHEN COALESCE(ss.stock_actual, 0) < 0 THEN 0 ELSE CAST(COALESCE(ss.stock_actual, 0) AS INT) END AS stock_actual,
+               e.grupo, CURRENT_TIMESTAMP AS fecha_calculo
+        FROM explosivos e
+        LEFT JOIN stock_saldos ss ON ss.explosivo_id = e.id
+    """,
+    'vw_stock_diario_simple': """
+        CREATE VIEW vw_stock_diario_simple AS
+        SELECT sd.explosivo_id, e.codigo, e.descripcion, e.unidad, sd.fecha, sd.guardia,
+               sd.stock_inicial, sd.stock_final,
+               COALESCE(mt.ingresos, 0.0) AS ingresos,
+               COALESCE(mt.salidas, 0.0) AS salidas,
+               COALESCE(mt.devoluciones, 0.0) AS devoluciones,
+               sd.responsable_guardia, sd.observaciones,
+               (sd.stock_inicial + COALESCE(mt.ingresos, 0) + COALESCE(mt.devoluciones, 0) - COALESCE(mt.salidas, 0)) AS stock_final_calculado,
+               CASE
+                   WHEN ABS(sd.stock_final - (sd.stock_inicial + COALESCE(mt.ingresos, 0) + COALESCE(mt.devoluciones, 0) - COALESCE(mt.salidas, 0))) <= 0.01
+                   THEN 'OK' ELSE 'INCONSISTENTE'
+               END AS estado_consistencia
+        FROM stock_diario sd
+        JOIN explosivos e ON sd.explosivo_id = e.id
+        LEFT JOIN stock_movimientos_turno mt
+            ON mt.explosivo_id = sd.explosivo_id AND mt.fecha = sd.fecha AND mt.guardia = sd.guardia
+    """
+}
+
+def crear_vistas_portables():
+    for sql in VISTAS_PORTABLES.values():
+        db.session.execute(text(sql))
+
+def _insertar_en_lotes(modelo, filas):
+    for i in range(0, len(filas), LOTE_INSERCION):
+        db.session.execute(insert(modelo), filas[i:i + LOTE_INSERCION])
+
+def generar_datos(explosivos=40, labores=60, anios=1, semilla=2025, fecha_fin=None, permitir_destruir=False):
+    """Borrar y recrear el esquema, y poblarlo con datos sintéticos reproducibles.
+
+    Solo borra bases SQLite; cualquier otro motor exige permitir_destruir=True.
+    """
+    azar = random.Random(semilla)
+    fecha_fin = fecha_fin or date.today()
+    fecha_inicio = fecha_fin - timedelta(days=int(365 * anios) - 1)
+
+    with app.app_context():
+        if db.engine.dialect.name != 'sqlite' and not permitir_destruir:
+            raise RuntimeError(
+                f"{db.engine.url.render_as_string(hide_password=True)} no es SQLite: generar_datos borra "
+                "el esquema completo. Use --permitir-destruir solo con una base desechable"
+            )
+
+        for nombre in VISTAS_PORTABLES:
+            db.session.execute(text(f"DROP VIEW IF EXISTS {nombre}"))
+        db.session.commit()
+        db.drop_all()
+        db.create_all()
+        crear_vistas_portables()
+
+        # Catálogos
+        db.session.execute(insert(Explosivo), [{
+            'id': i,
+            'codigo': f'EXP-{i:04d}',
+            'descripcion': f'EXPLOSIVO SINTETICO {i:04d}',
+            'unidad': azar.choice(('UND', 'KG', 'MTS')),
+            'grupo': GRUPOS[i % len(GRUPOS)]
+        } for i in range(1, explosivos + 1)])
+
+        nombres_labores = [f'{azar.choice(PREFIJOS_LABOR)}-{100 + i}' for i in range(labores)]
+        db.session.execute(insert(Labor), [{
+            'nombre': nombre, 'descripcion': f'Labor sintética {nombre}', 'fecha_creacion': datetime.now()
+        } for nombre in nombres_labores])
+        db.session.execute(insert(TipoActividad), [{
+            'nombre': nombre, 'descripcion': '', 'fecha_creacion': datetime.now()
+        } for nombre in TIPOS_ACTIVIDAD])
+
+        admin = Usuario(username=USUARIO_BENCHMARK, nombre_completo='Benchmark', cargo='administrador', nivel=4)
+        admin.set_password('benchmark')
+        db.session.add(admin)
+
+        ingresos, salidas, devoluciones = [], [], []
+        turnos = {}       # (explosivo_id, fecha, guardia) -> [ingresos, salidas, devoluciones]
+        saldos = {i: [0, 0, 0] for i in range(1, explosivos + 1)}
+        stock = {i: 0 for i in range(1, explosivos + 1)}
+        stock_diario = []
+        salida_id = 0
+
+        fecha = fecha_inicio
+        while fecha <= fecha_fin:
+            for guardia in GUARDIAS:
+                momento = obtener_hora_estandar_turno(guardia, fecha)
+                for explosivo_id in range(1, explosivos + 1):
+                    stock_inicial = stock[explosivo_id]
+                    movimiento = turnos.setdefault((explosivo_id, fecha, guardia), [0, 0, 0])
+
+                    if guardia == 'dia' and (fecha - fecha_inicio).days % DIAS_ENTRE_INGRESOS == explosivo_id % DIAS_ENTRE_INGRESOS:
+                        cantidad = azar.randint(200, 800)
+                        ingresos.append({
+                            'explosivo_id': explosivo_id, 'numero_vale': f'V-{len(ingresos) + 1:06d}',
+                            'cantidad': cantidad, 'fecha_ingreso': momento, 'guardia': guardia,
+                            'recibido_por': 'Polvorín', 'observaciones': None
+                        })
+                        movimiento[0] += cantidad
+
+                    if azar.random() < PROB_SALIDA:
+                        for _ in range(azar.randint(*SALIDAS_POR_TURNO)):
+                            disponible = stock_inicial + movimiento[0] - movimiento[1] + movimiento[2]
+                            if disponible <= 0:
+                                break
+                            cantidad = min(disponible, azar.randint(5, 60))
+                            labor = azar.choice(nombres_labores)
+                            salida_id += 1
+                            salidas.append({
+                                'id': salida_id, 'explosivo_id': explosivo_id, 'labor': labor,
+                                'tipo_actividad': azar.choice(TIPOS_ACTIVIDAD), 'cantidad': cantidad,
+                                'fecha_salida': momento, 'guardia': guardia, 'responsable': 'Trabajador',
+                                'autorizado_por': 'Benchmark', 'observaciones': None, 'estado': 'activo'
+                            })
+                            movimiento[1] += cantidad
+
+                            if azar.random() < PROB_DEVOLUCION:
+                                devuelto = max(1, cantidad // azar.randint(3, 6))
+                                devoluciones.append({
+                                    'salida_id': salida_id, 'explosivo_id': explosivo_id,
+                                    'cantidad_devuelta': devuelto, 'motivo': 'Sobrante de voladura',
+                                    'fecha_devolucion': momento, 'guardia': guardia, 'responsable': 'Trabajador',
+                                    'recibido_por': 'Polvorín', 'labor': labor, 'estado_material': 'bueno',
+                                    'observaciones': None
+                                })
+                                movimiento[2] += devuelto
+
+                    stock[explosivo_id] = stock_inicial + movimiento[0] - movimiento[1] + movimiento[2]
+                    for indice in range(3):
+                        saldos[explosivo_id][indice] += movimiento[indice]
+                    stock_diario.append({
+                        'explosivo_id': explosivo_id, 'fecha': fecha, 'guardia': guardia,
+                        'stock_inicial': stock_inicial, 'stock_final': stock[explosivo_id],
+                        'responsable_guardia': 'Benchmark', 'observaciones': None,
+                        'fecha_registro': momento
+                    })
+            fecha += timedelta(days=1)
+
+        _insertar_en_lotes(Ingreso, ingresos)
+        _insertar_en_lotes(Salida, salidas)
+        _insertar_en_lotes(Devolucion, devoluciones)
+        _insertar_en_lotes(StockDiario, stock_diario)
+        _insertar_en_lotes(StockMovimientoTurno, [{
+            'explosivo_id': explosivo_id, 'fecha': fecha_turno, 'guardia': guardia,
+            'ingresos': valores[0], 'salidas': valores[1], 'devoluciones': valores[2],
+            'fecha_actualizacion': datetime.now()
+        } for (explosivo_id, fecha_turno, guardia), valores in turnos.items() if any(valores)])
+        _insertar_en_lotes(StockSaldo, [{
+            'explosivo_id': explosivo_id, 'total_ingresos': valores[0], 'total_salidas': valores[1],
+            'total_devoluciones': valores[2], 'stock_actual': valores[0] - valores[1] + valores[2],
+            'fecha_actualizacion': datetime.now()
+        } for explosivo_id, valores in saldos.items()])
+
+        db.session.commit()
+
+        resumen = {
+            'explosivos': explosivos,
+            'labores': labores,
+            'fecha_inicio': fecha_inicio.isoformat(),
+            'fecha_fin': fecha_fin.isoformat(),
+            'ingresos': len(ingresos),
+            'salidas': len(salidas),
+            'devoluciones': len(devoluciones),
+            'stock_diario': len(stock_diario)
+        }
+        print(f"✅ Datos sintéticos generados: {resumen}")
+        return resumen
+
+def main():
+    parser = argparse.ArgumentParser(description='Poblar la base de DATABASE_URL con datos sintéticos')
+    parser.add_argument('--explosivos', type=int, default=40)
+    parser.add_argument('--labores', type=int, default=60)
+    parser.add_argument('--anios', type=float, default=1)
+    parser.add_argument('--semilla', type=int, default=2025)
+    parser.add_argument('--permitir-destruir', action='store_true',
+                        help='Permitir borrar el esquema de una base que no es SQLite')
+    args = parser.parse_args()
+
+    if 'DATABASE_URL' not in os.environ:
+        print("❌ Defina DATABASE_URL (p. ej. sqlite:///benchmark.db): este script borra y recrea el esquema")
+        return 1
+
+    try:
+        generar_datos(args.explosivos, args.labores, args.anios, args.semilla,
+                      permitir_destruir=args.permitir_destruir)
+    except RuntimeError as e:
+        print(f"❌ {e}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Caché en memoria del catálogo de explosivos
+Guarda la lista ordenada (mismo orden que los formularios), los mapas id → explosivo
+y código → explosivo y los miembros de cada grupo. Cada carga calcula un checksum del
+contenido; la versión solo sube cuando el contenido cambia, así los clientes pueden
+comparar versión/checksum y evitar recargar la lista.
+"""
+
+import hashlib
+import threading
+from collections import namedtuple
+
+# Registro inmutable: se puede compartir entre peticiones sin sesión de SQLAlchemy
+ExplosivoCatalogo = namedtuple('ExplosivoCatalogo', ['id', 'codigo', 'descripcion', 'unidad', 'grupo'])
+
+def orden_catalogo(explosivo):
+    """Orden de los formularios: grupo, SUPERFAM/ANFO primero dentro de EXPLOSIVOS, luego código"""
+    grupo = explosivo.grupo or 'ZZZ'  # Si no tiene grupo, va al final
+
+    if grupo == 'EXPLOSIVOS':
+        desc_upper = (explosivo.descripcion or '').upper()
+        if 'SUPERFAM' in desc_upper or 'ANFO' in desc_upper:
+            return (grupo, '0', explosivo.codigo)
+        return (grupo, '1', explosivo.codigo)
+
+    return (grupo, '0', explosivo.codigo)
+
+def calcular_checksum(explosivos):
+    """Checksum del contenido del catálogo (independiente del orden de carga y del proceso)"""
+    digest = hashlib.sha1()
+    for explosivo in sorted(explosivos, key=lambda e: e.id):
+        digest.update(repr(tuple(explosivo)).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+class _Instantanea:
+    """Estructuras de una carga del catálogo (se reemplazan completas al recargar)"""
+
+    def __init__(self, explosivos):
+        self.ordenados = tuple(sorted(explosivos, key=orden_catalogo))
+        self.por_id = {e.id: e for e in self.ordenados}
+        self.por_codigo = {e.codigo: e for e in self.ordenados}
+        grupos = {}
+        for explosivo in self.ordenados:
+            grupos.setdefault(explosivo.grupo or 'Sin grupo', []).append(explosivo.id)
+        self.grupos = {grupo: tuple(ids) for grupo, ids in grupos.items()}
+        self.checksum = calcular_checksum(self.ordenados)
+
+class CatalogoExplosivos:
+    """Catálogo de explosivos compartido por todas las peticiones del proceso"""
+
+    def __init__(self):
+        self._instantanea = None
+        self._lock = threading.Lock()
+        self.version = 0
+        self.firma = None
+        self.cargado_en = None
+        self.verificado_en = None
+
+    @property
+    def cargado(self):
+        return self._instantanea is not None
+
+    @property
+    def checksum(self):
+        instantanea = self._instantanea
+        return instantanea.checksum if instantanea else None
+
+    def cargar(self, registros, firma=None, cargado_en=None):
+        """Reemplazar el catálogo. registros: dicts o tuplas con id, codigo, descripcion, unidad, grupo
+
+        firma: valor barato calculado en la base para detectar cambios sin leer el catálogo.
+        Retorna True si el contenido cambió (y con él la versión).
+        """
+        explosivos = [ExplosivoCatalogo(**r) if isinstance(r, dict) else ExplosivoCatalogo(*r) for r in registros]
+        instantanea = _Instantanea(explosivos)
+
+        # Reemplazo atómico: las lecturas en curso siguen usando la instantánea anterior
+        with self._lock:
+            cambio = self._instantanea is None or self._instantanea.checksum != instantanea.checksum
+            if cambio:
+                self.version += 1
+            self._instantanea = instantanea
+            self.firma = firma
+            self.cargado_en = cargado_en
+            self.verificado_en = cargado_en
+        return cambio
+
+    def marcar_verificado(self, verificado_en):
+        """La firma de la base coincide: el catálogo sigue vigente"""
+        self.verificado_en = verificado_en
+
+    def invalidar(self):
+        """Marcar el catálogo para recarga en el próximo acceso"""
+        with self._lock:
+            self._instantanea = None
+
+    def ordenados(self):
+        """Lista de explosivos en el orden de los formularios"""
+        instantanea = self._instantanea
+        return list(instantanea.ordenados) if instantanea else []
+
+    def por_id(self, explosivo_id):
+        instantanea = self._instantanea
+        return instantanea.por_id.get(explosivo_id) if instantanea else None
+
+    def por_codigo(self, codigo):
+        instantanea = self._instantanea
+        return instantanea.por_codigo.get(codigo) if instantanea else None
+
+    def mapa_ids(self):
+        """{explosivo_id: explosivo} de la instantánea actual"""
+        instantanea = self._instantanea
+        return instantanea.por_id if instantanea else {}
+
+    def mapa_codigos(self):
+        """{codigo: explosivo} de la instantánea actual"""
+        instantanea = self._instantanea
+        return instantanea.por_codigo if instantanea else {}
+
+    def grupos(self):
+        """{grupo: (ids...)} en el orden del catálogo"""
+        instantanea = self._instantanea
+        return dict(instantanea.grupos) if instantanea else {}
+
+    def estado(self):
+        instantanea = self._instantanea
+        return {
+            'version': self.version,
+            'checksum': instantanea.checksum if instantanea else None,
+            'cargado': instantanea is not None,
+            'explosivos': len(instantanea.ordenados) if instantanea else 0,
+            'grupos': len(instantanea.grupos) if instantanea else 0,
+            'cargado_en': self.cargado_en,
+            'verificado_en': self.verificado_en
+        }
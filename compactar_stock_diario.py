@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Migración de stock_diario a almacenamiento disperso (ver stock_diario_disperso.py)
+Crea el calendario de turnos (turnos_calendario), reemplaza vw_stock_diario_simple por
+la vista que deriva los turnos sin actividad y borra las filas que esa vista reproduce
+tal cual. Si existe vw_stock_diario_powerbi (Power BI) se recrea sobre la vista derivada.
+Todo ocurre en una sola transacción: si alguna de las vistas no devuelve exactamente las
+mismas filas que antes, se revierte.
+
+Uso:
+    python compactar_stock_diario.py --dry-run               # solo informar, sin cambios
+    python compactar_stock_diario.py                         # migrar y compactar
+    python compactar_stock_diario.py --solo-vista            # calendario y vista, sin borrar filas
+    python compactar_stock_diario.py --normalizar-etiquetas  # compactar también filas 'Sistema' con otras observaciones
+
+Después: POST /admin/capacidades/refrescar (o reiniciar) para que la aplicación pase a
+modo disperso. Con la tabla turnos_calendario la inicialización de turnos ya no crea
+filas para los explosivos sin movimientos. No volver a ejecutar los scripts
+database_scripts/09_vista_stock_diario_powerbi*.sql: leen stock_diario directamente.
+"""
+
+import sys
+import argparse
+from collections import Counter
+sys.path.append('.')
+
+from app import app, db, dividir_en_lotes
+from sqlalchemy import text
+from stock_diario_disperso import filas_compactables, sql_vista_dispersa, VISTA_POWERBI_DISPERSA
+
+COLUMNAS_VISTA = (
+    'explosivo_id', 'codigo', 'descripcion', 'unidad', 'fecha', 'guardia',
+    'stock_inicial', 'stock_final', 'ingresos', 'salidas', 'devoluciones',
+    'responsable_guardia', 'observaciones', 'stock_final_calculado', 'estado_consistencia'
+)
+COLUMNAS_ETIQUETAS = ('responsable_guardia', 'observaciones')
+
+# Columnas de vw_stock_diario_powerbi (09_vista_stock_diario_powerbi_basica.sql). Se comparan
+# todas menos las de la fila guardada (un turno derivado no tiene) y fecha_consulta
+COLUMNAS_POWERBI_FILA = ('stock_diario_id', 'stock_diario_creado', 'fecha_consulta')
+COLUMNAS_POWERBI = (
+    'explosivo_id', 'codigo', 'descripcion', 'unidad', 'grupo', 'fecha', 'turno',
+    'stock_inicial', 'stock_final', 'total_ingresos', 'total_salidas', 'total_devoluciones',
+    'diferencia', 'tipo_diferencia', 'responsable_guardia', 'observaciones', 'cantidad_labores',
+    'estado_explosivo', 'anio', 'mes', 'dia', 'dia_semana', 'nombre_mes', 'periodo_mes', 'periodo_trimestre'
+)
+COLUMNAS_NUMERICAS = ('stock_', 'ingresos', 'salidas', 'devoluciones', 'total_', 'diferencia')
+
+# Filas distintas que se muestran si la verificación falla
+FILAS_DIFF_PANTALLA = 20
+
+def leer_vista(sin_etiquetas=False, vista='vw_stock_diario_simple', columnas_vista=COLUMNAS_VISTA):
+    """Todas las filas de la vista, normalizadas y ordenadas para comparar"""
+    columnas = [c for c in columnas_vista if not (sin_etiquetas and c in COLUMNAS_ETIQUETAS)]
+    filas = []
+    for row in db.session.execute(text(f"SELECT {', '.join(columnas)} FROM {vista}")):
+        fila = []
+        for columna, valor in zip(columnas, row):
+            if valor is None:
+                fila.append('')
+            elif columna == 'fecha':
+                fila.append(str(valor)[:10])
+            elif isinstance(valor, (int, float)) or columna.startswith(COLUMNAS_NUMERICAS):
+                fila.append(round(float(valor), 2))
+            else:
+                fila.append(str(valor))
+        filas.append(tuple(fila))
+    return sorted(filas, key=repr)
+
+def crear_calendario(dialecto):
+    """Tabla turnos_calendario e índice para buscar la fila anterior de cada explosivo"""
+    if dialecto == 'mssql':
+        db.session.execute(text("""
+            IF OBJECT_ID('turnos_calendario', 'U') IS NULL
+            CREATE TABLE turnos_calendario (
+                fecha DATE NOT NULL,
+                guardia VARCHAR(10) NOT NULL,
+                CONSTRAINT PK_turnos_calendario PRIMARY KEY (fecha, guardia)
+            )
+        """))
+        db.session.execute(text("""
+            IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_stock_diario_explosivo_fecha'
+                           AND object_id = OBJECT_ID('stock_diario'))
+            CREATE INDEX IX_stock_diario_explosivo_fecha ON stock_diario (explosivo_id, fecha, guardia) INCLUDE (stock_final)
+        """))
+    else:
+        db.session.execute(text("""
+            CREATE TABLE IF NOT EXISTS turnos_calendario (
+                fecha DATE NOT NULL,
+                guardia VARCHAR(10) NOT NULL,
+                PRIMARY KEY (fecha, guardia)
+            )
+        """))
+        db.session.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_stock_diario_explosivo_fecha ON stock_diario (explosivo_id, fecha, guardia)"
+        ))
+
+    # Todos los turnos que hoy tienen filas, antes de borrar ninguna
+    return db.session.execute(text("""
+        INSERT INTO turnos_calendario (fecha, guardia)
+        SELECT DISTINCT sd.fecha, sd.guardia
+        FROM stock_diario sd
+        WHERE NOT EXISTS (
+            SELECT 1 FROM turnos_calendario tc
+            WHERE tc.fecha = sd.fecha AND tc.guardia = sd.guardia
+        )
+    """)).rowcount
+
+def crear_vista_dispersa(dialecto):
+    db.session.execute(text("DROP VIEW IF EXISTS vw_stock_diario_simple"))
+    db.session.execute(text(sql_vista_dispersa(dialecto)))
+
+def existe_vista_powerbi(dialecto):
+    if dialecto == 'mssql':
+        return db.session.execute(text("SELECT OBJECT_ID('vw_stock_diario_powerbi', 'V')")).scalar() is not None
+    return db.session.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = 'vw_stock_diario_powerbi'"
+    )).scalar() is not None
+
+def verificar_vista_powerbi(dialecto):
+    """Motivo por el que no se puede recrear vw_stock_diario_powerbi, o None"""
+    if dialecto != 'mssql':
+        return "la versión dispersa de vw_stock_diario_powerbi solo existe para SQL Server"
+    columnas = set(db.session.execute(text("SELECT * FROM vw_stock_diario_powerbi WHERE 1 = 0")).keys())
+    esperadas = set(COLUMNAS_POWERBI) | set(COLUMNAS_POWERBI_FILA)
+    if columnas != esperadas:
+        return (f"vw_stock_diario_powerbi no tiene las columnas de 09_vista_stock_diario_powerbi_basica.sql "
+                f"(sobran {sorted(columnas - esperadas)}, faltan {sorted(esperadas - columnas)})")
+    return None
+
+def crear_vista_powerbi_dispersa():
+    db.session.execute(text("DROP VIEW vw_stock_diario_powerbi"))
+    db.session.execute(text(VISTA_POWERBI_DISPERSA))
+
+def cargar_filas_stock_diario():
+    """Filas de stock_diario con las marcas de movimientos que impiden borrarlas"""
+    return [tuple(row) for row in db.session.execute(text("""
+        SELECT
+            sd.id, sd.explosivo_id, sd.fecha, sd.guardia, sd.stock_inicial, sd.stock_final,
+            sd.responsable_guardia, sd.observaciones,
+            CASE WHEN EXISTS (
+                SELECT 1 FROM stock_movimientos_turno mt
+                WHERE mt.explosivo_id = sd.explosivo_id AND mt.fecha = sd.fecha AND mt.guardia = sd.guardia
+                AND (mt.ingresos <> 0 OR mt.salidas <> 0 OR mt.devoluciones <> 0)
+            ) THEN 1 ELSE 0 END AS con_movimientos,
+            CASE WHEN EXISTS (SELECT 1 FROM ingresos i WHERE i.stock_diario_id = sd.id)
+                   OR EXISTS (SELECT 1 FROM salidas s WHERE s.stock_diario_id = sd.id)
+                   OR EXISTS (SELECT 1 FROM devoluciones d WHERE d.stock_diario_id = sd.id)
+            THEN 1 ELSE 0 END AS referenciada
+        FROM stock_diario sd
+    """)).fetchall()]
+
+def borrar_filas(ids):
+    borradas = 0
+    for lote in dividir_en_lotes(ids, 1):
+        params = {f'id_{i}': fila_id for i, fila_id in enumerate(lote)}
+        placeholders = ','.join(f':id_{i}' for i in range(len(lote)))
+        borradas += db.session.execute(text(f"DELETE FROM stock_diario WHERE id IN ({placeholders})"), params).rowcount
+    return borradas
+
+def reportar_diferencias(vista, antes, despues):
+    solo_antes = Counter(antes) - Counter(despues)
+    solo_despues = Counter(despues) - Counter(antes)
+    print(f"❌ {vista} cambió: {len(antes)} filas antes, {len(despues)} después")
+    for etiqueta, filas in (('   - antes  ', solo_antes), ('   + después', solo_despues)):
+        for fila in list(filas.elements())[:FILAS_DIFF_PANTALLA]:
+            print(f"{etiqueta} {fila}")
+
+def compactar_stock_diario(dry_run=False, solo_vista=False, normalizar_etiquetas=False):
+    """Migrar a stock_diario disperso verificando que vw_stock_diario_simple y vw_stock_diario_powerbi no cambien"""
+
+    with app.app_context():
+        print("=== STOCK_DIARIO DISPERSO ===\n")
+        dialecto = db.engine.dialect.name
+
+        try:
+            # vw_stock_diario_powerbi lee stock_diario directamente: sin recrearla perdería
+            # los turnos compactados
+            powerbi = existe_vista_powerbi(dialecto)
+            if powerbi:
+                motivo = verificar_vista_powerbi(dialecto)
+                if motivo:
+                    print(f"❌ No se compacta: {motivo}")
+                    return False
+
+            antes = leer_vista(normalizar_etiquetas)
+            filas_totales = db.session.execute(text("SELECT COUNT(*) FROM stock_diario")).scalar()
+            print(f"📊 stock_diario: {filas_totales} filas, vista: {len(antes)} filas")
+            if powerbi:
+                antes_powerbi = leer_vista(normalizar_etiquetas, 'vw_stock_diario_powerbi', COLUMNAS_POWERBI)
+                print(f"📊 vw_stock_diario_powerbi: {len(antes_powerbi)} filas")
+
+            if dialecto == 'sqlite':
+                # pysqlite no abre la transacción antes de un CREATE: se abre aquí para poder revertir
+                db.session.execute(text("BEGIN"))
+            turnos = crear_calendario(dialecto)
+            print(f"🗓️ {turnos} turnos agregados a turnos_calendario")
+            crear_vista_dispersa(dialecto)
+            print("🔧 Vista vw_stock_diario_simple en modo disperso")
+            if powerbi:
+                crear_vista_powerbi_dispersa()
+                print("🔧 Vista vw_stock_diario_powerbi sobre la vista dispersa")
+
+            borradas = 0
+            if not solo_vista:
+                ids = filas_compactables(cargar_filas_stock_diario(), normalizar_etiquetas)
+                borradas = borrar_filas(ids)
+            print(f"🗑️ {borradas} filas sin actividad compactadas ({filas_totales - borradas} quedan)")
+
+            comparaciones = [('vw_stock_diario_simple', antes, leer_vista(normalizar_etiquetas))]
+            if powerbi:
+                comparaciones.append(('vw_stock_diario_powerbi', antes_powerbi,
+                                      leer_vista(normalizar_etiquetas, 'vw_stock_diario_powerbi', COLUMNAS_POWERBI)))
+            for vista, filas_antes, filas_despues in comparaciones:
+                if filas_antes != filas_despues:
+                    db.session.rollback()
+                    reportar_diferencias(vista, filas_antes, filas_despues)
+                    print("↩️ Cambios revertidos")
+                    return False
+                print(f"✅ Verificación: {vista} devuelve las mismas {len(filas_despues)} filas")
+
+            if dry_run:
+                db.session.rollback()
+                print("📝 --dry-run: cambios revertidos")
+                return True
+
+            db.session.commit()
+            print("✅ Migración aplicada. Refrescar capacidades: POST /admin/capacidades/refrescar")
+            return True
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Error en la migración: {e}")
+            return False
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrar stock_diario a almacenamiento disperso')
+    parser.add_argument('--dry-run', action='store_true', help='Verificar e informar sin aplicar cambios')
+    parser.add_argument('--solo-vista', action='store_true', help='Crear calendario y vista sin borrar filas')
+    parser.add_argument('--normalizar-etiquetas', action='store_true',
+                        help="Compactar también filas 'Sistema' con otras observaciones (la verificación ignora las etiquetas)")
+    args = parser.parse_args()
+    return 0 if compactar_stock_diario(args.dry_run, args.solo_vista, args.normalizar_etiquetas) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,7 +10,7 @@ import os
 sys.path.append('.')
 
 from datetime import datetime, date
-from app import app, db
+from app import app, db, obtener_capacidades
 from sqlalchemy import text
 
 def crear_vista_simple():
@@ -19,6 +19,12 @@ def crear_vista_simple():
     with app.app_context():
         print("=== CREACIÓN DE VISTA SIMPLE STOCK DIARIO ===\n")
         
+        # Con stock_diario disperso esta vista ocultaría los turnos sin movimientos
+        if obtener_capacidades(forzar=True)['turnos_calendario']:
+            print("⚠️ stock_diario está en modo disperso (existe turnos_calendario)")
+            print("   Ejecuta: python compactar_stock_diario.py --solo-vista")
+            return False
+        
         # Primero eliminar vista si existe
         try:
             drop_vista_sql = "DROP VIEW IF EXISTS vw_stock_diario_simple"
@@ -28,6 +34,8 @@ def crear_vista_simple():
             print(f"📝 Vista no existía previamente: {e}")
         
         # Vista simplificada compatible con SQL Server
+        # Los totales del turno salen de stock_movimientos_turno (un solo JOIN,
+        # sin subconsultas correlacionadas ni CAST sobre las fechas de movimientos)
         vista_sql = """
         CREATE VIEW vw_stock_diario_simple AS
         SELECT 
@@ -40,52 +48,23 @@ def crear_vista_simple():
             sd.stock_inicial,
             sd.stock_final,
             
-            -- Ingresos del turno
-            COALESCE((
-                SELECT SUM(i.cantidad)
-                FROM ingresos i
-                WHERE i.explosivo_id = sd.explosivo_id
-                AND CAST(i.fecha_ingreso AS DATE) = sd.fecha
-                AND i.guardia = sd.guardia
-            ), 0.0) as ingresos,
-            
-            -- Salidas del turno
-            COALESCE((
-                SELECT SUM(s.cantidad)
-                FROM salidas s
-                WHERE s.explosivo_id = sd.explosivo_id
-                AND CAST(s.fecha_salida AS DATE) = sd.fecha
-                AND s.guardia = sd.guardia
-            ), 0.0) as salidas,
-            
-            -- Devoluciones del turno
-            COALESCE((
-                SELECT SUM(d.cantidad_devuelta)
-                FROM devoluciones d
-                JOIN salidas s ON d.salida_id = s.id
-                WHERE s.explosivo_id = sd.explosivo_id
-                AND CAST(d.fecha_devolucion AS DATE) = sd.fecha
-                AND s.guardia = sd.guardia
-            ), 0.0) as devoluciones,
+            -- Movimientos del turno
+            COALESCE(mt.ingresos, 0.0) as ingresos,
+            COALESCE(mt.salidas, 0.0) as salidas,
+            COALESCE(mt.devoluciones, 0.0) as devoluciones,
             
             -- Información adicional
             sd.responsable_guardia,
             sd.observaciones,
             
-            -- Stock calculado dinámicamente para verificación
-            (sd.stock_inicial + 
-             COALESCE((SELECT SUM(i.cantidad) FROM ingresos i WHERE i.explosivo_id = sd.explosivo_id AND CAST(i.fecha_ingreso AS DATE) = sd.fecha AND i.guardia = sd.guardia), 0) +
-             COALESCE((SELECT SUM(d.cantidad_devuelta) FROM devoluciones d JOIN salidas s ON d.salida_id = s.id WHERE s.explosivo_id = sd.explosivo_id AND CAST(d.fecha_devolucion AS DATE) = sd.fecha AND s.guardia = sd.guardia), 0) -
-             COALESCE((SELECT SUM(s.cantidad) FROM salidas s WHERE s.explosivo_id = sd.explosivo_id AND CAST(s.fecha_salida AS DATE) = sd.fecha AND s.guardia = sd.guardia), 0)
+            -- Stock calculado para verificación
+            (sd.stock_inicial + COALESCE(mt.ingresos, 0) + COALESCE(mt.devoluciones, 0) - COALESCE(mt.salidas, 0)
             ) as stock_final_calculado,
             
             -- Verificación de consistencia
             CASE 
                 WHEN ABS(sd.stock_final - 
-                    (sd.stock_inicial + 
-                     COALESCE((SELECT SUM(i.cantidad) FROM ingresos i WHERE i.explosivo_id = sd.explosivo_id AND CAST(i.fecha_ingreso AS DATE) = sd.fecha AND i.guardia = sd.guardia), 0) +
-                     COALESCE((SELECT SUM(d.cantidad_devuelta) FROM devoluciones d JOIN salidas s ON d.salida_id = s.id WHERE s.explosivo_id = sd.explosivo_id AND CAST(d.fecha_devolucion AS DATE) = sd.fecha AND s.guardia = sd.guardia), 0) -
-                     COALESCE((SELECT SUM(s.cantidad) FROM salidas s WHERE s.explosivo_id = sd.explosivo_id AND CAST(s.fecha_salida AS DATE) = sd.fecha AND s.guardia = sd.guardia), 0)
+                    (sd.stock_inicial + COALESCE(mt.ingresos, 0) + COALESCE(mt.devoluciones, 0) - COALESCE(mt.salidas, 0)
                     )) <= 0.01 
                 THEN 'OK' 
                 ELSE 'INCONSISTENTE' 
@@ -93,14 +72,19 @@ def crear_vista_simple():
             
         FROM stock_diario sd
         JOIN explosivos e ON sd.explosivo_id = e.id
+        LEFT JOIN stock_movimientos_turno mt
+            ON mt.explosivo_id = sd.explosivo_id
+            AND mt.fecha = sd.fecha
+            AND mt.guardia = sd.guardia
         WHERE e.activo = 1
         """
         
         print("🔧 VISTA SIMPLE GENERADA:")
         print("   • Basada en tabla stock_diario existente")
-        print("   • Calcula movimientos dinámicamente")
+        print("   • Movimientos desde stock_movimientos_turno (agregado por turno)")
         print("   • Incluye verificación de consistencia") 
         print("   • Compatible con SQL Server")
+        print("   • Requiere database_scripts/12_crear_tabla_stock_movimientos_turno.sql")
         
         confirm = input("\n¿Crear vista simple stock diario? (si/no): ").strip().lower()
         
@@ -4,6 +4,8 @@
 -- Fecha: Noviembre 2025
 -- Descripción: Vista que replica la funcionalidad de stock diario
 --              de la aplicación web para usar en Power BI
+-- Con stock_diario disperso (compactar_stock_diario.py) no ejecutar este script:
+-- la migración recrea la vista sobre vw_stock_diario_simple.
 
 USE pallca;
 GO
@@ -1,6 +1,8 @@
 -- =========================================================
 -- VISTA PARA POWER BI: STOCK DIARIO SIMPLIFICADA
 -- =========================================================
+-- Con stock_diario disperso (compactar_stock_diario.py) no ejecutar este script:
+-- la migración recrea la vista sobre vw_stock_diario_simple.
 
 USE pallca;
 GO
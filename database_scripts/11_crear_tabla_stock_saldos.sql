@@ -0,0 +1,61 @@
+-- Tabla de saldos acumulados por explosivo (ledger de stock)
+-- Reemplaza la re-agregación completa de v_stock_actual en cada lectura.
+-- La aplicación actualiza esta tabla en la misma transacción de cada
+-- ingreso, salida o devolución (alta, edición y eliminación).
+-- Reconstrucción/verificación: python reconstruir_stock_saldos.py
+
+USE pallca;
+GO
+
+PRINT '🔄 Creando tabla stock_saldos...';
+
+IF OBJECT_ID('stock_saldos', 'U') IS NULL
+BEGIN
+    CREATE TABLE stock_saldos (
+        explosivo_id INT NOT NULL PRIMARY KEY,
+        total_ingresos DECIMAL(12, 2) NOT NULL DEFAULT 0,
+        total_salidas DECIMAL(12, 2) NOT NULL DEFAULT 0,
+        total_devoluciones DECIMAL(12, 2) NOT NULL DEFAULT 0,
+        stock_actual DECIMAL(12, 2) NOT NULL DEFAULT 0,
+        fecha_actualizacion DATETIME NOT NULL DEFAULT GETDATE(),
+        CONSTRAINT FK_stock_saldos_explosivos FOREIGN KEY (explosivo_id) REFERENCES explosivos(id)
+    );
+    PRINT '✅ Tabla stock_saldos creada';
+END
+ELSE
+    PRINT '📝 Tabla stock_saldos ya existía';
+GO
+
+-- Poblar saldos iniciales desde el historial completo de movimientos
+PRINT '🔄 Poblando stock_saldos desde movimientos...';
+
+BEGIN TRANSACTION;
+
+DELETE FROM stock_saldos;
+
+INSERT INTO stock_saldos (explosivo_id, total_ingresos, total_salidas, total_devoluciones, stock_actual, fecha_actualizacion)
+SELECT
+    e.id,
+    COALESCE(i.total_ingresos, 0),
+    COALESCE(s.total_salidas, 0),
+    COALESCE(d.total_devoluciones, 0),
+    COALESCE(i.total_ingresos, 0) - COALESCE(s.total_salidas, 0) + COALESCE(d.total_devoluciones, 0),
+    GETDATE()
+FROM explosivos e
+LEFT JOIN (
+    SELECT explosivo_id, SUM(cantidad) AS total_ingresos
+    FROM ingresos GROUP BY explosivo_id
+) i ON e.id = i.explosivo_id
+LEFT JOIN (
+    SELECT explosivo_id, SUM(cantidad) AS total_salidas
+    FROM salidas GROUP BY explosivo_id
+) s ON e.id = s.explosivo_id
+LEFT JOIN (
+    SELECT explosivo_id, SUM(cantidad_devuelta) AS total_devoluciones
+    FROM devoluciones GROUP BY explosivo_id
+) d ON e.id = d.explosivo_id;
+
+COMMIT TRANSACTION;
+GO
+
+PRINT '✅ stock_saldos poblada';
@@ -0,0 +1,104 @@
+-- Totales de movimientos por explosivo, fecha y guardia (agregado materializado)
+-- Reemplaza las subconsultas correlacionadas de vw_stock_diario_simple.
+-- La aplicación actualiza esta tabla en la misma transacción de cada
+-- ingreso, salida o devolución (alta, edición y eliminación).
+-- Reconstrucción/verificación: python reconstruir_stock_saldos.py
+
+USE pallca;
+GO
+
+PRINT '🔄 Creando tabla stock_movimientos_turno...';
+
+IF OBJECT_ID('stock_movimientos_turno', 'U') IS NULL
+BEGIN
+    CREATE TABLE stock_movimientos_turno (
+        explosivo_id INT NOT NULL,
+        fecha DATE NOT NULL,
+        guardia VARCHAR(10) NOT NULL,
+        ingresos DECIMAL(12, 2) NOT NULL DEFAULT 0,
+        salidas DECIMAL(12, 2) NOT NULL DEFAULT 0,
+        devoluciones DECIMAL(12, 2) NOT NULL DEFAULT 0,
+        fecha_actualizacion DATETIME NOT NULL DEFAULT GETDATE(),
+        CONSTRAINT PK_stock_movimientos_turno PRIMARY KEY (explosivo_id, fecha, guardia),
+        CONSTRAINT FK_stock_movimientos_turno_explosivos FOREIGN KEY (explosivo_id) REFERENCES explosivos(id)
+    );
+    PRINT '✅ Tabla stock_movimientos_turno creada';
+END
+ELSE
+    PRINT '📝 Tabla stock_movimientos_turno ya existía';
+GO
+
+-- Poblar agregados desde el historial completo de movimientos
+PRINT '🔄 Poblando stock_movimientos_turno desde movimientos...';
+
+BEGIN TRANSACTION;
+
+DELETE FROM stock_movimientos_turno;
+
+INSERT INTO stock_movimientos_turno (explosivo_id, fecha, guardia, ingresos, salidas, devoluciones, fecha_actualizacion)
+SELECT
+    m.explosivo_id,
+    m.fecha,
+    m.guardia,
+    SUM(m.ingresos),
+    SUM(m.salidas),
+    SUM(m.devoluciones),
+    GETDATE()
+FROM (
+    SELECT explosivo_id, CAST(fecha_ingreso AS DATE) AS fecha, guardia,
+           cantidad AS ingresos, 0 AS salidas, 0 AS devoluciones
+    FROM ingresos
+    UNION ALL
+    SELECT explosivo_id, CAST(fecha_salida AS DATE), guardia, 0, cantidad, 0
+    FROM salidas
+    UNION ALL
+    SELECT COALESCE(d.explosivo_id, s.explosivo_id), CAST(d.fecha_devolucion AS DATE), d.guardia, 0, 0, d.cantidad_devuelta
+    FROM devoluciones d
+    LEFT JOIN salidas s ON d.salida_id = s.id
+) m
+WHERE m.explosivo_id IS NOT NULL
+GROUP BY m.explosivo_id, m.fecha, m.guardia;
+
+COMMIT TRANSACTION;
+GO
+
+PRINT '✅ stock_movimientos_turno poblada';
+
+-- Vista de stock diario: un solo JOIN contra el agregado por turno
+PRINT '🔄 Recreando vista vw_stock_diario_simple...';
+
+IF OBJECT_ID('vw_stock_diario_simple', 'V') IS NOT NULL
+    DROP VIEW vw_stock_diario_simple;
+GO
+
+CREATE VIEW vw_stock_diario_simple AS
+SELECT
+    sd.explosivo_id,
+    e.codigo,
+    e.descripcion,
+    e.unidad,
+    sd.fecha,
+    sd.guardia,
+    sd.stock_inicial,
+    sd.stock_final,
+    COALESCE(mt.ingresos, 0.0) AS ingresos,
+    COALESCE(mt.salidas, 0.0) AS salidas,
+    COALESCE(mt.devoluciones, 0.0) AS devoluciones,
+    sd.responsable_guardia,
+    sd.observaciones,
+    sd.stock_inicial + COALESCE(mt.ingresos, 0) + COALESCE(mt.devoluciones, 0) - COALESCE(mt.salidas, 0) AS stock_final_calculado,
+    CASE
+        WHEN ABS(sd.stock_final - (sd.stock_inicial + COALESCE(mt.ingresos, 0) + COALESCE(mt.devoluciones, 0) - COALESCE(mt.salidas, 0))) <= 0.01
+        THEN 'OK'
+        ELSE 'INCONSISTENTE'
+    END AS estado_consistencia
+FROM stock_diario sd
+JOIN explosivos e ON sd.explosivo_id = e.id
+LEFT JOIN stock_movimientos_turno mt
+    ON mt.explosivo_id = sd.explosivo_id
+    AND mt.fecha = sd.fecha
+    AND mt.guardia = sd.guardia
+WHERE e.activo = 1;
+GO
+
+PRINT '✅ Vista vw_stock_diario_simple recreada sobre stock_movimientos_turno';
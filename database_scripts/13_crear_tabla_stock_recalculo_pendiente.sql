@@ -0,0 +1,27 @@
+-- Marca "sucio desde" por explosivo para el recálculo incremental de stock_diario
+-- La aplicación baja la marca a la fecha de cada ingreso, salida o devolución
+-- (alta, edición y eliminación) en la misma transacción del movimiento.
+-- python recalcular_stock_automatico.py --incremental recorre solo desde la marca
+-- más antigua y la va adelantando (checkpoint para reanudar ejecuciones cortadas).
+
+USE pallca;
+GO
+
+PRINT '🔄 Creando tabla stock_recalculo_pendiente...';
+
+IF OBJECT_ID('stock_recalculo_pendiente', 'U') IS NULL
+BEGIN
+    CREATE TABLE stock_recalculo_pendiente (
+        explosivo_id INT NOT NULL,
+        sucio_desde DATE NOT NULL,
+        fecha_actualizacion DATETIME NOT NULL DEFAULT GETDATE(),
+        CONSTRAINT PK_stock_recalculo_pendiente PRIMARY KEY (explosivo_id),
+        CONSTRAINT FK_stock_recalculo_pendiente_explosivos FOREIGN KEY (explosivo_id) REFERENCES explosivos(id)
+    );
+    PRINT '✅ Tabla stock_recalculo_pendiente creada';
+END
+ELSE
+    PRINT '📝 Tabla stock_recalculo_pendiente ya existía';
+GO
+
+PRINT '✅ stock_recalculo_pendiente lista (vacía: se llena con los próximos movimientos)';
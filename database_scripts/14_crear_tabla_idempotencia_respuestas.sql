@@ -0,0 +1,30 @@
+-- Respuestas de los registros por Idempotency-Key (salidas, ingresos, devoluciones)
+-- Opcional: sin esta tabla la deduplicación usa solo la memoria de cada proceso.
+-- Con varios workers, la reserva de la clave (PRIMARY KEY) evita que un reintento que
+-- llega a otro worker vuelva a insertar los movimientos.
+-- Las filas vencen a las 24 h (IDEMPOTENCIA_TTL_SEG); la aplicación purga las viejas.
+
+USE pallca;
+GO
+
+PRINT '🔄 Creando tabla idempotencia_respuestas...';
+
+IF OBJECT_ID('idempotencia_respuestas', 'U') IS NULL
+BEGIN
+    CREATE TABLE idempotencia_respuestas (
+        clave NVARCHAR(200) NOT NULL,
+        estado VARCHAR(20) NOT NULL,        -- 'en_proceso' o 'completada'
+        codigo INT NULL,                    -- código HTTP de la respuesta original
+        cuerpo NVARCHAR(MAX) NULL,
+        tipo VARCHAR(100) NULL,
+        creado_en DATETIME NOT NULL DEFAULT GETDATE(),
+        CONSTRAINT PK_idempotencia_respuestas PRIMARY KEY (clave)
+    );
+    CREATE INDEX IX_idempotencia_respuestas_creado_en ON idempotencia_respuestas (creado_en);
+    PRINT '✅ Tabla idempotencia_respuestas creada';
+END
+ELSE
+    PRINT '📝 Tabla idempotencia_respuestas ya existía';
+GO
+
+PRINT '✅ idempotencia_respuestas lista (POST /admin/capacidades/refrescar la activa sin reiniciar)';
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Difusión en memoria de cambios de stock para /api/stock/stream (Server-Sent Events)
+Cada formulario abierto se suscribe a los explosivos que muestra; al confirmarse un
+movimiento se publica una sola vez el delta de saldo por explosivo (y el saldo resultante,
+si se conoce) y el hub lo reparte a las colas de los suscriptores interesados, sin
+consultas ni sondeo por cliente.
+El hub es del proceso: difunde al instante los commits de su worker, y SondeoSaldos le
+entrega los de otros workers o scripts leyendo stock_saldos cada pocos segundos.
+Cada conexión ocupa un hilo del worker: pasado max_suscriptores el hub rechaza la
+suscripción y el cliente sondea el stock por su cuenta.
+"""
+
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+class Suscripcion:
+    """Cola de eventos de un cliente conectado"""
+
+    __slots__ = ('explosivos_ids', 'cola', 'conectado_en')
+
+    def __init__(self, explosivos_ids, max_pendientes):
+        self.explosivos_ids = frozenset(explosivos_ids) if explosivos_ids else None
+        self.cola = queue.Queue(maxsize=max_pendientes)
+        self.conectado_en = time.time()
+
+    def interesa(self, explosivo_id):
+        return self.explosivos_ids is None or explosivo_id in self.explosivos_ids
+
+    def siguiente(self, espera):
+        """Próximo evento, o None si no llegó ninguno en `espera` segundos"""
+        try:
+            return self.cola.get(timeout=espera)
+        except queue.Empty:
+            return None
+
+class HubStock:
+    """Reparte cambios de stock a los suscriptores del proceso"""
+
+    def __init__(self, max_pendientes=50, max_suscriptores=None):
+        self.max_pendientes = max_pendientes
+        self.max_suscriptores = max_suscriptores
+        self._suscripciones = set()
+        self._saldos = {}  # último saldo difundido por explosivo (publicar_saldos calcula el delta)
+        self._lock = threading.Lock()
+        self.publicados_total = 0
+        self.entregados_total = 0
+        self.desbordes_total = 0
+        self.rechazados_total = 0
+
+    @property
+    def activo(self):
+        """Hay al menos un cliente conectado"""
+        return bool(self._suscripciones)
+
+    def suscribir(self, explosivos_ids=None):
+        """Nueva suscripción (explosivos_ids=None: todos los explosivos), o None si el
+        proceso ya tiene max_suscriptores conexiones abiertas"""
+        suscripcion = Suscripcion(explosivos_ids, self.max_pendientes)
+        with self._lock:
+            if self.max_suscriptores is not None and len(self._suscripciones) >= self.max_suscriptores:
+                self.rechazados_total += 1
+                return None
+            self._suscripciones.add(suscripcion)
+        return suscripcion
+
+    def cancelar(self, suscripcion):
+        with self._lock:
+            self._suscripciones.discard(suscripcion)
+
+    def publicar(self, deltas, version=None, saldos=None):
+        """Difundir {explosivo_id: delta de stock} a quien muestre esos explosivos
+
+        saldos: {explosivo_id: stock resultante} opcional; el cliente lo prefiere al delta
+        porque aplicarlo dos veces no cambia el resultado.
+        """
+        if not deltas:
+            return 0
+        with self._lock:
+            suscripciones = list(self._suscripciones)
+            self.publicados_total += 1
+            self._saldos.update(saldos or {})
+
+        entregados = desbordes = 0
+        for suscripcion in suscripciones:
+            cambios = {str(e): delta for e, delta in deltas.items() if delta and suscripcion.interesa(e)}
+            if not cambios:
+                continue
+            evento = {'tipo': 'stock', 'deltas': cambios, 'version': version}
+            if saldos:
+                evento['saldos'] = {str(e): saldo for e, saldo in saldos.items() if str(e) in cambios}
+            try:
+                suscripcion.cola.put_nowait(evento)
+            except queue.Full:
+                # Cliente lento: se descartan sus eventos y se le pide recargar el stock completo
+                self._vaciar(suscripcion)
+                suscripcion.cola.put_nowait({'tipo': 'resincronizar', 'version': version})
+                desbordes += 1
+            entregados += 1
+
+        with self._lock:
+            self.entregados_total += entregados
+            self.desbordes_total += desbordes
+        return entregados
+
+    def publicar_saldos(self, saldos, version=None, base=False):
+        """Difundir los saldos que cambiaron desde la última difusión ({explosivo_id: saldo})
+
+        base=True solo registra los saldos (primera lectura, sin eventos). Un saldo ya
+        difundido por publicar() tras el commit local no se vuelve a enviar.
+        """
+        with self._lock:
+            deltas = {e: saldo - self._saldos.get(e, 0.0) for e, saldo in saldos.items()
+                      if not base and abs(saldo - self._saldos.get(e, 0.0)) > 1e-9}
+            self._saldos.update(saldos)
+        return self.publicar(deltas, version, saldos={e: saldos[e] for e in deltas})
+
+    def olvidar_saldos(self):
+        """Sin suscriptores no se siguen los saldos: la próxima lectura vuelve a ser la base"""
+        with self._lock:
+            self._saldos.clear()
+
+    @staticmethod
+    def _vaciar(suscripcion):
+        try:
+            while True:
+                suscripcion.cola.get_nowait()
+        except queue.Empty:
+            pass
+
+    def estado(self):
+        with self._lock:
+            suscripciones = list(self._suscripciones)
+        return {
+            'suscriptores': len(suscripciones),
+            'max_suscriptores': self.max_suscriptores,
+            'eventos_en_cola': sum(s.cola.qsize() for s in suscripciones),
+            'publicados_total': self.publicados_total,
+            'entregados_total': self.entregados_total,
+            'desbordes_total': self.desbordes_total,
+            'rechazados_total': self.rechazados_total
+        }
+
+class SondeoSaldos:
+    """
+    Hilo que alimenta el hub con los saldos confirmados por cualquier worker o script
+
+    - leer_saldos(desde): {explosivo_id: stock_actual} de stock_saldos con
+      fecha_actualizacion >= desde (desde=None: todas las filas)
+    - Solo consulta mientras el hub tiene suscriptores; la primera lectura es la base
+    - Relee margen_seg hacia atrás: una transacción larga confirma filas con una
+      fecha_actualizacion anterior a la última lectura (los saldos repetidos no se envían)
+    """
+
+    def __init__(self, hub, leer_saldos, intervalo_seg=2, margen_seg=60):
+        self.hub = hub
+        self._leer_saldos = leer_saldos
+        self.intervalo = intervalo_seg
+        self.margen = timedelta(seconds=margen_seg)
+        self._detenido = threading.Event()
+        self._lock = threading.Lock()
+        self._hilo = None
+        self.lecturas_total = 0
+        self.errores_total = 0
+        self.ultimo_error = None
+
+    def asegurar_hilo(self):
+        """Arranca el hilo bajo demanda (después del fork de gunicorn)"""
+        with self._lock:
+            if self._hilo is None or not self._hilo.is_alive():
+                self._detenido.clear()
+                self._hilo = threading.Thread(target=self._trabajar, name='sondeo-saldos', daemon=True)
+                self._hilo.start()
+
+    def detener(self):
+        self._detenido.set()
+
+    def _trabajar(self):
+        ultima_lectura = None
+        while not self._detenido.wait(self.intervalo):
+            if not self.hub.activo:
+                if ultima_lectura is not None:
+                    self.hub.olvidar_saldos()
+                ultima_lectura = None
+                continue
+            inicio = datetime.now()
+            try:
+                saldos = self._leer_saldos(None if ultima_lectura is None else ultima_lectura - self.margen)
+                self.hub.publicar_saldos(saldos, base=ultima_lectura is None)
+                ultima_lectura = inicio
+                self.lecturas_total += 1
+            except Exception as e:
+                self.errores_total += 1
+                self.ultimo_error = f"{inicio.isoformat(timespec='seconds')}: {e}"
+                print(f"⚠️ Error sondeando stock_saldos para difusión: {e}")
+
+    def estado(self):
+        return {
+            'activo': self._hilo is not None and self._hilo.is_alive(),
+            'intervalo_seg': self.intervalo,
+            'lecturas_total': self.lecturas_total,
+            'errores_total': self.errores_total,
+            'ultimo_error': self.ultimo_error
+        }
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Escritores en streaming para la exportación de stock diario
+CSV (con BOM para Excel) y XLSX generado con zipfile de la biblioteca estándar.
+Ambos consumen un iterador de filas y producen bloques de bytes, de modo que la
+memoria usada no depende del número de filas exportadas.
+"""
+
+import csv
+import io
+import re
+import zipfile
+from datetime import date, datetime
+from xml.sax.saxutils import escape
+
+FILAS_POR_BLOQUE = 500
+
+# Caracteres de control no permitidos en XML 1.0
+_CARACTERES_INVALIDOS_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+def generar_csv(encabezados, filas, filas_por_bloque=FILAS_POR_BLOQUE):
+    """Generar un CSV por bloques (UTF-8 con BOM para que Excel respete los acentos)"""
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+
+    buffer.write('\ufeff')
+    escritor.writerow(encabezados)
+
+    for i, fila in enumerate(filas, 1):
+        escritor.writerow(['' if valor is None else valor for valor in fila])
+        if i % filas_por_bloque == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate(0)
+
+    yield buffer.getvalue().encode('utf-8')
+
+class _BufferSalida:
+    """Destino no posicionable para zipfile: acumula bytes hasta que se vacían"""
+
+    def __init__(self):
+        self._partes = []
+
+    def write(self, datos):
+        self._partes.append(bytes(datos))
+        return len(datos)
+
+    def flush(self):
+        pass
+
+    def vaciar(self):
+        datos = b''.join(self._partes)
+        self._partes = []
+        return datos
+
+def letra_columna(indice):
+    """Índice de columna base 0 -> letra de Excel (0 -> A, 26 -> AA)"""
+    letras = ''
+    indice += 1
+    while indice:
+        indice, resto = divmod(indice - 1, 26)
+        letras = chr(65 + resto) + letras
+    return letras
+
+def celda_xlsx(referencia, valor):
+    """XML de una celda: números como valor, fechas y texto como cadena en línea"""
+    if valor is None or valor == '':
+        return ''
+    if isinstance(valor, bool):
+        valor = 'SI' if valor else 'NO'
+    if isinstance(valor, (int, float)):
+        return f'<c r="{referencia}"><v>{valor}</v></c>'
+    if hasattr(valor, 'is_finite'):
+        # Decimal
+        return f'<c r="{referencia}"><v>{float(valor)}</v></c>'
+    if isinstance(valor, (date, datetime)):
+        valor = valor.isoformat()
+    texto = escape(_CARACTERES_INVALIDOS_XML.sub('', str(valor)))
+    return f'<c r="{referencia}" t="inlineStr"><is><t xml:space="preserve">{texto}</t></is></c>'
+
+_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '</Types>'
+)
+
+_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+
+_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+    '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+    '</Relationships>'
+)
+
+# Estilos mínimos: 0 = normal, 1 = negrita (encabezados)
+_STYLES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/></cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+
+def _workbook_xml(nombre_hoja):
+    return (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        f'<sheets><sheet name="{escape(nombre_hoja[:31])}" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    )
+
+def generar_xlsx(encabezados, filas, nombre_hoja='Stock', filas_por_bloque=FILAS_POR_BLOQUE):
+    """Generar un libro XLSX de una hoja por bloques de bytes
+
+    La hoja se escribe como un miembro zip en modo streaming (descriptor de datos),
+    por lo que solo se mantiene en memoria el bloque de filas en curso.
+    """
+    salida = _BufferSalida()
+    libro = zipfile.ZipFile(salida, 'w', compression=zipfile.ZIP_DEFLATED)
+
+    libro.writestr('[Content_Types].xml', _CONTENT_TYPES)
+    libro.writestr('_rels/.rels', _RELS)
+    libro.writestr('xl/workbook.xml', _workbook_xml(nombre_hoja))
+    libro.writestr('xl/_rels/workbook.xml.rels', _WORKBOOK_RELS)
+    libro.writestr('xl/styles.xml', _STYLES)
+    yield salida.vaciar()
+
+    with libro.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True) as hoja:
+        hoja.write((
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            '<sheetViews><sheetView workbookViewId="0"><pane ySplit="1" topLeftCell="A2" activePane="bottomLeft" state="frozen"/></sheetView></sheetViews>'
+            '<sheetData>'
+        ).encode('utf-8'))
+
+        columnas = [letra_columna(i) for i in range(len(encabezados))]
+        celdas = ''.join(
+            celda_xlsx(f'{col}1', titulo).replace('<c ', '<c s="1" ', 1)
+            for col, titulo in zip(columnas, encabezados)
+        )
+        hoja.write(f'<row r="1">{celdas}</row>'.encode('utf-8'))
+
+        bloque = []
+        for numero, fila in enumerate(filas, 2):
+            while len(columnas) < len(fila):
+                columnas.append(letra_columna(len(columnas)))
+            celdas = ''.join(celda_xlsx(f'{col}{numero}', valor) for col, valor in zip(columnas, fila))
+            bloque.append(f'<row r="{numero}">{celdas}</row>')
+
+            if len(bloque) >= filas_por_bloque:
+                hoja.write(''.join(bloque).encode('utf-8'))
+                bloque = []
+                yield salida.vaciar()
+
+        if bloque:
+            hoja.write(''.join(bloque).encode('utf-8'))
+        hoja.write(b'</sheetData></worksheet>')
+
+    libro.close()
+    yield salida.vaciar()
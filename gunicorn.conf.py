@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Configuración de gunicorn (se carga sola desde el directorio de la aplicación)
+/api/stock/stream mantiene la respuesta abierta hasta SSE_DURACION_MAX_SEG: con el worker
+sync cada formulario abierto ocuparía un worker entero y bloquearía el resto de peticiones.
+Con gthread cada conexión ocupa solo un hilo del worker, y app.py admite a lo sumo
+SSE_MAX_CONEXIONES streams por worker (por defecto la mitad de GUNICORN_THREADS): los demás
+formularios sondean /api/stock-masivo, así siempre quedan hilos para el resto de peticiones.
+No se usa gevent: pyodbc bloquea el proceso durante cada consulta y detendría todos los
+streams y peticiones del worker.
+
+Variables de entorno:
+    GUNICORN_WORKERS  procesos (por defecto WEB_CONCURRENCY o 2)
+    GUNICORN_THREADS  hilos por proceso (por defecto 8, dentro del pool de SQLAlchemy: 5 + 10)
+    PORT              puerto (por defecto 8000)
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('GUNICORN_WORKERS', os.environ.get('WEB_CONCURRENCY', 2)))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Con gthread el timeout vigila al proceso, no a cada petición: un stream largo no lo dispara
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 600))
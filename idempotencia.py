@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Almacén de claves de idempotencia para los registros (salidas, ingresos, devoluciones)
+El cliente envía la cabecera Idempotency-Key con un valor único por envío del formulario;
+el servidor guarda la respuesta exitosa bajo esa clave y la devuelve tal cual ante un
+reintento o un doble clic, sin volver a insertar movimientos.
+Memoria acotada: LRU con vencimiento por TTL. Una petición igual que llega mientras la
+primera sigue en proceso espera su resultado en lugar de ejecutarse otra vez.
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# Respuesta guardada: código HTTP, cuerpo (texto) y tipo de contenido
+RespuestaGuardada = namedtuple('RespuestaGuardada', ['codigo', 'cuerpo', 'tipo'])
+
+PATRON_CLAVE = re.compile(r'^[A-Za-z0-9_.:\-]{8,100}$')
+
+def clave_valida(valor):
+    """Idempotency-Key aceptable: 8 a 100 caracteres alfanuméricos o _ . : -"""
+    return bool(valor) and PATRON_CLAVE.match(valor) is not None
+
+class _Entrada:
+    """Estado de una clave: en proceso (respuesta None) o completada"""
+
+    __slots__ = ('respuesta', 'terminada', 'expira')
+
+    def __init__(self, expira):
+        self.respuesta = None
+        self.terminada = threading.Event()
+        self.expira = expira
+
+class AlmacenIdempotencia:
+    """Claves → respuesta, con tope de entradas y TTL"""
+
+    NUEVA = 'nueva'
+    EN_PROCESO = 'en_proceso'
+    COMPLETADA = 'completada'
+
+    def __init__(self, max_claves=2000, ttl_seg=24 * 3600, reserva_seg=120):
+        self.max_claves = max_claves
+        self.ttl_seg = ttl_seg
+        # Una reserva sin completar vence antes (proceso caído a mitad del registro)
+        self.reserva_seg = reserva_seg
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+        self.repeticiones_total = 0
+        self.desalojos_total = 0
+
+    def reservar(self, clave):
+        """Reservar la clave para procesarla. Retorna (estado, entrada)
+
+        NUEVA: la petición debe ejecutarse y luego completar() o liberar().
+        EN_PROCESO: otra petición con la misma clave está en curso (ver esperar()).
+        COMPLETADA: entrada.respuesta es la respuesta original.
+        """
+        ahora = time.time()
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is not None and entrada.expira > ahora:
+                self._entradas.move_to_end(clave)
+                if entrada.respuesta is not None:
+                    self.repeticiones_total += 1
+                    return self.COMPLETADA, entrada
+                return self.EN_PROCESO, entrada
+
+            entrada = _Entrada(ahora + self.reserva_seg)
+            self._entradas[clave] = entrada
+            self._entradas.move_to_end(clave)
+            self._desalojar(ahora)
+            return self.NUEVA, entrada
+
+    def esperar(self, entrada, espera):
+        """Respuesta de la petición en curso, o None si no terminó en `espera` segundos"""
+        entrada.terminada.wait(espera)
+        if entrada.respuesta is not None:
+            with self._lock:
+                self.repeticiones_total += 1
+        return entrada.respuesta
+
+    def completar(self, clave, respuesta):
+        """Guardar la respuesta de la clave y despertar a quien la espere"""
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is None:
+                entrada = _Entrada(0)
+                self._entradas[clave] = entrada
+            entrada.respuesta = RespuestaGuardada(*respuesta)
+            entrada.expira = time.time() + self.ttl_seg
+            self._entradas.move_to_end(clave)
+            self._desalojar(time.time())
+        entrada.terminada.set()
+
+    def liberar(self, clave):
+        """Descartar la reserva (la petición falló): un reintento se ejecuta de nuevo"""
+        with self._lock:
+            entrada = self._entradas.pop(clave, None)
+        if entrada is not None:
+            entrada.terminada.set()
+
+    def _desalojar(self, ahora):
+        # Vencidas desde el extremo menos usado, y luego las más antiguas hasta el tope
+        while self._entradas:
+            clave, entrada = next(iter(self._entradas.items()))
+            if entrada.expira > ahora and len(self._entradas) <= self.max_claves:
+                break
+            del self._entradas[clave]
+            entrada.terminada.set()
+            self.desalojos_total += 1
+
+    def estado(self):
+        with self._lock:
+            entradas = list(self._entradas.values())
+        return {
+            'claves': len(entradas),
+            'en_proceso': sum(1 for e in entradas if e.respuesta is None),
+            'max_claves': self.max_claves,
+            'ttl_seg': self.ttl_seg,
+            'repeticiones_total': self.repeticiones_total,
+            'desalojos_total': self.desalojos_total
+        }
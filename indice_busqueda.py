@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Índice de búsqueda en memoria para autocompletado de labores y tipos de actividad
+Combina un trie de prefijos (nombre completo y cada palabra) con un índice de
+trigramas para coincidencias por subcadena. Los resultados se ordenan por tipo
+de coincidencia y luego por frecuencia de uso reciente en salidas.
+"""
+
+import threading
+import unicodedata
+
+def normalizar_texto(texto):
+    """Mayúsculas, sin tildes y con espacios simples (comparación insensible a acentos)"""
+    texto = unicodedata.normalize('NFKD', texto or '')
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return ' '.join(texto.upper().split())
+
+def trigramas(texto):
+    """Conjunto de trigramas de un texto ya normalizado"""
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+class _NodoTrie:
+    __slots__ = ('hijos', 'ids')
+
+    def __init__(self):
+        self.hijos = {}
+        self.ids = set()
+
+class _Estructura:
+    """Estructuras inmutables de una carga del índice (se reemplazan completas al recargar)"""
+
+    def __init__(self, registros):
+        self.registros = {}
+        self.nombres = {}
+        self.textos = {}
+        self.raiz_nombres = _NodoTrie()
+        self.raiz_palabras = _NodoTrie()
+        self.trigramas = {}
+
+        for registro in registros:
+            registro_id = registro['id']
+            nombre = normalizar_texto(registro['nombre'])
+            texto = f"{nombre} {normalizar_texto(registro.get('descripcion'))}".strip()
+
+            self.registros[registro_id] = registro
+            self.nombres[registro_id] = nombre
+            self.textos[registro_id] = texto
+
+            self._insertar(self.raiz_nombres, nombre, registro_id)
+            for palabra in set(nombre.split()):
+                self._insertar(self.raiz_palabras, palabra, registro_id)
+            for trigrama in trigramas(texto):
+                self.trigramas.setdefault(trigrama, set()).add(registro_id)
+
+    @staticmethod
+    def _insertar(raiz, clave, registro_id):
+        # Cada nodo guarda los ids de todo su subárbol: la búsqueda por prefijo no recorre hijos
+        nodo = raiz
+        nodo.ids.add(registro_id)
+        for caracter in clave:
+            nodo = nodo.hijos.setdefault(caracter, _NodoTrie())
+            nodo.ids.add(registro_id)
+
+    @staticmethod
+    def prefijo(raiz, clave):
+        nodo = raiz
+        for caracter in clave:
+            nodo = nodo.hijos.get(caracter)
+            if nodo is None:
+                return set()
+        return nodo.ids
+
+    def subcadena(self, clave):
+        """Ids cuyo nombre o descripción contiene la clave"""
+        if len(clave) < 3:
+            candidatos = self.textos.keys()
+        else:
+            conjuntos = sorted((self.trigramas.get(t, set()) for t in trigramas(clave)), key=len)
+            candidatos = set.intersection(*conjuntos) if conjuntos else set()
+        # Verificación final: los trigramas solo descartan, no garantizan la coincidencia
+        return {registro_id for registro_id in candidatos if clave in self.textos[registro_id]}
+
+class IndiceBusqueda:
+    """Índice de autocompletado para un catálogo pequeño (labores, tipos de actividad)"""
+
+    # Prioridad por tipo de coincidencia (menor = mejor)
+    EXACTA, PREFIJO_NOMBRE, PREFIJO_PALABRA, SUBCADENA = range(4)
+
+    def __init__(self, nombre):
+        self.nombre = nombre
+        self._estructura = None
+        self._frecuencias = {}
+        self._lock = threading.Lock()
+        self.cargado_en = None
+
+    @property
+    def cargado(self):
+        return self._estructura is not None
+
+    def cargar(self, registros, frecuencias=None, cargado_en=None):
+        """Reconstruir el índice. registros: dicts con id, nombre y descripcion (más campos libres)
+
+        frecuencias: {nombre: usos recientes}; el nombre se compara normalizado.
+        """
+        estructura = _Estructura(registros)
+        conteo = {}
+        for nombre, usos in (frecuencias or {}).items():
+            clave = normalizar_texto(nombre)
+            conteo[clave] = conteo.get(clave, 0) + int(usos or 0)
+
+        # Reemplazo atómico: las búsquedas en curso siguen usando la estructura anterior
+        with self._lock:
+            self._estructura = estructura
+            self._frecuencias = conteo
+            self.cargado_en = cargado_en
+
+    def invalidar(self):
+        """Marcar el índice para recarga en el próximo acceso"""
+        with self._lock:
+            self._estructura = None
+
+    def registrar_uso(self, nombre):
+        """Sumar un uso (p. ej. al registrar una salida) sin recargar el índice"""
+        clave = normalizar_texto(nombre)
+        if clave:
+            with self._lock:
+                self._frecuencias[clave] = self._frecuencias.get(clave, 0) + 1
+
+    def _orden(self, registro_id, prioridad, estructura):
+        nombre = estructura.nombres[registro_id]
+        return (prioridad, -self._frecuencias.get(nombre, 0), nombre)
+
+    def buscar(self, termino, limite=10):
+        """Registros que coinciden con el término, del más relevante al menos relevante"""
+        estructura = self._estructura
+        if estructura is None:
+            return []
+
+        clave = normalizar_texto(termino)
+        if not clave:
+            return self.mas_usados(limite)
+
+        prioridades = {}
+        for registro_id in estructura.subcadena(clave):
+            prioridades[registro_id] = self.SUBCADENA
+        for registro_id in estructura.prefijo(estructura.raiz_palabras, clave):
+            prioridades[registro_id] = self.PREFIJO_PALABRA
+        for registro_id in estructura.prefijo(estructura.raiz_nombres, clave):
+            prioridades[registro_id] = self.PREFIJO_NOMBRE
+            if estructura.nombres[registro_id] == clave:
+                prioridades[registro_id] = self.EXACTA
+
+        ordenados = sorted(prioridades, key=lambda registro_id: self._orden(registro_id, prioridades[registro_id], estructura))
+        if limite is not None:
+            ordenados = ordenados[:limite]
+        return [estructura.registros[registro_id] for registro_id in ordenados]
+
+    def mas_usados(self, limite=10):
+        """Registros ordenados por frecuencia de uso y luego por nombre"""
+        estructura = self._estructura
+        if estructura is None:
+            return []
+
+        ordenados = sorted(estructura.registros, key=lambda registro_id: self._orden(registro_id, 0, estructura))
+        if limite is not None:
+            ordenados = ordenados[:limite]
+        return [estructura.registros[registro_id] for registro_id in ordenados]
+
+    def todos(self):
+        """Todos los registros ordenados por nombre"""
+        estructura = self._estructura
+        if estructura is None:
+            return []
+        return sorted(estructura.registros.values(), key=lambda registro: registro['nombre'])
+
+    def estado(self):
+        estructura = self._estructura
+        return {
+            'indice': self.nombre,
+            'cargado': estructura is not None,
+            'registros': len(estructura.registros) if estructura else 0,
+            'trigramas': len(estructura.trigramas) if estructura else 0,
+            'nombres_con_uso': len(self._frecuencias),
+            'cargado_en': self.cargado_en
+        }
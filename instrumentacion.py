@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Instrumentación por petición: consultas SQL, tiempo de base de datos y estrategia de stock
+Se engancha a los eventos de SQLAlchemy (todas las conexiones) y al ciclo de
+petición de Flask, y acumula ventanas móviles por endpoint para /admin/metrics.
+"""
+
+import heapq
+import math
+import os
+import threading
+import time
+from collections import deque
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Peticiones que se conservan por endpoint para calcular percentiles
+VENTANA_PETICIONES = int(os.environ.get('METRICAS_VENTANA', 500))
+# Sentencias más lentas que se guardan por petición y por endpoint
+MAX_LENTAS = 5
+LARGO_SQL = 300
+
+# Objetos de stock reconocibles en el SQL -> estrategia registrada
+_ESTRATEGIAS_SQL = (
+    ('stock_saldos', 'stock_saldos'),
+    ('stock_movimientos_turno', 'stock_movimientos_turno'),
+    ('v_stock_actual', 'v_stock_actual'),
+    ('vw_stock_diario_powerbi', 'vistas_powerbi'),
+    ('vw_stock_explosivos_powerbi', 'vistas_powerbi'),
+    ('vw_stock_diario_simple', 'vw_stock_diario_simple'),
+)
+
+_lock = threading.Lock()
+_endpoints = {}
+_instalado = False
+_mostrar_server_timing = None
+
+def _resumir_sql(sentencia):
+    return ' '.join(sentencia.split())[:LARGO_SQL]
+
+def percentil(valores_ordenados, p):
+    """Percentil por rango más cercano sobre una lista ya ordenada"""
+    if not valores_ordenados:
+        return 0
+    indice = max(0, min(len(valores_ordenados) - 1, math.ceil(p / 100.0 * len(valores_ordenados)) - 1))
+    return valores_ordenados[indice]
+
+def registrar_estrategia(nombre):
+    """Anotar la estrategia de stock usada por la petición actual (no-op fuera de una petición)"""
+    if has_request_context():
+        metricas = g.get('_metricas')
+        if metricas is not None:
+            metricas['estrategias'].add(nombre)
+
+def _antes_de_ejecutar(conn, cursor, sentencia, parametros, contexto, executemany):
+    conn.info.setdefault('_inicios_consulta', []).append(time.perf_counter())
+
+def _despues_de_ejecutar(conn, cursor, sentencia, parametros, contexto, executemany):
+    inicios = conn.info.get('_inicios_consulta')
+    if not inicios:
+        return
+    duracion = time.perf_counter() - inicios.pop()
+
+    if not has_request_context():
+        return
+    metricas = g.get('_metricas')
+    if metricas is None:
+        return
+
+    metricas['consultas'] += 1
+    metricas['tiempo_db'] += duracion
+
+    # Estrategia inferida de los objetos consultados
+    sentencia_min = sentencia.lower()
+    for objeto, estrategia in _ESTRATEGIAS_SQL:
+        if objeto in sentencia_min:
+            metricas['estrategias'].add(estrategia)
+
+    lentas = metricas['lentas']
+    entrada = (duracion, metricas['consultas'], sentencia)
+    if len(lentas) < MAX_LENTAS:
+        heapq.heappush(lentas, entrada)
+    elif duracion > lentas[0][0]:
+        heapq.heapreplace(lentas, entrada)
+
+def _inicio_peticion():
+    g._metricas = {
+        'inicio': time.perf_counter(),
+        'consultas': 0,
+        'tiempo_db': 0.0,
+        'lentas': [],
+        'estrategias': set()
+    }
+
+def _fin_peticion(response):
+    metricas = g.pop('_metricas', None)
+    if metricas is None:
+        return response
+
+    duracion = time.perf_counter() - metricas['inicio']
+    endpoint = request.endpoint or request.path
+
+    # Server-Timing: visible en las herramientas de desarrollo del navegador (solo si se permite)
+    if _mostrar_server_timing is not None and _mostrar_server_timing():
+        response.headers['Server-Timing'] = (
+            f'db;dur={metricas["tiempo_db"] * 1000:.1f};desc="{metricas["consultas"]} consultas", '
+            f'total;dur={duracion * 1000:.1f}'
+        )
+
+    with _lock:
+        datos = _endpoints.get(endpoint)
+        if datos is None:
+            datos = _endpoints[endpoint] = {
+                'peticiones': 0,
+                'errores': 0,
+                'duraciones': deque(maxlen=VENTANA_PETICIONES),
+                'consultas': deque(maxlen=VENTANA_PETICIONES),
+                'tiempos_db': deque(maxlen=VENTANA_PETICIONES),
+                'estrategias': {},
+                'lentas': []
+            }
+
+        datos['peticiones'] += 1
+        if response.status_code >= 500:
+            datos['errores'] += 1
+        datos['duraciones'].append(duracion)
+        datos['consultas'].append(metricas['consultas'])
+        datos['tiempos_db'].append(metricas['tiempo_db'])
+        for estrategia in metricas['estrategias']:
+            datos['estrategias'][estrategia] = datos['estrategias'].get(estrategia, 0) + 1
+
+        for lenta_duracion, _, sentencia in metricas['lentas']:
+            entrada = (lenta_duracion, _resumir_sql(sentencia))
+            if len(datos['lentas']) < MAX_LENTAS:
+                heapq.heappush(datos['lentas'], entrada)
+            elif lenta_duracion > datos['lentas'][0][0]:
+                heapq.heapreplace(datos['lentas'], entrada)
+
+    return response
+
+def instalar_instrumentacion(app, mostrar_server_timing=None):
+    """Registrar los eventos de SQLAlchemy y los hooks de petición de Flask
+
+    mostrar_server_timing: función sin argumentos que decide, por petición, si la respuesta
+    lleva la cabecera Server-Timing (sin ella no se envía nunca).
+    """
+    global _instalado, _mostrar_server_timing
+    _mostrar_server_timing = mostrar_server_timing
+
+    if not _instalado:
+        event.listen(Engine, 'before_cursor_execute', _antes_de_ejecutar)
+        event.listen(Engine, 'after_cursor_execute', _despues_de_ejecutar)
+        _instalado = True
+
+    app.before_request(_inicio_peticion)
+    app.after_request(_fin_peticion)
+
+def obtener_metricas():
+    """Resumen por endpoint: percentiles de duración, consultas, tiempo de BD y estrategias"""
+    with _lock:
+        copia = {
+            endpoint: {
+                'peticiones': datos['peticiones'],
+                'errores': datos['errores'],
+                'duraciones': sorted(datos['duraciones']),
+                'consultas': sorted(datos['consultas']),
+                'tiempos_db': sorted(datos['tiempos_db']),
+                'estrategias': dict(datos['estrategias']),
+                'lentas': sorted(datos['lentas'], reverse=True)
+            }
+            for endpoint, datos in _endpoints.items()
+        }
+
+    resumen = []
+    for endpoint, datos in copia.items():
+        muestras = len(datos['duraciones'])
+        resumen.append({
+            'endpoint': endpoint,
+            'peticiones': datos['peticiones'],
+            'errores': datos['errores'],
+            'muestras': muestras,
+            'duracion_ms': {
+                'p50': round(percentil(datos['duraciones'], 50) * 1000, 2),
+                'p90': round(percentil(datos['duraciones'], 90) * 1000, 2),
+                'p99': round(percentil(datos['duraciones'], 99) * 1000, 2),
+                'max': round(datos['duraciones'][-1] * 1000, 2) if muestras else 0
+            },
+            'consultas': {
+                'p50': percentil(datos['consultas'], 50),
+                'p90': percentil(datos['consultas'], 90),
+                'max': datos['consultas'][-1] if muestras else 0,
+                'promedio': round(sum(datos['consultas']) / muestras, 2) if muestras else 0
+            },
+            'tiempo_db_ms': {
+                'p50': round(percentil(datos['tiempos_db'], 50) * 1000, 2),
+                'p90': round(percentil(datos['tiempos_db'], 90) * 1000, 2),
+                'promedio': round(sum(datos['tiempos_db']) / muestras * 1000, 2) if muestras else 0
+            },
+            'estrategias': datos['estrategias'],
+            'sentencias_lentas': [
+                {'duracion_ms': round(duracion * 1000, 2), 'sql': sentencia}
+                for duracion, sentencia in datos['lentas']
+            ]
+        })
+
+    resumen.sort(key=lambda item: item['duracion_ms']['p90'], reverse=True)
+    return resumen
+
+def reiniciar_metricas():
+    with _lock:
+        _endpoints.clear()
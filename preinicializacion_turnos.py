@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pre-inicialización programada de stock_diario por turno
+Un hilo en segundo plano crea los turnos día y noche de todos los explosivos unos
+minutos antes de cada cambio de turno o de fecha, así ninguna petición de usuario
+paga la inicialización. Poco después del cambio se realinean las filas creadas por
+adelantado que no tuvieron movimientos (el saldo pudo cambiar en los últimos minutos
+del turno anterior).
+Las funciones de base de datos las entrega app.py (evita el import circular).
+"""
+
+import threading
+import time
+from datetime import datetime, date, time as dtime, timedelta
+
+# Horas en que cambia la fecha o la guardia (ver obtener_guardia_actual en app.py)
+LIMITES_TURNO = (0, 6, 18)
+
+def siguiente_limite_turno(ahora):
+    """Próximo cambio de turno o de fecha estrictamente posterior a `ahora`"""
+    for hora in LIMITES_TURNO:
+        limite = datetime.combine(ahora.date(), dtime(hora))
+        if limite > ahora:
+            return limite
+    return datetime.combine(ahora.date() + timedelta(days=1), dtime(LIMITES_TURNO[0]))
+
+class PreinicializadorTurnos:
+    """
+    Agenda del hilo pre-inicializador
+
+    - preinicializar(fecha, anticipado): crea los turnos que falten de `fecha`
+    - realinear(fecha): ajusta al saldo vigente las filas anticipadas sin movimientos
+    - Al arrancar se asegura el día en curso; una petición que no encuentra su turno
+      lo pide con solicitar() y sigue con el cálculo directo, sin esperar
+    """
+
+    def __init__(self, preinicializar, realinear, antelacion_seg=300, margen_seg=5):
+        self._preinicializar = preinicializar
+        self._realinear = realinear
+        self.antelacion = timedelta(seconds=antelacion_seg)
+        self.margen = timedelta(seconds=margen_seg)
+        self._condicion = threading.Condition()
+        self._solicitadas = set()
+        self._hilo = None
+        self._detenido = False
+        self.ejecuciones_total = 0
+        self.filas_creadas_total = 0
+        self.errores_total = 0
+        self.ultimo_error = None
+        self.ultima_ejecucion = None
+        self.proximo_limite = None
+
+    def asegurar_hilo(self):
+        """Arranca el hilo bajo demanda (después del fork de gunicorn)"""
+        if self._hilo is None or not self._hilo.is_alive():
+            with self._condicion:
+                if self._hilo is None or not self._hilo.is_alive():
+                    self._detenido = False
+                    self._hilo = threading.Thread(target=self._trabajar, name='preinicializacion-turnos', daemon=True)
+                    self._hilo.start()
+
+    def solicitar(self, fecha):
+        """Pedir la inicialización de una fecha sin esperarla"""
+        with self._condicion:
+            self._solicitadas.add(fecha)
+            self._condicion.notify()
+        self.asegurar_hilo()
+
+    def detener(self):
+        with self._condicion:
+            self._detenido = True
+            self._condicion.notify()
+
+    def _ejecutar(self, accion, fecha, *args):
+        inicio = time.time()
+        try:
+            filas = accion(fecha, *args) or 0
+            self.ejecuciones_total += 1
+            self.filas_creadas_total += filas if accion is self._preinicializar else 0
+            self.ultima_ejecucion = {
+                'accion': accion.__name__,
+                'fecha': fecha.isoformat(),
+                'filas': filas,
+                'duracion_ms': round((time.time() - inicio) * 1000, 1),
+                'en': datetime.now().isoformat(timespec='seconds')
+            }
+        except Exception as e:
+            self.errores_total += 1
+            self.ultimo_error = f"{datetime.now().isoformat(timespec='seconds')} {accion.__name__} {fecha}: {e}"
+            print(f"⚠️ Error en pre-inicialización de turnos ({fecha}): {e}")
+
+    def _trabajar(self):
+        self._ejecutar(self._preinicializar, date.today(), False)
+        preparado = None      # último límite ya pre-inicializado
+        realinear_en = None   # (momento, fecha) pendiente tras el último límite
+
+        while not self._detenido:
+            with self._condicion:
+                solicitadas, self._solicitadas = self._solicitadas, set()
+            for fecha in sorted(solicitadas):
+                self._ejecutar(self._preinicializar, fecha, False)
+
+            ahora = datetime.now()
+            limite = siguiente_limite_turno(ahora)
+            self.proximo_limite = limite.isoformat()
+
+            if realinear_en and ahora >= realinear_en[0]:
+                self._ejecutar(self._realinear, realinear_en[1])
+                realinear_en = None
+                continue
+
+            if limite != preparado and ahora >= limite - self.antelacion:
+                self._ejecutar(self._preinicializar, limite.date(), True)
+                preparado = limite
+                realinear_en = (limite + self.margen, limite.date())
+                continue
+
+            # Dormir hasta la próxima tarea (máx. 1 h: tolera cambios de hora del sistema)
+            proxima = limite - self.antelacion if limite != preparado else siguiente_limite_turno(limite) - self.antelacion
+            if realinear_en:
+                proxima = min(proxima, realinear_en[0])
+            espera = min(max((proxima - ahora).total_seconds(), 0.5), 3600)
+            with self._condicion:
+                if not self._solicitadas and not self._detenido:
+                    self._condicion.wait(espera)
+
+    def estado(self):
+        return {
+            'activo': self._hilo is not None and self._hilo.is_alive(),
+            'antelacion_seg': int(self.antelacion.total_seconds()),
+            'proximo_limite': self.proximo_limite,
+            'solicitudes_pendientes': len(self._solicitadas),
+            'ejecuciones_total': self.ejecuciones_total,
+            'filas_creadas_total': self.filas_creadas_total,
+            'errores_total': self.errores_total,
+            'ultimo_error': self.ultimo_error,
+            'ultima_ejecucion': self.ultima_ejecucion
+        }
@@ -3,15 +3,46 @@
 """
 Función para recalcular automáticamente stock_diario cuando hay cambios
 Mantiene la tabla sincronizada con los movimientos reales
+
+Modos:
+    python recalcular_stock_automatico.py                  # completo desde el primer movimiento
+    python recalcular_stock_automatico.py --desde 2025-08-01
+    python recalcular_stock_automatico.py --incremental    # solo desde las marcas de stock_recalculo_pendiente
+    python recalcular_stock_automatico.py --motor turnos   # motor anterior (turno por turno)
+    python recalcular_stock_automatico.py --dry-run --exportar diferencias.csv   # solo reportar
+    python recalcular_stock_automatico.py --procesos 4     # lotes de explosivos en paralelo
+
+El motor por defecto ('acumulado', stock_acumulado.py) carga los totales por turno en
+una sola consulta agrupada, calcula los saldos con una suma acumulada por explosivo
+y escribe solo las filas que cambian.
 """
 
 import sys
 import os
+import argparse
+import csv
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 sys.path.append('.')
 
+from collections import namedtuple
 from datetime import datetime, date, timedelta
-from app import app, db, StockDiario, Explosivo, Ingreso, Salida, Devolucion
+from app import (app, db, StockDiario, Explosivo, Ingreso, Salida, Devolucion, obtener_capacidades,
+                 ultima_fila_stock_diario, stock_diario_disperso, dividir_en_lotes, sql_fecha)
 from sqlalchemy import text
+from reconstruir_stock_saldos import movimientos_por_turno_sql
+from stock_acumulado import (calcular_saldos_acumulados, comparar_con_existentes, valores_distintos,
+                             detectar_rupturas_continuidad, resumir_diferencias, clave_turno)
+
+# Explosivos por lote en el recálculo incremental con el motor acumulado (cada lote es un checkpoint)
+LOTE_EXPLOSIVOS_INCREMENTAL = 20
+
+# Filas del diff que se muestran en pantalla con --dry-run
+FILAS_DIFF_PANTALLA = 20
+
+# Recálculo en paralelo: cada tarea es un lote de explosivos (memoria acotada por trabajador)
+PROCESOS_RECALCULO = int(os.environ.get('RECALCULO_PROCESOS', 1))
+LOTE_EXPLOSIVOS_PARALELO = int(os.environ.get('RECALCULO_LOTE_EXPLOSIVOS', 25))
 
 def recalcular_stock_diario_completo(fecha_desde=None):
     """Recalcula completamente stock_diario desde una fecha"""
@@ -21,33 +52,33 @@ def recalcular_stock_diario_completo(fecha_desde=None):
         
         if fecha_desde is None:
             # Obtener primera fecha con movimientos
-            query_primera_fecha = text("""
+            query_primera_fecha = text(f"""
                 SELECT MIN(fecha_minima) as primera_fecha
                 FROM (
-                    SELECT MIN(CAST(fecha_ingreso AS DATE)) as fecha_minima FROM ingresos
+                    SELECT MIN({sql_fecha('fecha_ingreso')}) as fecha_minima FROM ingresos
                     UNION ALL
-                    SELECT MIN(CAST(fecha_salida AS DATE)) as fecha_minima FROM salidas
+                    SELECT MIN({sql_fecha('fecha_salida')}) as fecha_minima FROM salidas
                     UNION ALL  
-                    SELECT MIN(CAST(fecha_devolucion AS DATE)) as fecha_minima FROM devoluciones
+                    SELECT MIN({sql_fecha('fecha_devolucion')}) as fecha_minima FROM devoluciones
                 ) fechas
             """)
-            fecha_desde = db.session.execute(query_primera_fecha).scalar()
+            fecha_desde = normalizar_fecha_sql(db.session.execute(query_primera_fecha).scalar())
         
         if not fecha_desde:
             print("❌ No hay movimientos en la base de datos")
-            return
+            return 0
         
         print(f"📅 Recalculando desde: {fecha_desde}")
         
         # Obtener todas las fechas con movimientos
-        query_fechas = text("""
+        query_fechas = text(f"""
             SELECT DISTINCT fecha, COUNT(*) as movimientos
             FROM (
-                SELECT CAST(fecha_ingreso AS DATE) as fecha FROM ingresos
+                SELECT {sql_fecha('fecha_ingreso')} as fecha FROM ingresos
                 UNION ALL
-                SELECT CAST(fecha_salida AS DATE) as fecha FROM salidas  
+                SELECT {sql_fecha('fecha_salida')} as fecha FROM salidas  
                 UNION ALL
-                SELECT CAST(d.fecha_devolucion AS DATE) as fecha FROM devoluciones d
+                SELECT {sql_fecha('d.fecha_devolucion')} as fecha FROM devoluciones d
             ) todas_fechas
             WHERE fecha >= :fecha_desde
             GROUP BY fecha
@@ -61,7 +92,7 @@ def recalcular_stock_diario_completo(fecha_desde=None):
         total_procesados = 0
         
         for fecha_row in fechas_movimientos:
-            fecha_actual = fecha_row[0]
+            fecha_actual = normalizar_fecha_sql(fecha_row[0])
             print(f"\n🔧 Procesando {fecha_actual}...")
             
             # Procesar día y noche para esta fecha
@@ -76,35 +107,476 @@ def recalcular_stock_diario_completo(fecha_desde=None):
         print(f"   ✅ {total_procesados} registros procesados")
         print(f"   ✅ Stock_diario sincronizado con movimientos")
         print(f"   ✅ Continuidad automática establecida")
+        return total_procesados
+
+# Marca leída de stock_recalculo_pendiente: fecha "sucio desde" y fecha_actualizacion tal
+# como está guardada (versión para el compare-and-swap de avanzar_marca)
+Marca = namedtuple('Marca', ['desde', 'version'])
+
+def leer_marcas_pendientes():
+    """Marcas "sucio desde" por explosivo: {explosivo_id: Marca}"""
+    if not obtener_capacidades(forzar=True)['stock_recalculo_pendiente']:
+        return None
+
+    result = db.session.execute(text("""
+        SELECT explosivo_id, sucio_desde, fecha_actualizacion
+        FROM stock_recalculo_pendiente
+    """)).fetchall()
+    return {row.explosivo_id: Marca(normalizar_fecha_sql(row.sucio_desde), row.fecha_actualizacion) for row in result}
+
+def normalizar_fecha_sql(valor):
+    """Fechas leídas con text(): date en SQL Server, texto ISO en otros drivers"""
+    if isinstance(valor, datetime):
+        return valor.date()
+    if isinstance(valor, str):
+        return date.fromisoformat(valor[:10])
+    return valor
+
+def avanzar_marca(explosivo_id, marca_leida, nueva_marca):
+    """Adelantar la marca solo si nadie la tocó desde que se leyó (compare-and-swap).
+
+    Se compara fecha_actualizacion, no sucio_desde: marcar un movimiento siempre la
+    cambia, aunque la fecha del movimiento no sea anterior a la marca. nueva_marca=None
+    elimina la marca (explosivo al día). Retorna la Marca guardada (True al eliminar), o
+    None si un movimiento concurrente la tocó: ese explosivo queda para la próxima ejecución.
+    """
+    # DATETIME de SQL Server guarda en pasos de 1/300 s: el valor leído se compara convertido al mismo tipo
+    version = 'CAST(:leida AS DATETIME)' if db.engine.dialect.name == 'mssql' else ':leida'
+    params = {'explosivo_id': explosivo_id, 'leida': marca_leida.version, 'nueva': nueva_marca, 'ahora': datetime.now()}
+    if nueva_marca is None:
+        result = db.session.execute(text(f"""
+            DELETE FROM stock_recalculo_pendiente
+            WHERE explosivo_id = :explosivo_id AND fecha_actualizacion = {version}
+        """), params)
+        db.session.commit()
+        return True if result.rowcount > 0 else None
+
+    result = db.session.execute(text(f"""
+        UPDATE stock_recalculo_pendiente
+        SET sucio_desde = :nueva, fecha_actualizacion = :ahora
+        WHERE explosivo_id = :explosivo_id AND fecha_actualizacion = {version}
+    """), params)
+    if result.rowcount == 0:
+        db.session.commit()
+        return None
+    guardada = db.session.execute(text("""
+        SELECT fecha_actualizacion FROM stock_recalculo_pendiente WHERE explosivo_id = :explosivo_id
+    """), params).scalar()
+    db.session.commit()
+    return Marca(nueva_marca, guardada)
+
+def obtener_fechas_a_recorrer(fecha_desde):
+    """Fechas con stock_diario o con movimientos desde fecha_desde, en orden"""
+    if obtener_capacidades()['stock_movimientos_turno']:
+        query = text("""
+            SELECT fecha FROM stock_diario WHERE fecha >= :fecha_desde
+            UNION
+            SELECT fecha FROM stock_movimientos_turno WHERE fecha >= :fecha_desde
+            ORDER BY fecha
+        """)
+    else:
+        query = text(f"""
+            SELECT fecha FROM stock_diario WHERE fecha >= :fecha_desde
+            UNION
+            SELECT {sql_fecha('fecha_ingreso')} FROM ingresos WHERE fecha_ingreso >= :fecha_desde
+            UNION
+            SELECT {sql_fecha('fecha_salida')} FROM salidas WHERE fecha_salida >= :fecha_desde
+            UNION
+            SELECT {sql_fecha('fecha_devolucion')} FROM devoluciones WHERE fecha_devolucion >= :fecha_desde
+            ORDER BY fecha
+        """)
+    return [normalizar_fecha_sql(row[0]) for row in db.session.execute(query, {'fecha_desde': fecha_desde}).fetchall()]
+
+def recalcular_stock_incremental(motor='acumulado', dry_run=False, exportar=None):
+    """Recalcula stock_diario solo desde la marca "sucio desde" de cada explosivo.
+
+    Motor 'turnos': después de cada fecha procesada se adelantan las marcas (checkpoint);
+    si la ejecución se corta, la siguiente retoma desde la última fecha confirmada.
+    Motor 'acumulado': se recalculan lotes de explosivos de una pasada y se quita
+    la marca de cada lote confirmado.
+    """
+
+    with app.app_context():
+        print("=== RECÁLCULO INCREMENTAL STOCK_DIARIO ===\n")
+
+        marcas = leer_marcas_pendientes()
+        if marcas is None:
+            print("❌ No existe stock_recalculo_pendiente (database_scripts/13_crear_tabla_stock_recalculo_pendiente.sql)")
+            print("   Use el recálculo completo")
+            return 0
+        if not marcas:
+            print("✅ No hay explosivos pendientes de recálculo")
+            return 0
+
+        if motor == 'acumulado':
+            return recalcular_incremental_acumulado(marcas, dry_run, exportar)
+
+        fecha_inicio = min(marca.desde for marca in marcas.values())
+        fechas = obtener_fechas_a_recorrer(fecha_inicio)
+        print(f"📅 {len(marcas)} explosivos pendientes, recorriendo {len(fechas)} fechas desde {fecha_inicio}")
+
+        total_procesados = 0
+        for fecha_actual in fechas:
+            # Explosivos cuya marca ya alcanzó esta fecha
+            explosivos_ids = sorted(e for e, marca in marcas.items() if marca.desde <= fecha_actual)
+            if not explosivos_ids:
+                continue
+
+            for guardia in ['dia', 'noche']:
+                total_procesados += procesar_stock_fecha_guardia(fecha_actual, guardia, explosivos_ids)
+
+            # Checkpoint: la fecha quedó confirmada para estos explosivos
+            siguiente = fecha_actual + timedelta(days=1)
+            for explosivo_id in explosivos_ids:
+                nueva = avanzar_marca(explosivo_id, marcas[explosivo_id], siguiente)
+                if nueva:
+                    marcas[explosivo_id] = nueva
+                else:
+                    print(f"   ⚠️ Explosivo {explosivo_id}: nuevo movimiento durante el recálculo, queda pendiente")
+                    del marcas[explosivo_id]
+
+            print(f"   ✅ {fecha_actual}: {len(explosivos_ids)} explosivos")
+
+        # Explosivos al día: quitar su marca (salvo que un movimiento la haya bajado)
+        al_dia = sum(1 for explosivo_id, marca in marcas.items() if avanzar_marca(explosivo_id, marca, None))
+
+        print(f"\n🎯 RECÁLCULO INCREMENTAL COMPLETADO:")
+        print(f"   ✅ {total_procesados} registros procesados")
+        print(f"   ✅ {al_dia} explosivos al día")
+        return total_procesados
+
+def recalcular_incremental_acumulado(marcas, dry_run=False, exportar=None):
+    """Motor acumulado sobre las marcas pendientes, por lotes de explosivos (dentro de app_context)"""
+    desde = min(marca.desde for marca in marcas.values())
+    print(f"📅 {len(marcas)} explosivos pendientes desde {desde}")
+
+    if dry_run:
+        # Un solo diff de todos los pendientes; las marcas no se tocan
+        return aplicar_recalculo_acumulado(desde, sorted(marcas), dry_run=True, exportar=exportar)
+
+    explosivos_ordenados = sorted(marcas, key=lambda explosivo_id: (marcas[explosivo_id].desde, explosivo_id))
+
+    total_cambios = 0
+    al_dia = 0
+    for i in range(0, len(explosivos_ordenados), LOTE_EXPLOSIVOS_INCREMENTAL):
+        lote = explosivos_ordenados[i:i + LOTE_EXPLOSIVOS_INCREMENTAL]
+        resumen = aplicar_recalculo_acumulado(min(marcas[e].desde for e in lote), lote)
+        total_cambios += resumen['actualizadas'] + resumen['insertadas']
+
+        # Checkpoint: el lote quedó confirmado
+        for explosivo_id in lote:
+            if avanzar_marca(explosivo_id, marcas[explosivo_id], None):
+                al_dia += 1
+            else:
+                print(f"   ⚠️ Explosivo {explosivo_id}: nuevo movimiento durante el recálculo, queda pendiente")
+
+        print(f"   ✅ Lote {i // LOTE_EXPLOSIVOS_INCREMENTAL + 1}: {len(lote)} explosivos, "
+              f"{resumen['actualizadas']} filas actualizadas, {resumen['insertadas']} insertadas")
+
+    print(f"\n🎯 RECÁLCULO INCREMENTAL COMPLETADO:")
+    print(f"   ✅ {total_cambios} filas de stock_diario modificadas")
+    print(f"   ✅ {al_dia} explosivos al día")
+    return total_cambios
+
+def filtro_explosivos(columna, explosivos_ids, params):
+    """Fragmento 'AND columna IN (...)' con parámetros nombrados (vacío si no hay filtro)"""
+    if explosivos_ids is None:
+        return ''
+    ids = sorted(set(explosivos_ids))
+    for i, explosivo_id in enumerate(ids):
+        params[f'exp_{i}'] = explosivo_id
+    placeholders = ','.join([f':exp_{i}' for i in range(len(ids))]) or 'NULL'
+    return f' AND {columna} IN ({placeholders})'
+
+def cargar_movimientos_por_turno(fecha_desde=None, explosivos_ids=None):
+    """Totales de movimientos por (explosivo, fecha, guardia) en una sola consulta agrupada"""
+    params = {'fecha_desde': fecha_desde or date.min}
+    if obtener_capacidades()['stock_movimientos_turno']:
+        query = """
+            SELECT explosivo_id, fecha, guardia, ingresos, salidas, devoluciones
+            FROM stock_movimientos_turno
+            WHERE fecha >= :fecha_desde
+        """ + filtro_explosivos('explosivo_id', explosivos_ids, params)
+    else:
+        query = f"""
+            SELECT m.explosivo_id, m.fecha, m.guardia,
+                   SUM(m.ingresos) AS ingresos, SUM(m.salidas) AS salidas, SUM(m.devoluciones) AS devoluciones
+            FROM ({movimientos_por_turno_sql()}) m
+            WHERE m.explosivo_id IS NOT NULL AND m.fecha >= :fecha_desde
+            {filtro_explosivos('m.explosivo_id', explosivos_ids, params)}
+            GROUP BY m.explosivo_id, m.fecha, m.guardia
+        """
+
+    return [
+        (row.explosivo_id, normalizar_fecha_sql(row.fecha), row.guardia, row.ingresos, row.salidas, row.devoluciones)
+        for row in db.session.execute(text(query), params).fetchall()
+    ]
+
+def cargar_saldos_previos(fecha_desde, explosivos_ids=None):
+    """Stock de cada explosivo antes de fecha_desde (suma de todos los movimientos anteriores)"""
+    if fecha_desde is None:
+        return {}
+
+    params = {'fecha_desde': fecha_desde}
+    if obtener_capacidades()['stock_movimientos_turno']:
+        query = """
+            SELECT explosivo_id, SUM(ingresos - salidas + devoluciones) AS saldo
+            FROM stock_movimientos_turno
+            WHERE fecha < :fecha_desde
+        """ + filtro_explosivos('explosivo_id', explosivos_ids, params) + " GROUP BY explosivo_id"
+    else:
+        query = f"""
+            SELECT m.explosivo_id, SUM(m.ingresos - m.salidas + m.devoluciones) AS saldo
+            FROM ({movimientos_por_turno_sql()}) m
+            WHERE m.explosivo_id IS NOT NULL AND m.fecha < :fecha_desde
+            {filtro_explosivos('m.explosivo_id', explosivos_ids, params)}
+            GROUP BY m.explosivo_id
+        """
+
+    return {row.explosivo_id: float(row.saldo or 0) for row in db.session.execute(text(query), params).fetchall()}
+
+def cargar_stock_diario(fecha_desde=None, explosivos_ids=None):
+    """Filas actuales de stock_diario: {(explosivo_id, fecha, guardia): (id, stock_inicial, stock_final)}"""
+    params = {'fecha_desde': fecha_desde or date.min}
+    query = """
+        SELECT id, explosivo_id, fecha, guardia, stock_inicial, stock_final
+        FROM stock_diario
+        WHERE fecha >= :fecha_desde
+    """ + filtro_explosivos('explosivo_id', explosivos_ids, params)
+
+    return {
+        (row.explosivo_id, normalizar_fecha_sql(row.fecha), row.guardia): (row.id, row.stock_inicial, row.stock_final)
+        for row in db.session.execute(text(query), params).fetchall()
+    }
+
+# Parámetros que envía cada fila. Con pyodbc (marcadores ?) un nombre repetido en la
+# sentencia se envía una vez por aparición: :id va 3 veces en el UPDATE, y :observaciones
+# y :ahora van en cada tupla VALUES del INSERT.
+PARAMETROS_FILA_ACTUALIZAR = 5
+PARAMETROS_FILA_INSERTAR = 7
+
+def sentencia_actualizar_stock_diario(lote, observaciones):
+    """UPDATE con CASE por id de un lote: una sentencia (sintaxis válida en SQL Server y SQLite)"""
+    params = {'observaciones': observaciones}
+    casos_inicial, casos_final, ids = [], [], []
+    for i, (registro_id, _, _, nuevo) in enumerate(lote):
+        params[f'id_{i}'] = registro_id
+        params[f'ini_{i}'] = nuevo[0]
+        params[f'fin_{i}'] = nuevo[1]
+        casos_inicial.append(f"WHEN :id_{i} THEN :ini_{i}")
+        casos_final.append(f"WHEN :id_{i} THEN :fin_{i}")
+        ids.append(f":id_{i}")
+
+    return text(f"""
+        UPDATE stock_diario
+        SET stock_inicial = CASE id {' '.join(casos_inicial)} END,
+            stock_final = CASE id {' '.join(casos_final)} END,
+            observaciones = :observaciones
+        WHERE id IN ({','.join(ids)})
+    """), params
+
+def sentencia_insertar_stock_diario(lote, observaciones, ahora):
+    """INSERT de varias filas de un lote en una sentencia"""
+    params = {'observaciones': observaciones, 'ahora': ahora}
+    valores = []
+    for i, (clave, nuevo) in enumerate(lote):
+        params[f'exp_{i}'] = clave[0]
+        params[f'fecha_{i}'] = clave[1]
+        params[f'guardia_{i}'] = clave[2]
+        params[f'ini_{i}'] = nuevo[0]
+        params[f'fin_{i}'] = nuevo[1]
+        valores.append(f"(:exp_{i}, :fecha_{i}, :guardia_{i}, :ini_{i}, :fin_{i}, 'Sistema', :observaciones, :ahora)")
+
+    return text(f"""
+        INSERT INTO stock_diario (explosivo_id, fecha, guardia, stock_inicial, stock_final, responsable_guardia, observaciones, fecha_registro)
+        VALUES {', '.join(valores)}
+    """), params
+
+def escribir_cambios_stock_diario(actualizar, insertar):
+    """Aplicar solo las filas que cambian con UPDATE/INSERT por conjuntos, en lotes, en una transacción"""
+    ahora = datetime.now()
 
-def procesar_stock_fecha_guardia(fecha, guardia):
-    """Procesa stock para una fecha y guardia específica"""
+    for lote in dividir_en_lotes(actualizar, PARAMETROS_FILA_ACTUALIZAR, parametros_fijos=1):
+        db.session.execute(*sentencia_actualizar_stock_diario(lote, f"Recalculado automáticamente - {ahora}"))
+
+    for lote in dividir_en_lotes(insertar, PARAMETROS_FILA_INSERTAR):
+        db.session.execute(*sentencia_insertar_stock_diario(lote, f"Creado automáticamente - {ahora}", ahora))
+
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+
+def reportar_diferencias(actualizar, insertar, rupturas, exportar=None):
+    """Imprimir (y opcionalmente exportar a CSV) el diff calculado sin escribir nada"""
+    resumen = resumir_diferencias(actualizar, insertar, rupturas)
+
+    print("\n🔍 DRY-RUN: no se escribió nada en stock_diario")
+    print(f"   📝 {resumen['actualizar']} filas a actualizar, {resumen['insertar']} a insertar "
+          f"({resumen['explosivos_afectados']} explosivos)")
+    print(f"   📏 Diferencia por fila (inicial o final): máx {resumen['delta_max']}, total {resumen['delta_total']}")
+    print(f"   🔗 {resumen['rupturas_continuidad']} rupturas de continuidad en los datos actuales")
+
+    for _, clave, anterior, nuevo in actualizar[:FILAS_DIFF_PANTALLA]:
+        print(f"   • {clave[0]} {clave[1]} {clave[2]}: {anterior[0]} → {nuevo[0]} / {anterior[1]} → {nuevo[1]}")
+    if len(actualizar) > FILAS_DIFF_PANTALLA:
+        print(f"   ... y {len(actualizar) - FILAS_DIFF_PANTALLA} más")
+
+    if exportar:
+        filas = [('actualizar', clave, anterior, nuevo) for _, clave, anterior, nuevo in actualizar]
+        filas += [('insertar', clave, (None, None), nuevo) for clave, nuevo in insertar]
+        filas += [('ruptura', clave, (None, final_anterior), (inicial, None)) for clave, final_anterior, inicial in rupturas]
+        filas.sort(key=lambda fila: (fila[1][0], clave_turno(fila[1][1], fila[1][2]), fila[0]))
+
+        with open(exportar, 'w', newline='', encoding='utf-8') as archivo:
+            escritor = csv.writer(archivo)
+            escritor.writerow(['accion', 'explosivo_id', 'fecha', 'guardia', 'stock_inicial_actual', 'stock_final_actual',
+                               'stock_inicial_nuevo', 'stock_final_nuevo'])
+            for accion, clave, anterior, nuevo in filas:
+                escritor.writerow([accion, clave[0], clave[1], clave[2], anterior[0], anterior[1], nuevo[0], nuevo[1]])
+        print(f"   💾 Diferencias exportadas a {exportar}")
+
+    return resumen
+
+def calcular_diff_acumulado(fecha_desde=None, explosivos_ids=None):
+    """Estado objetivo y diferencias contra stock_diario (3 lecturas agrupadas, sin escrituras)"""
+    movimientos = cargar_movimientos_por_turno(fecha_desde, explosivos_ids)
+    existentes = cargar_stock_diario(fecha_desde, explosivos_ids)
+    saldos_previos = cargar_saldos_previos(fecha_desde, explosivos_ids)
+
+    objetivo = calcular_saldos_acumulados(movimientos, existentes.keys(), saldos_previos)
+    actualizar, insertar = comparar_con_existentes(objetivo, existentes)
+    return objetivo, actualizar, insertar, existentes
+
+def aplicar_recalculo_acumulado(fecha_desde=None, explosivos_ids=None, dry_run=False, exportar=None):
+    """Motor acumulado: 3 lecturas agrupadas, suma acumulada en memoria y escritura solo de diferencias"""
+    objetivo, actualizar, insertar, existentes = calcular_diff_acumulado(fecha_desde, explosivos_ids)
+
+    if dry_run:
+        return reportar_diferencias(actualizar, insertar, detectar_rupturas_continuidad(existentes), exportar)
+
+    escribir_cambios_stock_diario(actualizar, insertar)
+
+    return {
+        'turnos': len(objetivo),
+        'actualizadas': len(actualizar),
+        'insertadas': len(insertar),
+        'sin_cambios': len(objetivo) - len(actualizar) - len(insertar)
+    }
+
+def recalcular_stock_acumulado(fecha_desde=None, explosivos_ids=None, dry_run=False, exportar=None):
+    """Recalcula stock_diario con el motor acumulado (todo el historial o desde una fecha)"""
+
+    with app.app_context():
+        print("=== RECÁLCULO ACUMULADO STOCK_DIARIO ===\n")
+        print(f"📅 Recalculando desde: {fecha_desde or 'el primer movimiento'}")
+
+        resumen = aplicar_recalculo_acumulado(fecha_desde, explosivos_ids, dry_run, exportar)
+        if dry_run:
+            return resumen
+
+        print(f"\n🎯 RECÁLCULO COMPLETADO:")
+        print(f"   ✅ {resumen['turnos']} turnos evaluados")
+        print(f"   ✅ {resumen['actualizadas']} filas actualizadas, {resumen['insertadas']} insertadas")
+        print(f"   ✅ {resumen['sin_cambios']} filas ya correctas (sin escritura)")
+        return resumen
+
+def _inicializar_trabajador():
+    """Cada proceso trabajador abre sus propias conexiones (nunca las heredadas del padre)"""
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+def _recalcular_lote(indice, explosivos_ids, fecha_desde, dry_run):
+    """Tarea de un trabajador: recalcular (o solo comparar) un lote de explosivos"""
+    with app.app_context():
+        objetivo, actualizar, insertar, existentes = calcular_diff_acumulado(fecha_desde, explosivos_ids)
+        if dry_run:
+            return indice, {'turnos': len(objetivo)}, (actualizar, insertar, detectar_rupturas_continuidad(existentes))
+
+        escribir_cambios_stock_diario(actualizar, insertar)
+        db.session.remove()
+        return indice, {
+            'turnos': len(objetivo),
+            'actualizadas': len(actualizar),
+            'insertadas': len(insertar),
+            'sin_cambios': len(objetivo) - len(actualizar) - len(insertar)
+        }, None
+
+def recalcular_stock_paralelo(fecha_desde=None, procesos=None, dry_run=False, exportar=None):
+    """Motor acumulado repartido por explosivo en un pool de procesos.
+
+    La cadena de stock de cada explosivo es independiente: los explosivos se dividen en
+    lotes ordenados y cada trabajador toma un lote a la vez con su propia conexión.
+    El resumen se combina en el orden de los lotes (resultado determinista).
+    """
+    procesos = procesos or PROCESOS_RECALCULO
+
+    with app.app_context():
+        print("=== RECÁLCULO ACUMULADO PARALELO STOCK_DIARIO ===\n")
+        print(f"📅 Recalculando desde: {fecha_desde or 'el primer movimiento'}")
+        obtener_capacidades(forzar=True)
+        explosivos_ids = [row[0] for row in db.session.execute(text("SELECT id FROM explosivos ORDER BY id")).fetchall()]
+        db.session.remove()
+
+    lotes = [explosivos_ids[i:i + LOTE_EXPLOSIVOS_PARALELO]
+             for i in range(0, len(explosivos_ids), LOTE_EXPLOSIVOS_PARALELO)]
+    print(f"⚙️ {len(explosivos_ids)} explosivos en {len(lotes)} lotes, {procesos} procesos")
+
+    # Se liberan las conexiones del padre antes de crear los trabajadores
+    with app.app_context():
+        db.engine.dispose()
+
+    resultados = {}
+    with ProcessPoolExecutor(max_workers=procesos, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_inicializar_trabajador) as pool:
+        tareas = [pool.submit(_recalcular_lote, i, lote, fecha_desde, dry_run) for i, lote in enumerate(lotes)]
+        for tarea in tareas:
+            indice, resumen, diff = tarea.result()
+            resultados[indice] = (resumen, diff)
+            print(f"   ✅ Lote {indice + 1}/{len(lotes)}: {resumen['turnos']} turnos")
+
+    if dry_run:
+        actualizar, insertar, rupturas = [], [], []
+        for indice in sorted(resultados):
+            lote_actualizar, lote_insertar, lote_rupturas = resultados[indice][1]
+            actualizar.extend(lote_actualizar)
+            insertar.extend(lote_insertar)
+            rupturas.extend(lote_rupturas)
+        return reportar_diferencias(actualizar, insertar, rupturas, exportar)
+
+    total = {'turnos': 0, 'actualizadas': 0, 'insertadas': 0, 'sin_cambios': 0}
+    for indice in sorted(resultados):
+        for campo in total:
+            total[campo] += resultados[indice][0][campo]
+
+    print(f"\n🎯 RECÁLCULO COMPLETADO:")
+    print(f"   ✅ {total['turnos']} turnos evaluados en {len(lotes)} lotes")
+    print(f"   ✅ {total['actualizadas']} filas actualizadas, {total['insertadas']} insertadas")
+    print(f"   ✅ {total['sin_cambios']} filas ya correctas (sin escritura)")
+    return total
+
+def procesar_stock_fecha_guardia(fecha, guardia, explosivos_ids=None):
+    """Procesa stock para una fecha y guardia específica
+    
+    Si se indican explosivos_ids, solo se recalculan esos explosivos
+    (sincronización consolidada después de registrar movimientos).
+    """
     
     procesados = 0
     
     # Obtener explosivos que tuvieron movimientos en esta fecha/guardia
-    query_explosivos = text("""
-        SELECT DISTINCT explosivo_id
-        FROM (
-            SELECT explosivo_id FROM ingresos 
-            WHERE CAST(fecha_ingreso AS DATE) = :fecha AND guardia = :guardia
-            UNION
-            SELECT explosivo_id FROM salidas
-            WHERE CAST(fecha_salida AS DATE) = :fecha AND guardia = :guardia
-            UNION  
-            SELECT s.explosivo_id FROM devoluciones d
-            JOIN salidas s ON d.salida_id = s.id
-            WHERE CAST(d.fecha_devolucion AS DATE) = :fecha AND s.guardia = :guardia
-        ) explosivos_con_movimientos
-    """)
-    
-    explosivos_ids = db.session.execute(query_explosivos, {
-        'fecha': fecha, 
-        'guardia': guardia
-    }).fetchall()
+    if explosivos_ids is None:
+        explosivos_ids = [row[0] for row in db.session.execute(text(f"""
+            SELECT DISTINCT m.explosivo_id
+            FROM ({sql_movimientos_turno()}) m
+            WHERE m.explosivo_id IS NOT NULL AND m.fecha = :fecha AND m.guardia = :guardia
+        """), {
+            'fecha': fecha, 
+            'guardia': guardia
+        }).fetchall()]
     
-    for explosivo_row in explosivos_ids:
-        explosivo_id = explosivo_row[0]
+    for explosivo_id in sorted(set(explosivos_ids)):
         
         # Calcular stock inicial
         stock_inicial = calcular_stock_inicial(explosivo_id, fecha, guardia)
@@ -123,10 +595,11 @@ def procesar_stock_fecha_guardia(fecha, guardia):
         ).first()
         
         if stock_registro:
-            # Actualizar existente
-            stock_registro.stock_inicial = stock_inicial
-            stock_registro.stock_final = stock_final
-            stock_registro.observaciones = f"Recalculado automáticamente - {datetime.now()}"
+            # Actualizar existente solo si el saldo cambió (evita reescrituras en cada pasada)
+            if valores_distintos((stock_registro.stock_inicial, stock_registro.stock_final), (stock_inicial, stock_final)):
+                stock_registro.stock_inicial = stock_inicial
+                stock_registro.stock_final = stock_final
+                stock_registro.observaciones = f"Recalculado automáticamente - {datetime.now()}"
         else:
             # Crear nuevo
             stock_registro = StockDiario(
@@ -151,7 +624,15 @@ def procesar_stock_fecha_guardia(fecha, guardia):
     return procesados
 
 def calcular_stock_inicial(explosivo_id, fecha, guardia):
-    """Calcula stock inicial correcto para un explosivo/fecha/guardia"""
+    """Calcula stock inicial correcto para un explosivo/fecha/guardia
+    
+    Con stock_diario disperso los turnos sin movimientos no tienen fila: el stock inicial
+    es el final de la última fila guardada antes del turno.
+    """
+    if stock_diario_disperso():
+        stock_anterior = ultima_fila_stock_diario(explosivo_id, fecha, guardia)
+        # Si es el primer turno, stock inicial = 0
+        return stock_anterior.stock_final if stock_anterior else 0.0
     
     if guardia == 'dia':
         # Stock inicial día = stock final noche día anterior
@@ -182,60 +663,59 @@ def calcular_stock_inicial(explosivo_id, fecha, guardia):
             # Si no hay registro día, calcular desde stock inicial día
             return calcular_stock_inicial(explosivo_id, fecha, 'dia')
 
+def sql_movimientos_turno():
+    """Movimientos por (explosivo_id, fecha, guardia): el agregado stock_movimientos_turno si
+    existe, si no movimientos_por_turno_sql(). Las devoluciones van al turno de la devolución y
+    a su explosivo (o al de la salida), igual que en el motor acumulado y vw_stock_diario_simple"""
+    if obtener_capacidades()['stock_movimientos_turno']:
+        return "SELECT explosivo_id, fecha, guardia, ingresos, salidas, devoluciones FROM stock_movimientos_turno"
+    return movimientos_por_turno_sql()
+
 def calcular_movimientos_turno(explosivo_id, fecha, guardia):
     """Calcula movimientos de un turno específico"""
-    
-    # Ingresos
-    query_ingresos = text("""
-        SELECT COALESCE(SUM(cantidad), 0) as total
-        FROM ingresos 
-        WHERE explosivo_id = :explosivo_id
-        AND CAST(fecha_ingreso AS DATE) = :fecha
-        AND guardia = :guardia
-    """)
-    
-    ingresos = db.session.execute(query_ingresos, {
-        'explosivo_id': explosivo_id,
-        'fecha': fecha,
-        'guardia': guardia
-    }).scalar() or 0.0
-    
-    # Salidas
-    query_salidas = text("""
-        SELECT COALESCE(SUM(cantidad), 0) as total
-        FROM salidas
-        WHERE explosivo_id = :explosivo_id
-        AND CAST(fecha_salida AS DATE) = :fecha
-        AND guardia = :guardia
-    """)
-    
-    salidas = db.session.execute(query_salidas, {
+    row = db.session.execute(text(f"""
+        SELECT
+            COALESCE(SUM(m.ingresos), 0) AS ingresos,
+            COALESCE(SUM(m.salidas), 0) AS salidas,
+            COALESCE(SUM(m.devoluciones), 0) AS devoluciones
+        FROM ({sql_movimientos_turno()}) m
+        WHERE m.explosivo_id = :explosivo_id AND m.fecha = :fecha AND m.guardia = :guardia
+    """), {
         'explosivo_id': explosivo_id,
         'fecha': fecha,
         'guardia': guardia
-    }).scalar() or 0.0
-    
-    # Devoluciones
-    query_devoluciones = text("""
-        SELECT COALESCE(SUM(d.cantidad_devuelta), 0) as total
-        FROM devoluciones d
-        JOIN salidas s ON d.salida_id = s.id
-        WHERE s.explosivo_id = :explosivo_id
-        AND CAST(d.fecha_devolucion AS DATE) = :fecha
-        AND s.guardia = :guardia
-    """)
-    
-    devoluciones = db.session.execute(query_devoluciones, {
-        'explosivo_id': explosivo_id,
-        'fecha': fecha,
-        'guardia': guardia
-    }).scalar() or 0.0
+    }).fetchone()
     
     return {
-        'ingresos': float(ingresos),
-        'salidas': float(salidas),
-        'devoluciones': float(devoluciones)
+        'ingresos': float(row.ingresos),
+        'salidas': float(row.salidas),
+        'devoluciones': float(row.devoluciones)
     }
 
 if __name__ == "__main__":
-    recalcular_stock_diario_completo()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Recalcular stock_diario desde los movimientos')
+    parser.add_argument('--incremental', action='store_true', help='Solo desde las marcas de stock_recalculo_pendiente')
+    parser.add_argument('--desde', type=date.fromisoformat, help='Fecha inicial del recálculo completo (AAAA-MM-DD)')
+    parser.add_argument('--motor', choices=['acumulado', 'turnos'], default='acumulado',
+                        help='acumulado: suma acumulada en una pasada; turnos: turno por turno (anterior)')
+    parser.add_argument('--dry-run', action='store_true', help='Calcular y reportar las diferencias sin escribir')
+    parser.add_argument('--exportar', metavar='ARCHIVO.csv', help='Con --dry-run: exportar el diff completo a CSV')
+    parser.add_argument('--procesos', type=int, default=PROCESOS_RECALCULO,
+                        help='Procesos trabajadores para el recálculo completo acumulado (1 = en serie)')
+    args = parser.parse_args()
+
+    if (args.dry_run or args.exportar) and args.motor != 'acumulado':
+        parser.error('--dry-run y --exportar requieren --motor acumulado')
+    if args.exportar and not args.dry_run:
+        parser.error('--exportar se usa junto con --dry-run')
+    if args.procesos > 1 and (args.incremental or args.motor != 'acumulado'):
+        parser.error('--procesos aplica al recálculo completo con --motor acumulado')
+
+    if args.incremental:
+        recalcular_stock_incremental(args.motor, args.dry_run, args.exportar)
+    elif args.procesos > 1:
+        recalcular_stock_paralelo(args.desde, args.procesos, dry_run=args.dry_run, exportar=args.exportar)
+    elif args.motor == 'acumulado':
+        recalcular_stock_acumulado(args.desde, dry_run=args.dry_run, exportar=args.exportar)
+    else:
+        recalcular_stock_diario_completo(args.desde)
\ No newline at end of file
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Reconstrucción y verificación de las tablas stock_saldos y stock_movimientos_turno
+Recalcula los saldos acumulados y los totales por turno desde cero a partir de
+ingresos, salidas y devoluciones, y los compara contra el historial
+"""
+
+import sys
+sys.path.append('.')
+
+from app import app, db, sql_fecha
+from sqlalchemy import text
+
+# Movimientos individuales normalizados a (explosivo_id, fecha, guardia, ingresos, salidas, devoluciones)
+MOVIMIENTOS_POR_TURNO_SQL = """
+    SELECT explosivo_id, {fecha_ingreso} AS fecha, guardia,
+           cantidad AS ingresos, 0 AS salidas, 0 AS devoluciones
+    FROM ingresos
+    UNION ALL
+    SELECT explosivo_id, {fecha_salida}, guardia, 0, cantidad, 0
+    FROM salidas
+    UNION ALL
+    SELECT COALESCE(d.explosivo_id, s.explosivo_id), {fecha_devolucion}, d.guardia, 0, 0, d.cantidad_devuelta
+    FROM devoluciones d
+    LEFT JOIN salidas s ON d.salida_id = s.id
+"""
+
+def movimientos_por_turno_sql():
+    """MOVIMIENTOS_POR_TURNO_SQL con la fecha truncada según el motor (sql_fecha)"""
+    return MOVIMIENTOS_POR_TURNO_SQL.format(
+        fecha_ingreso=sql_fecha('fecha_ingreso'),
+        fecha_salida=sql_fecha('fecha_salida'),
+        fecha_devolucion=sql_fecha('d.fecha_devolucion')
+    )
+
+def reconstruir_stock_saldos():
+    """Recalcula stock_saldos desde el historial completo de movimientos"""
+
+    with app.app_context():
+        print("=== RECONSTRUCCIÓN STOCK_SALDOS ===\n")
+
+        try:
+            db.session.execute(text("DELETE FROM stock_saldos"))
+
+            resultado = db.session.execute(text("""
+                INSERT INTO stock_saldos (explosivo_id, total_ingresos, total_salidas, total_devoluciones, stock_actual, fecha_actualizacion)
+                SELECT
+                    e.id,
+                    COALESCE(i.total_ingresos, 0),
+                    COALESCE(s.total_salidas, 0),
+                    COALESCE(d.total_devoluciones, 0),
+                    COALESCE(i.total_ingresos, 0) - COALESCE(s.total_salidas, 0) + COALESCE(d.total_devoluciones, 0),
+                    CURRENT_TIMESTAMP
+                FROM explosivos e
+                LEFT JOIN (
+                    SELECT explosivo_id, SUM(cantidad) AS total_ingresos
+                    FROM ingresos GROUP BY explosivo_id
+                ) i ON e.id = i.explosivo_id
+                LEFT JOIN (
+                    SELECT explosivo_id, SUM(cantidad) AS total_salidas
+                    FROM salidas GROUP BY explosivo_id
+                ) s ON e.id = s.explosivo_id
+                LEFT JOIN (
+                    SELECT explosivo_id, SUM(cantidad_devuelta) AS total_devoluciones
+                    FROM devoluciones GROUP BY explosivo_id
+                ) d ON e.id = d.explosivo_id
+            """))
+
+            db.session.commit()
+            print(f"✅ {resultado.rowcount} saldos reconstruidos")
+            return True
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Error reconstruyendo stock_saldos: {e}")
+            return False
+
+def reconstruir_movimientos_turno():
+    """Recalcula stock_movimientos_turno desde el historial completo de movimientos"""
+
+    with app.app_context():
+        print("\n=== RECONSTRUCCIÓN STOCK_MOVIMIENTOS_TURNO ===\n")
+
+        try:
+            db.session.execute(text("DELETE FROM stock_movimientos_turno"))
+
+            resultado = db.session.execute(text(f"""
+                INSERT INTO stock_movimientos_turno (explosivo_id, fecha, guardia, ingresos, salidas, devoluciones, fecha_actualizacion)
+                SELECT m.explosivo_id, m.fecha, m.guardia, SUM(m.ingresos), SUM(m.salidas), SUM(m.devoluciones), CURRENT_TIMESTAMP
+                FROM ({movimientos_por_turno_sql()}) m
+                WHERE m.explosivo_id IS NOT NULL
+                GROUP BY m.explosivo_id, m.fecha, m.guardia
+            """))
+
+            db.session.commit()
+            print(f"✅ {resultado.rowcount} turnos reconstruidos")
+            return True
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"❌ Error reconstruyendo stock_movimientos_turno: {e}")
+            return False
+
+def verificar_stock_saldos():
+    """Compara stock_saldos contra v_stock_actual y reporta diferencias"""
+
+    with app.app_context():
+        print("\n=== VERIFICACIÓN STOCK_SALDOS vs v_stock_actual ===\n")
+
+        diferencias = db.session.execute(text("""
+            SELECT
+                v.id,
+                v.codigo,
+                v.stock_actual as stock_vista,
+                ss.stock_actual as stock_saldo
+            FROM v_stock_actual v
+            LEFT JOIN stock_saldos ss ON ss.explosivo_id = v.id
+            WHERE ss.explosivo_id IS NULL
+            OR ABS(ss.stock_actual - v.stock_actual) > 0.001
+            ORDER BY v.codigo
+        """)).fetchall()
+
+        if not diferencias:
+            print("✅ stock_saldos coincide con v_stock_actual")
+            return 0
+
+        print(f"⚠️ {len(diferencias)} explosivos con diferencias:")
+        for row in diferencias:
+            saldo = 'SIN FILA' if row.stock_saldo is None else row.stock_saldo
+            print(f"   {row.codigo}: vista={row.stock_vista} saldo={saldo}")
+
+        return len(diferencias)
+
+def verificar_movimientos_turno():
+    """Compara stock_movimientos_turno contra los movimientos agregados por turno"""
+
+    with app.app_context():
+        print("\n=== VERIFICACIÓN STOCK_MOVIMIENTOS_TURNO ===\n")
+
+        diferencias = db.session.execute(text(f"""
+            SELECT
+                h.explosivo_id, h.fecha, h.guardia,
+                h.ingresos, h.salidas, h.devoluciones,
+                mt.ingresos as mt_ingresos, mt.salidas as mt_salidas, mt.devoluciones as mt_devoluciones
+            FROM (
+                SELECT m.explosivo_id, m.fecha, m.guardia,
+                       SUM(m.ingresos) as ingresos, SUM(m.salidas) as salidas, SUM(m.devoluciones) as devoluciones
+                FROM ({movimientos_por_turno_sql()}) m
+                WHERE m.explosivo_id IS NOT NULL
+                GROUP BY m.explosivo_id, m.fecha, m.guardia
+            ) h
+            LEFT JOIN stock_movimientos_turno mt
+                ON mt.explosivo_id = h.explosivo_id AND mt.fecha = h.fecha AND mt.guardia = h.guardia
+            WHERE mt.explosivo_id IS NULL
+            OR ABS(mt.ingresos - h.ingresos) > 0.001
+            OR ABS(mt.salidas - h.salidas) > 0.001
+            OR ABS(mt.devoluciones - h.devoluciones) > 0.001
+            ORDER BY h.fecha, h.guardia, h.explosivo_id
+        """)).fetchall()
+
+        if not diferencias:
+            print("✅ stock_movimientos_turno coincide con los movimientos")
+            return 0
+
+        print(f"⚠️ {len(diferencias)} turnos con diferencias:")
+        for row in diferencias:
+            if row.mt_ingresos is None:
+                print(f"   {row.fecha} {row.guardia} explosivo {row.explosivo_id}: SIN FILA")
+            else:
+                print(f"   {row.fecha} {row.guardia} explosivo {row.explosivo_id}: "
+                      f"I {row.mt_ingresos}/{row.ingresos} S {row.mt_salidas}/{row.salidas} D {row.mt_devoluciones}/{row.devoluciones}")
+
+        return len(diferencias)
+
+if __name__ == "__main__":
+    if '--solo-verificar' not in sys.argv:
+        if not reconstruir_stock_saldos() or not reconstruir_movimientos_turno():
+            sys.exit(1)
+
+    diferencias = verificar_stock_saldos() + verificar_movimientos_turno()
+    sys.exit(1 if diferencias else 0)
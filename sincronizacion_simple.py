@@ -3,8 +3,233 @@
 """
 Sincronización automática simplificada para stock_diario
 Evita imports circulares usando importación dinámica
+Incluye una cola en memoria con hilo trabajador para sacar el recálculo
+de stock_diario fuera de la petición HTTP
 """
 
+import os
+import threading
+import time
+import atexit
+
+_modulo_recalculo = None
+_suscriptores = []
+
+def obtener_modulo_recalculo():
+    """Importa recalcular_stock_automatico una sola vez (import dinámico para evitar circular import)"""
+    global _modulo_recalculo
+    
+    if _modulo_recalculo is None:
+        import importlib
+        _modulo_recalculo = importlib.import_module('recalcular_stock_automatico')
+    
+    return _modulo_recalculo
+
+def agrupar_claves_por_turno(claves):
+    """Agrupa claves (explosivo_id, fecha, guardia) en {(fecha, guardia): {explosivo_id, ...}}"""
+    turnos = {}
+    for explosivo_id, fecha, guardia in claves:
+        turnos.setdefault((fecha, guardia), set()).add(explosivo_id)
+    return turnos
+
+def trigger_sincronizacion_lote(claves):
+    """
+    Sincronización consolidada después del commit de un registro con varios ítems
+    Recalcula una sola vez cada (fecha, guardia) afectada, limitada a sus explosivos
+    """
+    
+    turnos = agrupar_claves_por_turno(claves)
+    if not turnos:
+        return 0
+    
+    try:
+        return sincronizar_turnos(turnos)
+        
+    except Exception as e:
+        print(f"⚠️ Error en sincronización automática: {e}")
+        return 0
+
+def suscribir_sincronizacion(funcion):
+    """Registra funcion(turnos) para después de cada sincronización (p. ej. subir la versión de datos)"""
+    _suscriptores.append(funcion)
+
+def sincronizar_turnos(turnos):
+    """Recalcula {(fecha, guardia): {explosivo_id, ...}} en un solo app_context (propaga errores)"""
+    
+    recalcular_module = obtener_modulo_recalculo()
+    procesados = 0
+    
+    with recalcular_module.app.app_context():
+        for (fecha, guardia), explosivos_ids in sorted(turnos.items()):
+            procesados += recalcular_module.procesar_stock_fecha_guardia(fecha, guardia, explosivos_ids)
+    
+    for funcion in _suscriptores:
+        try:
+            funcion(turnos)
+        except Exception as e:
+            print(f"⚠️ Error notificando sincronización: {e}")
+    
+    print(f"🔄 Auto-sincronizado: {procesados} explosivos en {len(turnos)} turno(s)")
+    return procesados
+
+class ColaSincronizacion:
+    """
+    Cola en memoria de sincronizaciones pendientes de stock_diario
+    
+    - Las claves (explosivo_id, fecha, guardia) se agrupan por turno; una clave
+      que ya está pendiente no se vuelve a encolar
+    - Un único hilo trabajador toma todo lo pendiente y lo procesa en un lote,
+      un recálculo por (fecha, guardia)
+    - Si una clave llega mientras su turno se está procesando, queda pendiente
+      para el siguiente lote (el recálculo se basa en el estado ya confirmado)
+    """
+    
+    def __init__(self, espera_lote=0.5):
+        self.espera_lote = espera_lote
+        self._condicion = threading.Condition()
+        self._pendientes = {}   # (fecha, guardia) -> {'explosivos': set, 'encolado': timestamp}
+        self._hilo = None
+        self._en_proceso = 0
+        self._detenida = False
+        self.encoladas_total = 0
+        self.duplicadas_total = 0
+        self.procesadas_total = 0
+        self.lotes_total = 0
+        self.errores_total = 0
+        self.ultimo_error = None
+        self.ultimo_lote = None
+        self.ultimo_lag = None
+    
+    def encolar(self, claves):
+        """Agrega claves a la cola. Retorna cuántas claves nuevas quedaron pendientes"""
+        turnos = agrupar_claves_por_turno(claves)
+        if not turnos:
+            return 0
+        
+        nuevas = 0
+        ahora = time.time()
+        with self._condicion:
+            for turno, explosivos_ids in turnos.items():
+                pendiente = self._pendientes.get(turno)
+                if pendiente is None:
+                    pendiente = self._pendientes[turno] = {'explosivos': set(), 'encolado': ahora}
+                antes = len(pendiente['explosivos'])
+                pendiente['explosivos'].update(explosivos_ids)
+                agregadas = len(pendiente['explosivos']) - antes
+                nuevas += agregadas
+                self.duplicadas_total += len(explosivos_ids) - agregadas
+            
+            self.encoladas_total += nuevas
+            self._asegurar_hilo()
+            self._condicion.notify()
+        
+        return nuevas
+    
+    def _asegurar_hilo(self):
+        """Arranca el hilo trabajador bajo demanda (después del fork de gunicorn)"""
+        if self._hilo is None or not self._hilo.is_alive():
+            self._detenida = False
+            self._hilo = threading.Thread(target=self._trabajar, name='sincronizacion-stock', daemon=True)
+            self._hilo.start()
+    
+    def _tomar_lote(self, bloquear=True):
+        """Retira todo lo pendiente de la cola"""
+        with self._condicion:
+            while bloquear and not self._pendientes and not self._detenida:
+                self._condicion.wait()
+            
+            if bloquear and self._pendientes and self.espera_lote:
+                # Breve espera para juntar los movimientos que llegan seguidos: cada encolar()
+                # despierta al hilo, así que se espera hasta el plazo y no al primer aviso
+                limite = time.time() + self.espera_lote
+                restante = self.espera_lote
+                while restante > 0 and not self._detenida:
+                    self._condicion.wait(restante)
+                    restante = limite - time.time()
+            
+            lote = self._pendientes
+            self._pendientes = {}
+            self._en_proceso = sum(len(p['explosivos']) for p in lote.values())
+            return lote
+    
+    def _procesar_lote(self, lote):
+        """Ejecuta un lote ya retirado de la cola"""
+        if not lote:
+            return
+        
+        turnos = {turno: pendiente['explosivos'] for turno, pendiente in lote.items()}
+        mas_antiguo = min(pendiente['encolado'] for pendiente in lote.values())
+        
+        try:
+            sincronizar_turnos(turnos)
+        except Exception as e:
+            self.errores_total += 1
+            self.ultimo_error = f"{type(e).__name__}: {e}"
+            print(f"⚠️ Error en sincronización en segundo plano: {e}")
+        finally:
+            ahora = time.time()
+            with self._condicion:
+                self.procesadas_total += self._en_proceso
+                self._en_proceso = 0
+                self.lotes_total += 1
+                self.ultimo_lote = ahora
+                self.ultimo_lag = ahora - mas_antiguo
+    
+    def _trabajar(self):
+        """Bucle del hilo trabajador"""
+        while True:
+            lote = self._tomar_lote()
+            if not lote and self._detenida:
+                return
+            self._procesar_lote(lote)
+    
+    def drenar(self):
+        """Procesa lo pendiente en el hilo actual (usado al terminar el proceso)"""
+        with self._condicion:
+            self._detenida = True
+            self._condicion.notify_all()
+        self._procesar_lote(self._tomar_lote(bloquear=False))
+    
+    def estado(self):
+        """Profundidad, lag y contadores de la cola para diagnóstico"""
+        ahora = time.time()
+        with self._condicion:
+            pendientes = sum(len(p['explosivos']) for p in self._pendientes.values())
+            mas_antiguo = min((p['encolado'] for p in self._pendientes.values()), default=None)
+            
+            return {
+                'modo': 'asincrono' if SINCRONIZACION_ASINCRONA else 'sincrono',
+                'hilo_activo': bool(self._hilo and self._hilo.is_alive()),
+                'pendientes': pendientes,
+                'turnos_pendientes': sorted(f"{fecha} {guardia}" for fecha, guardia in self._pendientes),
+                'en_proceso': self._en_proceso,
+                'lag_segundos': round(ahora - mas_antiguo, 3) if mas_antiguo is not None else 0,
+                'ultimo_lag_segundos': round(self.ultimo_lag, 3) if self.ultimo_lag is not None else None,
+                'ultimo_lote': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.ultimo_lote)) if self.ultimo_lote else None,
+                'encoladas_total': self.encoladas_total,
+                'duplicadas_total': self.duplicadas_total,
+                'procesadas_total': self.procesadas_total,
+                'lotes_total': self.lotes_total,
+                'errores_total': self.errores_total,
+                'ultimo_error': self.ultimo_error
+            }
+
+# SINCRONIZACION_ASINCRONA=false vuelve al recálculo dentro de la petición (scripts, pruebas)
+SINCRONIZACION_ASINCRONA = os.environ.get('SINCRONIZACION_ASINCRONA', 'true').lower() not in ('0', 'false', 'no')
+
+cola_sincronizacion = ColaSincronizacion()
+atexit.register(cola_sincronizacion.drenar)
+
+def encolar_sincronizacion(claves):
+    """Punto de entrada desde app.py: encola las claves o sincroniza en línea según configuración"""
+    if SINCRONIZACION_ASINCRONA:
+        return cola_sincronizacion.encolar(claves)
+    return trigger_sincronizacion_lote(claves)
+
+def estado_cola_sincronizacion():
+    """Estado de la cola de sincronización (endpoint de administración)"""
+    return cola_sincronizacion.estado()
+
 def trigger_sincronizacion_stock(movimiento_tipo, explosivo_id, fecha, guardia):
     """
     Función wrapper simple para sincronización automática
@@ -13,10 +238,7 @@ def trigger_sincronizacion_stock(movimiento_tipo, explosivo_id, fecha, guardia):
     
     try:
         # Import dinámico para evitar circular import
-        import importlib
-        
-        # Intentar importar desde recalcular_stock_automatico
-        recalcular_module = importlib.import_module('recalcular_stock_automatico')
+        recalcular_module = obtener_modulo_recalculo()
         
         # Llamar función específica para una fecha/guardia
         with recalcular_module.app.app_context():
@@ -0,0 +1,45 @@
+// GET condicional para las APIs de stock y catálogo (ETag / If-None-Match)
+// Guarda la última respuesta de cada URL en sessionStorage; si el servidor responde
+// 304 Not Modified se reutiliza el cuerpo guardado sin volver a descargarlo.
+const PREFIJO_CACHE_CONDICIONAL = 'fetch-condicional:';
+
+function leerCacheCondicional(url) {
+    try {
+        const guardado = sessionStorage.getItem(PREFIJO_CACHE_CONDICIONAL + url);
+        return guardado ? JSON.parse(guardado) : null;
+    } catch (error) {
+        return null;
+    }
+}
+
+function guardarCacheCondicional(url, etag, cuerpo) {
+    try {
+        sessionStorage.setItem(PREFIJO_CACHE_CONDICIONAL + url, JSON.stringify({ etag: etag, cuerpo: cuerpo }));
+    } catch (error) {
+        // Sin espacio en sessionStorage: la próxima petición será completa
+    }
+}
+
+async function fetchCondicional(url, opciones = {}) {
+    const cache = leerCacheCondicional(url);
+    const headers = new Headers(opciones.headers || {});
+    if (cache && cache.etag) {
+        headers.set('If-None-Match', cache.etag);
+    }
+
+    const response = await fetch(url, { ...opciones, headers: headers, cache: 'no-store' });
+
+    if (response.status === 304 && cache) {
+        // Sin cambios desde la última consulta: el mismo cuerpo, como si fuera un 200
+        return new Response(cache.cuerpo, {
+            status: 200,
+            headers: { 'Content-Type': 'application/json', 'ETag': cache.etag }
+        });
+    }
+
+    const etag = response.headers.get('ETag');
+    if (response.ok && etag) {
+        guardarCacheCondicional(url, etag, await response.clone().text());
+    }
+    return response;
+}
@@ -0,0 +1,10 @@
+// Clave de idempotencia para los POST de registro (cabecera Idempotency-Key)
+// Cada registro usa una clave nueva y la conserva en sus reintentos: si el servidor ya
+// lo procesó devuelve la respuesta original en lugar de volver a insertar.
+function nuevaClaveIdempotencia() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    // Fuera de HTTPS no hay randomUUID
+    return Date.now().toString(36) + '-' + Math.random().toString(36).slice(2) + Math.random().toString(36).slice(2);
+}
@@ -0,0 +1,61 @@
+// Stock en vivo para los formularios de registro (Server-Sent Events de /api/stock/stream)
+// El servidor envía el delta de saldo de los explosivos suscritos (y el saldo resultante si
+// lo conoce) cada vez que se confirma un movimiento. Al reconectar, o si el servidor pide
+// resincronizar, se recarga el stock completo.
+// Si el navegador no tiene EventSource o el worker no admite más streams (503), se recarga
+// el stock cada SONDEO_STOCK_MS (alResincronizar usa GET condicional: 304 si no cambió).
+const SONDEO_STOCK_MS = 20000;
+
+function sondearStock(alResincronizar) {
+    const intervalo = setInterval(alResincronizar, SONDEO_STOCK_MS);
+    window.addEventListener('beforeunload', function() {
+        clearInterval(intervalo);
+    });
+}
+
+function conectarStockEnVivo(ids, alCambiarStock, alResincronizar) {
+    if (!ids.length) {
+        return null;
+    }
+    if (!window.EventSource) {
+        sondearStock(alResincronizar);
+        return null;
+    }
+
+    const fuente = new EventSource(`/api/stock/stream?ids=${ids.join(',')}`);
+    let conexiones = 0;
+
+    fuente.addEventListener('error', function() {
+        // Ante una respuesta que no es un stream (503 por límite de conexiones) EventSource
+        // no reintenta: se pasa a sondear y se recupera lo que cambió mientras tanto
+        if (fuente.readyState === EventSource.CLOSED) {
+            alResincronizar();
+            sondearStock(alResincronizar);
+        }
+    });
+
+    fuente.addEventListener('conectado', function() {
+        conexiones += 1;
+        // La primera conexión llega justo después de la carga inicial; las siguientes
+        // son reconexiones y pudieron perderse eventos mientras tanto
+        if (conexiones > 1) {
+            alResincronizar();
+        }
+    });
+
+    fuente.addEventListener('stock', function(evento) {
+        const datos = JSON.parse(evento.data);
+        const saldos = datos.saldos || {};
+        Object.entries(datos.deltas).forEach(([id, delta]) => alCambiarStock(id, delta, saldos[id]));
+    });
+
+    fuente.addEventListener('resincronizar', function() {
+        alResincronizar();
+    });
+
+    window.addEventListener('beforeunload', function() {
+        fuente.close();
+    });
+
+    return fuente;
+}
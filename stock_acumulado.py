@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Motor de recálculo de stock_diario por suma acumulada
+Recibe los totales de movimientos por turno (una sola consulta agrupada) y las
+filas existentes de stock_diario, y calcula el stock inicial/final de cada turno
+con una suma acumulada por explosivo. No consulta la base de datos: recalcular_stock_automatico.py
+carga los datos y escribe solo las filas que cambian.
+"""
+
+from datetime import date, datetime
+
+# Orden de las guardias dentro de un mismo día
+ORDEN_GUARDIA = {'dia': 0, 'noche': 1}
+
+# Diferencia mínima para considerar que un valor de stock cambió
+TOLERANCIA = 0.01
+
+def clave_turno(fecha, guardia):
+    """Clave ordenable de un turno: (fecha, 0=dia / 1=noche)"""
+    if isinstance(fecha, datetime):
+        fecha = fecha.date()
+    elif isinstance(fecha, str):
+        fecha = date.fromisoformat(fecha[:10])
+    return fecha, ORDEN_GUARDIA.get((guardia or '').lower(), 1)
+
+def calcular_saldos_acumulados(movimientos, turnos_existentes=(), saldos_iniciales=None):
+    """Stock inicial y final de cada turno por suma acumulada.
+
+    movimientos: iterable de (explosivo_id, fecha, guardia, ingresos, salidas, devoluciones)
+        ya agrupado por turno (o no: los repetidos se suman).
+    turnos_existentes: iterable de (explosivo_id, fecha, guardia) con fila en stock_diario;
+        los turnos sin movimientos también reciben su saldo (continuidad).
+    saldos_iniciales: {explosivo_id: stock antes del primer turno considerado}.
+
+    Retorna {(explosivo_id, fecha, guardia): (stock_inicial, stock_final)}.
+    """
+    netos = {}
+    guardias = {}
+    for explosivo_id, fecha, guardia, ingresos, salidas, devoluciones in movimientos:
+        fecha_turno, orden = clave_turno(fecha, guardia)
+        clave = (explosivo_id, fecha_turno, orden)
+        netos[clave] = netos.get(clave, 0.0) + float(ingresos or 0) - float(salidas or 0) + float(devoluciones or 0)
+        guardias[clave] = guardia
+
+    for explosivo_id, fecha, guardia in turnos_existentes:
+        fecha_turno, orden = clave_turno(fecha, guardia)
+        clave = (explosivo_id, fecha_turno, orden)
+        netos.setdefault(clave, 0.0)
+        guardias.setdefault(clave, guardia)
+
+    saldos_iniciales = saldos_iniciales or {}
+    resultado = {}
+    explosivo_actual = None
+    saldo = 0.0
+
+    # Un solo recorrido ordenado por (explosivo, fecha, guardia): la suma acumulada se reinicia por explosivo
+    for clave in sorted(netos):
+        explosivo_id, fecha_turno, _ = clave
+        if explosivo_id != explosivo_actual:
+            explosivo_actual = explosivo_id
+            saldo = float(saldos_iniciales.get(explosivo_id, 0) or 0)
+
+        stock_inicial = saldo
+        saldo = stock_inicial + netos[clave]
+        resultado[(explosivo_id, fecha_turno, guardias[clave])] = (round(stock_inicial, 2), round(saldo, 2))
+
+    return resultado
+
+def comparar_con_existentes(objetivo, existentes):
+    """Separar el estado objetivo en filas a actualizar y filas a insertar.
+
+    existentes: {(explosivo_id, fecha, guardia): (id, stock_inicial, stock_final)}
+    Retorna (actualizar, insertar): actualizar = [(id, clave, anterior, nuevo)], insertar = [(clave, nuevo)].
+    Las filas que ya tienen el valor correcto no aparecen (no se reescriben).
+    """
+    actualizar = []
+    insertar = []
+    for clave, nuevo in sorted(objetivo.items(), key=lambda item: (item[0][0], clave_turno(item[0][1], item[0][2]))):
+        fila = existentes.get(clave)
+        if fila is None:
+            insertar.append((clave, nuevo))
+            continue
+
+        registro_id, inicial_actual, final_actual = fila
+        anterior = (float(inicial_actual or 0), float(final_actual or 0))
+        if valores_distintos(anterior, nuevo):
+            actualizar.append((registro_id, clave, anterior, nuevo))
+
+    return actualizar, insertar
+
+def valores_distintos(anterior, nuevo):
+    """True si (stock_inicial, stock_final) difieren más que la tolerancia"""
+    return (abs(float(anterior[0] or 0) - float(nuevo[0] or 0)) > TOLERANCIA
+            or abs(float(anterior[1] or 0) - float(nuevo[1] or 0)) > TOLERANCIA)
+
+def detectar_rupturas_continuidad(existentes):
+    """Turnos cuyo stock inicial no coincide con el final del turno anterior del mismo explosivo.
+
+    existentes: {(explosivo_id, fecha, guardia): (id, stock_inicial, stock_final)}
+    Retorna [(clave, final_turno_anterior, inicial_turno)] en orden.
+    """
+    rupturas = []
+    anterior = None
+    for clave in sorted(existentes, key=lambda c: (c[0], clave_turno(c[1], c[2]))):
+        _, stock_inicial, stock_final = existentes[clave]
+        if anterior is not None and anterior[0] == clave[0]:
+            if abs(float(anterior[1] or 0) - float(stock_inicial or 0)) > TOLERANCIA:
+                rupturas.append((clave, float(anterior[1] or 0), float(stock_inicial or 0)))
+        anterior = (clave[0], stock_final)
+    return rupturas
+
+def resumir_diferencias(actualizar, insertar, rupturas=()):
+    """Resumen del diff para --dry-run: filas, explosivos afectados y magnitud de los cambios"""
+    deltas = [max(abs(nuevo[0] - anterior[0]), abs(nuevo[1] - anterior[1])) for _, _, anterior, nuevo in actualizar]
+    return {
+        'actualizar': len(actualizar),
+        'insertar': len(insertar),
+        'explosivos_afectados': len({clave[0] for _, clave, _, _ in actualizar} | {clave[0] for clave, _ in insertar}),
+        'delta_max': round(max(deltas), 2) if deltas else 0,
+        'delta_total': round(sum(deltas), 2),
+        'rupturas_continuidad': len(rupturas)
+    }
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Almacenamiento disperso de stock_diario
+Solo se guardan los turnos con movimientos (o con un conteo explícito) y una fila base
+por explosivo. Un turno sin actividad no tiene fila: su stock inicial y final son el
+stock final de la última fila guardada antes del turno. La vista vw_stock_diario_simple
+recorre el calendario de turnos (turnos_calendario) y completa esos turnos al leer, así
+las pantallas y exportaciones muestran lo mismo que con una fila por turno.
+No consulta la base de datos: app.py y compactar_stock_diario.py aportan los datos.
+"""
+
+from collections import namedtuple
+
+from stock_acumulado import clave_turno
+
+# Etiquetas de un turno derivado (las mismas que escribe la inicialización automática)
+RESPONSABLE_DERIVADO = 'Sistema Auto'
+RESPONSABLES_SISTEMA = ('Sistema', 'Sistema Auto')
+
+# Turno sin fila guardada, derivado de la fila anterior del explosivo
+TurnoDerivado = namedtuple('TurnoDerivado', ['explosivo_id', 'fecha', 'guardia', 'stock_inicial', 'stock_final'])
+
+def observaciones_derivadas(fecha, guardia):
+    """Observaciones de un turno inicializado automáticamente (y de un turno derivado)"""
+    return f'Turno {guardia.upper()} inicializado automáticamente - {fecha}'
+
+def filas_compactables(filas, normalizar_etiquetas=False):
+    """Ids de las filas de stock_diario que la lectura derivada reproduce tal cual.
+
+    filas: iterable de (id, explosivo_id, fecha, guardia, stock_inicial, stock_final,
+        responsable_guardia, observaciones, con_movimientos, referenciada).
+    Una fila se puede borrar si no tiene movimientos ni movimientos que la referencien,
+    stock_inicial = stock_final = final de la fila anterior del explosivo y sus etiquetas
+    son las derivadas. La primera fila de cada explosivo se conserva (es la base), igual
+    que los turnos repetidos. Borrar una serie de filas así no cambia la fila anterior
+    de las siguientes: todas valen lo mismo.
+    normalizar_etiquetas: aceptar también filas de responsables del sistema con otras observaciones.
+    """
+    ordenadas = sorted(filas, key=lambda f: (f[1], clave_turno(f[2], f[3]), f[0]))
+    repetidos = {}
+    for fila in ordenadas:
+        clave = (fila[1], clave_turno(fila[2], fila[3]))
+        repetidos[clave] = repetidos.get(clave, 0) + 1
+
+    compactables = []
+    explosivo_actual = None
+    final_anterior = None
+    for (fila_id, explosivo_id, fecha, guardia, stock_inicial, stock_final,
+         responsable, observaciones, con_movimientos, referenciada) in ordenadas:
+        if explosivo_id != explosivo_actual:
+            explosivo_actual = explosivo_id
+            final_anterior = None
+
+        if normalizar_etiquetas:
+            etiquetas_ok = responsable in RESPONSABLES_SISTEMA
+        else:
+            fecha_turno, _ = clave_turno(fecha, guardia)
+            etiquetas_ok = (responsable == RESPONSABLE_DERIVADO
+                            and observaciones == observaciones_derivadas(fecha_turno, guardia))
+
+        if (final_anterior is not None
+                and not con_movimientos and not referenciada and etiquetas_ok
+                and repetidos[(explosivo_id, clave_turno(fecha, guardia))] == 1
+                and float(stock_inicial) == float(stock_final) == float(final_anterior)):
+            compactables.append(fila_id)
+        final_anterior = stock_final
+
+    return compactables
+
+def derivar_turnos(guardadas, calendario, explosivos_ids):
+    """Turnos visibles de cada explosivo, con la misma regla que la vista dispersa.
+
+    guardadas: {(explosivo_id, fecha, guardia): (stock_inicial, stock_final, responsable, observaciones)}
+    calendario: iterable de (fecha, guardia); se suman los turnos que tienen filas guardadas.
+    Un explosivo aparece desde su primera fila guardada.
+    Retorna {(explosivo_id, fecha, guardia): (stock_inicial, stock_final, responsable, observaciones)}.
+    """
+    turnos = sorted(set(calendario) | {(fecha, guardia) for _, fecha, guardia in guardadas},
+                    key=lambda t: clave_turno(*t))
+    resultado = {}
+    for explosivo_id in explosivos_ids:
+        final_anterior = None
+        for fecha, guardia in turnos:
+            fila = guardadas.get((explosivo_id, fecha, guardia))
+            if fila is not None:
+                resultado[(explosivo_id, fecha, guardia)] = fila
+                final_anterior = fila[1]
+            elif final_anterior is not None:
+                resultado[(explosivo_id, fecha, guardia)] = (
+                    final_anterior, final_anterior, RESPONSABLE_DERIVADO, observaciones_derivadas(fecha, guardia)
+                )
+    return resultado
+
+# Vista vw_stock_diario_simple en modo disperso. El calendario incluye los turnos con filas
+# guardadas (un movimiento con fecha pasada crea su fila sin pasar por el calendario).
+# final_anterior solo se busca para los turnos sin fila.
+VISTA_STOCK_DIARIO_DISPERSA = """
+CREATE VIEW vw_stock_diario_simple AS
+SELECT
+    x.explosivo_id,
+    x.codigo,
+    x.descripcion,
+    x.unidad,
+    x.fecha,
+    x.guardia,
+    x.sd_id AS stock_diario_id,
+    COALESCE(x.sd_inicial, x.final_anterior) AS stock_inicial,
+    COALESCE(x.sd_final, x.final_anterior) AS stock_final,
+    COALESCE(mt.ingresos, 0.0) AS ingresos,
+    COALESCE(mt.salidas, 0.0) AS salidas,
+    COALESCE(mt.devoluciones, 0.0) AS devoluciones,
+    CASE WHEN x.sd_id IS NULL THEN '{responsable}' ELSE x.sd_responsable END AS responsable_guardia,
+    CASE WHEN x.sd_id IS NULL THEN {observaciones} ELSE x.sd_observaciones END AS observaciones,
+    COALESCE(x.sd_inicial, x.final_anterior) + COALESCE(mt.ingresos, 0) + COALESCE(mt.devoluciones, 0) - COALESCE(mt.salidas, 0) AS stock_final_calculado,
+    CASE
+        WHEN ABS(COALESCE(x.sd_final, x.final_anterior) - (COALESCE(x.sd_inicial, x.final_anterior) + COALESCE(mt.ingresos, 0) + COALESCE(mt.devoluciones, 0) - COALESCE(mt.salidas, 0))) <= 0.01
+        THEN 'OK'
+        ELSE 'INCONSISTENTE'
+    END AS estado_consistencia
+FROM (
+    SELECT
+        e.id AS explosivo_id, e.codigo, e.descripcion, e.unidad, t.fecha, t.guardia,
+        sd.id AS sd_id, sd.stock_inicial AS sd_inicial, sd.stock_final AS sd_final,
+        sd.responsable_guardia AS sd_responsable, sd.observaciones AS sd_observaciones,
+        CASE WHEN sd.id IS NULL THEN (
+            SELECT {primera} a.stock_final
+            FROM stock_diario a
+            WHERE a.explosivo_id = e.id
+            AND (a.fecha < t.fecha OR (a.fecha = t.fecha AND a.guardia < t.guardia))
+            ORDER BY a.fecha DESC, a.guardia DESC, a.id DESC {limite}
+        ) END AS final_anterior
+    FROM (
+        SELECT fecha, guardia FROM turnos_calendario
+        UNION
+        SELECT fecha, guardia FROM stock_diario
+    ) t
+    CROSS JOIN explosivos e
+    LEFT JOIN stock_diario sd
+        ON sd.explosivo_id = e.id AND sd.fecha = t.fecha AND sd.guardia = t.guardia
+    {filtro_activos}
+) x
+LEFT JOIN stock_movimientos_turno mt
+    ON mt.explosivo_id = x.explosivo_id AND mt.fecha = x.fecha AND mt.guardia = x.guardia
+WHERE x.sd_id IS NOT NULL OR x.final_anterior IS NOT NULL
+"""
+
+def sql_vista_dispersa(dialecto):
+    """CREATE VIEW de la vista dispersa para 'mssql' (T-SQL) o 'sqlite' (benchmarks locales).
+
+    Mantiene el filtro de cada variante densa: la de SQL Server solo muestra explosivos
+    activos (crear_vista_simple.py); la portable de benchmarks, todos.
+    """
+    if dialecto == 'mssql':
+        return VISTA_STOCK_DIARIO_DISPERSA.format(
+            responsable=RESPONSABLE_DERIVADO,
+            observaciones="N'Turno ' + UPPER(x.guardia) + N' inicializado automáticamente - ' + CONVERT(VARCHAR(10), x.fecha, 23)",
+            primera='TOP 1',
+            limite='',
+            filtro_activos='WHERE e.activo = 1'
+        )
+    return VISTA_STOCK_DIARIO_DISPERSA.format(
+        responsable=RESPONSABLE_DERIVADO,
+        observaciones="'Turno ' || UPPER(x.guardia) || ' inicializado automáticamente - ' || x.fecha",
+        primera='',
+        limite='LIMIT 1',
+        filtro_activos=''
+    )
+
+# vw_stock_diario_powerbi (columnas de database_scripts/09_vista_stock_diario_powerbi_basica.sql)
+# sobre la vista dispersa: los turnos derivados aparecen con stock_diario_id y
+# stock_diario_creado en NULL. Solo SQL Server (FORMAT, DATENAME).
+VISTA_POWERBI_DISPERSA = r"""
+CREATE VIEW vw_stock_diario_powerbi AS
+SELECT
+    v.stock_diario_id,
+    v.explosivo_id,
+    v.codigo,
+    v.descripcion,
+    v.unidad,
+    e.grupo,
+    v.fecha,
+    v.guardia as turno,
+    v.stock_inicial,
+    v.stock_final,
+    COALESCE((
+        SELECT SUM(cantidad) FROM ingresos
+        WHERE explosivo_id = v.explosivo_id AND CAST(fecha_ingreso AS DATE) = v.fecha AND guardia = v.guardia
+    ), 0) as total_ingresos,
+    COALESCE((
+        SELECT SUM(cantidad) FROM salidas
+        WHERE explosivo_id = v.explosivo_id AND CAST(fecha_salida AS DATE) = v.fecha AND guardia = v.guardia
+    ), 0) as total_salidas,
+    COALESCE((
+        SELECT SUM(cantidad_devuelta) FROM devoluciones
+        WHERE explosivo_id = v.explosivo_id AND CAST(fecha_devolucion AS DATE) = v.fecha AND guardia = v.guardia
+    ), 0) as total_devoluciones,
+    (v.stock_final - v.stock_inicial) as diferencia,
+    CASE
+        WHEN (v.stock_final - v.stock_inicial) > 0 THEN 'POSITIVA'
+        WHEN (v.stock_final - v.stock_inicial) < 0 THEN 'NEGATIVA'
+        ELSE 'CERO'
+    END as tipo_diferencia,
+    v.responsable_guardia,
+    v.observaciones,
+    COALESCE((
+        SELECT COUNT(DISTINCT ISNULL(labor, 'Sin Labor')) FROM salidas
+        WHERE explosivo_id = v.explosivo_id AND CAST(fecha_salida AS DATE) = v.fecha AND guardia = v.guardia
+    ), 0) as cantidad_labores,
+    CASE WHEN e.activo = 1 THEN 'ACTIVO' ELSE 'INACTIVO' END as estado_explosivo,
+    YEAR(v.fecha) as anio,
+    MONTH(v.fecha) as mes,
+    DAY(v.fecha) as dia,
+    DATENAME(WEEKDAY, v.fecha) as dia_semana,
+    DATENAME(MONTH, v.fecha) as nombre_mes,
+    FORMAT(v.fecha, 'yyyy-MM') as periodo_mes,
+    FORMAT(v.fecha, 'yyyy-\QQ') as periodo_trimestre,
+    sd.fecha_registro as stock_diario_creado,
+    GETDATE() as fecha_consulta
+FROM vw_stock_diario_simple v
+INNER JOIN explosivos e ON v.explosivo_id = e.id
+LEFT JOIN stock_diario sd ON sd.id = v.stock_diario_id
+WHERE e.activo = 1
+"""
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Pruebas para la caché del catálogo de explosivos
+No requiere conexión a base de datos
+"""
+
+import sys
+import os
+
+# Agregar el directorio del proyecto al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from catalogo_explosivos import CatalogoExplosivos
+
+REGISTROS = [
+    {'id': 1, 'codigo': 'EXP-003', 'descripcion': 'EMULNOR 1000', 'unidad': 'UND', 'grupo': 'EXPLOSIVOS'},
+    {'id': 2, 'codigo': 'EXP-010', 'descripcion': 'SUPERFAM DOS', 'unidad': 'KG', 'grupo': 'EXPLOSIVOS'},
+    {'id': 3, 'codigo': 'FAN-001', 'descripcion': 'FANEL MS 4.8 MTS', 'unidad': 'UND', 'grupo': 'FANEL MS'},
+    {'id': 4, 'codigo': 'ACC-001', 'descripcion': 'MECHA RAPIDA', 'unidad': 'MTS', 'grupo': None},
+]
+
+def test_orden_y_mapas():
+    """La lista respeta el orden de los formularios y los mapas resuelven id y código"""
+    print("=== TEST: Orden y mapas ===")
+    catalogo = CatalogoExplosivos()
+    catalogo.cargar(REGISTROS)
+    assert [e.codigo for e in catalogo.ordenados()] == ['EXP-010', 'EXP-003', 'FAN-001', 'ACC-001']
+    assert catalogo.por_id(3).codigo == 'FAN-001'
+    assert catalogo.por_codigo('EXP-003').id == 1
+    assert catalogo.por_codigo('NO-EXISTE') is None
+    assert catalogo.grupos() == {'EXPLOSIVOS': (2, 1), 'FANEL MS': (3,), 'Sin grupo': (4,)}
+    print("✅ Orden y mapas correctos")
+
+def test_version_solo_con_cambios():
+    """Recargar el mismo contenido no sube la versión; un cambio sí"""
+    print("=== TEST: Versión ===")
+    catalogo = CatalogoExplosivos()
+    assert catalogo.cargar(REGISTROS) is True
+    checksum = catalogo.checksum
+    assert catalogo.version == 1
+
+    assert catalogo.cargar(list(reversed(REGISTROS))) is False
+    assert catalogo.version == 1 and catalogo.checksum == checksum
+
+    modificados = REGISTROS[:3] + [dict(REGISTROS[3], descripcion='MECHA LENTA')]
+    assert catalogo.cargar(modificados) is True
+    assert catalogo.version == 2 and catalogo.checksum != checksum
+    print("✅ Versión correcta")
+
+def test_invalidar():
+    """Un catálogo invalidado queda vacío hasta la próxima carga"""
+    print("=== TEST: Invalidar ===")
+    catalogo = CatalogoExplosivos()
+    catalogo.cargar(REGISTROS)
+    catalogo.invalidar()
+    assert not catalogo.cargado
+    assert catalogo.ordenados() == [] and catalogo.mapa_codigos() == {}
+    print("✅ Invalidación correcta")
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Pruebas de registrar_deltas_stock_lote sobre una base SQLite en memoria
+Verifica que las filas faltantes se creen desde el historial, que un conflicto al
+crearlas se reintente por explosivo sin perder los deltas del vale y que el recálculo
+incremental no borre una marca tocada por un movimiento posterior.
+"""
+
+import sys
+import os
+from datetime import date, datetime
+
+# Agregar el directorio del proyecto al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from sqlalchemy import text
+
+from app import (app, db, Explosivo, Salida, obtener_capacidades, registrar_deltas_stock_lote,
+                 sumar_o_crear_filas_lote, marcar_recalculo_pendiente)
+from recalcular_stock_automatico import leer_marcas_pendientes, avanzar_marca
+
+FECHA = date(2025, 8, 1)
+
+def preparar_base():
+    db.drop_all()
+    db.create_all()
+    for i in (1, 2, 3):
+        db.session.add(Explosivo(id=i, codigo=f'EXP-{i}', descripcion=f'Explosivo {i}', unidad='UND'))
+    db.session.flush()
+    # Solo el explosivo 1 tiene saldo y agregado del turno
+    db.session.execute(text("""
+        INSERT INTO stock_saldos (explosivo_id, total_ingresos, total_salidas, total_devoluciones, stock_actual, fecha_actualizacion)
+        VALUES (1, 100, 0, 0, 100, :ahora)
+    """), {'ahora': datetime.now()})
+    db.session.execute(text("""
+        INSERT INTO stock_movimientos_turno (explosivo_id, fecha, guardia, ingresos, salidas, devoluciones, fecha_actualizacion)
+        VALUES (1, :fecha, 'dia', 0, 0, 0, :ahora)
+    """), {'fecha': FECHA, 'ahora': datetime.now()})
+    db.session.commit()
+    obtener_capacidades(forzar=True)
+
+def registrar_vale():
+    """Salida de 5 unidades de cada explosivo en el turno día"""
+    for i in (1, 2, 3):
+        db.session.add(Salida(explosivo_id=i, labor='M-100', cantidad=5, guardia='dia',
+                              fecha_salida=datetime.combine(FECHA, datetime.min.time()).replace(hour=9)))
+    return registrar_deltas_stock_lote({i: {'salidas': 5} for i in (1, 2, 3)}, FECHA, 'dia')
+
+def saldos():
+    return dict(db.session.execute(text("SELECT explosivo_id, stock_actual FROM stock_saldos")).fetchall())
+
+def salidas_turno():
+    return dict(db.session.execute(text(
+        "SELECT explosivo_id, salidas FROM stock_movimientos_turno WHERE fecha = :fecha AND guardia = 'dia'"
+    ), {'fecha': FECHA}).fetchall())
+
+def test_lote_crea_las_filas_faltantes():
+    """Las filas existentes suman el delta; las faltantes se crean desde el historial"""
+    print("=== TEST: Lote con filas faltantes ===")
+    with app.app_context():
+        preparar_base()
+        assert registrar_vale()
+        db.session.commit()
+        assert saldos() == {1: 95, 2: -5, 3: -5}
+        assert salidas_turno() == {1: 5, 2: 5, 3: 5}
+    print("✅ Filas creadas y actualizadas")
+
+def test_conflicto_se_reintenta_por_explosivo():
+    """Si otra transacción crea una fila faltante, el lote se revierte y se aplica por explosivo"""
+    print("=== TEST: Conflicto al crear filas ===")
+    with app.app_context():
+        preparar_base()
+        aplicados = []
+
+        def sumar(con_fila):
+            db.session.execute(text("UPDATE stock_saldos SET stock_actual = stock_actual - 1000"))
+
+        ok = sumar_o_crear_filas_lote(
+            'stock_saldos', [1, 2, 3],
+            existentes=lambda: {1},
+            sumar=sumar,
+            crear=lambda faltantes: 0,
+            por_explosivo=aplicados.append
+        )
+        assert ok and aplicados == [1, 2, 3]
+        # El UPDATE del lote se revirtió con su savepoint
+        assert saldos() == {1: 100}
+    print("✅ Reintento por explosivo sin aplicar el lote")
+
+def test_marca_tocada_despues_de_leerla_no_se_borra():
+    """Un movimiento con fecha posterior a la marca hace fallar el compare-and-swap"""
+    print("=== TEST: Compare-and-swap de marcas ===")
+    with app.app_context():
+        preparar_base()
+        assert registrar_vale()
+        db.session.commit()
+        marca = leer_marcas_pendientes()[2]
+        assert marca.desde == FECHA
+
+        # El recálculo ya pasó por FECHA cuando se confirma otro movimiento de ese día
+        assert marcar_recalculo_pendiente(2, FECHA)
+        db.session.commit()
+        assert avanzar_marca(2, marca, None) is None
+        assert leer_marcas_pendientes()[2].desde == FECHA
+
+        # Sin movimientos entretanto, la marca se adelanta y después se borra
+        nueva = avanzar_marca(2, leer_marcas_pendientes()[2], date(2025, 8, 2))
+        assert nueva.desde == date(2025, 8, 2)
+        assert avanzar_marca(2, nueva, None)
+        assert 2 not in leer_marcas_pendientes()
+    print("✅ Marca conservada ante un movimiento concurrente")
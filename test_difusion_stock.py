@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Pruebas de la difusión de stock en vivo (difusion_stock.py)
+Verifica el límite de streams por worker, que un saldo ya difundido tras el commit local
+no se repita y que el sondeo de stock_saldos entregue los commits de otros workers.
+"""
+
+import sys
+import os
+from datetime import datetime
+
+# Agregar el directorio del proyecto al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from sqlalchemy import text
+
+from difusion_stock import HubStock, SondeoSaldos
+
+def test_limite_de_suscriptores():
+    """Pasado max_suscriptores se rechaza la suscripción hasta que alguien cancele"""
+    print("=== TEST: Límite de streams ===")
+    hub = HubStock(max_suscriptores=2)
+    primera = hub.suscribir([1])
+    assert hub.suscribir([2]) is not None
+    assert hub.suscribir([3]) is None
+    hub.cancelar(primera)
+    assert hub.suscribir([3]) is not None
+    assert hub.estado()['rechazados_total'] == 1
+    print("✅ Suscripciones limitadas por worker")
+
+def test_saldo_ya_difundido_no_se_repite():
+    """publicar_saldos solo envía los saldos distintos de los ya difundidos"""
+    print("=== TEST: Saldos repetidos ===")
+    hub = HubStock()
+    suscripcion = hub.suscribir([1, 2])
+    hub.publicar_saldos({1: 100.0, 2: 50.0}, base=True)
+    assert suscripcion.siguiente(0) is None
+
+    # Commit local: el hook publica el delta con su saldo
+    hub.publicar({1: -5.0}, saldos={1: 95.0})
+    assert suscripcion.siguiente(0)['saldos'] == {'1': 95.0}
+
+    # El sondeo relee el mismo saldo y además ve otro explosivo cambiado en otro worker
+    assert hub.publicar_saldos({1: 95.0, 2: 40.0}) == 1
+    evento = suscripcion.siguiente(0)
+    assert evento['deltas'] == {'2': -10.0} and evento['saldos'] == {'2': 40.0}
+    assert suscripcion.siguiente(0) is None
+    print("✅ Sin eventos duplicados")
+
+def test_sondeo_entrega_commits_de_otro_worker():
+    """Un cambio en stock_saldos hecho fuera del proceso llega al stream"""
+    print("=== TEST: Sondeo de stock_saldos ===")
+    from app import app, db, Explosivo, obtener_capacidades, leer_saldos_actualizados
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add(Explosivo(id=1, codigo='EXP-1', descripcion='Explosivo 1', unidad='UND'))
+        db.session.execute(text("""
+            INSERT INTO stock_saldos (explosivo_id, total_ingresos, total_salidas, total_devoluciones, stock_actual, fecha_actualizacion)
+            VALUES (1, 100, 0, 0, 100, :ahora)
+        """), {'ahora': datetime.now()})
+        db.session.commit()
+        obtener_capacidades(forzar=True)
+
+    hub = HubStock()
+    sondeo = SondeoSaldos(hub, leer_saldos_actualizados, intervalo_seg=0.05)
+    suscripcion = hub.suscribir([1])
+    sondeo.asegurar_hilo()
+    try:
+        while sondeo.lecturas_total == 0:
+            assert suscripcion.siguiente(0.05) is None
+
+        with app.app_context():
+            db.session.execute(text("""
+                UPDATE stock_saldos SET total_salidas = 30, stock_actual = 70, fecha_actualizacion = :ahora
+                WHERE explosivo_id = 1
+            """), {'ahora': datetime.now()})
+            db.session.commit()
+
+        evento = suscripcion.siguiente(5)
+        assert evento['deltas'] == {'1': -30.0} and evento['saldos'] == {'1': 70.0}
+    finally:
+        sondeo.detener()
+    print("✅ Cambio de otro worker difundido")
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Pruebas para el almacén de claves de idempotencia
+No requiere conexión a base de datos
+"""
+
+import sys
+import os
+import threading
+import time
+
+# Agregar el directorio del proyecto al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from idempotencia import AlmacenIdempotencia, clave_valida
+
+RESPUESTA = (200, '{"success": "ok"}', 'application/json')
+
+def test_reintento_devuelve_respuesta_original():
+    """Una clave completada devuelve la misma respuesta; una liberada se procesa de nuevo"""
+    print("=== TEST: Reintentos ===")
+    almacen = AlmacenIdempotencia()
+    estado, _ = almacen.reservar('1:salida:abc12345')
+    assert estado == AlmacenIdempotencia.NUEVA
+    almacen.completar('1:salida:abc12345', RESPUESTA)
+
+    estado, entrada = almacen.reservar('1:salida:abc12345')
+    assert estado == AlmacenIdempotencia.COMPLETADA
+    assert entrada.respuesta.cuerpo == RESPUESTA[1] and entrada.respuesta.codigo == 200
+
+    almacen.reservar('1:salida:fallida1')
+    almacen.liberar('1:salida:fallida1')
+    estado, _ = almacen.reservar('1:salida:fallida1')
+    assert estado == AlmacenIdempotencia.NUEVA
+    print("✅ Reintentos correctos")
+
+def test_doble_clic_espera_al_primero():
+    """La segunda petición con la misma clave recibe la respuesta de la primera"""
+    print("=== TEST: Doble clic ===")
+    almacen = AlmacenIdempotencia()
+    almacen.reservar('1:ingreso:doble123')
+    estado, entrada = almacen.reservar('1:ingreso:doble123')
+    assert estado == AlmacenIdempotencia.EN_PROCESO
+
+    hilo = threading.Timer(0.05, almacen.completar, args=('1:ingreso:doble123', RESPUESTA))
+    hilo.start()
+    respuesta = almacen.esperar(entrada, 2)
+    hilo.join()
+    assert respuesta is not None and respuesta.codigo == 200
+    assert almacen.estado()['repeticiones_total'] == 1
+    print("✅ Doble clic correcto")
+
+def test_limite_y_vencimiento():
+    """El almacén no supera max_claves y olvida las claves vencidas"""
+    print("=== TEST: Límite y TTL ===")
+    almacen = AlmacenIdempotencia(max_claves=3, ttl_seg=60)
+    for i in range(5):
+        almacen.reservar(f'clave-{i:04d}')
+        almacen.completar(f'clave-{i:04d}', RESPUESTA)
+    assert almacen.estado()['claves'] == 3
+    assert almacen.reservar('clave-0000')[0] == AlmacenIdempotencia.NUEVA
+
+    almacen = AlmacenIdempotencia(ttl_seg=0.05)
+    almacen.reservar('vence-0001')
+    almacen.completar('vence-0001', RESPUESTA)
+    time.sleep(0.1)
+    assert almacen.reservar('vence-0001')[0] == AlmacenIdempotencia.NUEVA
+
+    assert clave_valida('550e8400-e29b-41d4-a716-446655440000')
+    assert not clave_valida('corta') and not clave_valida('con espacios 123')
+    print("✅ Límite y TTL correctos")
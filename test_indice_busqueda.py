@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Pruebas para el índice de búsqueda de labores y tipos de actividad
+No requiere conexión a base de datos
+"""
+
+import sys
+import os
+
+# Agregar el directorio del proyecto al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from indice_busqueda import IndiceBusqueda, normalizar_texto
+
+LABORES = [
+    {'id': 1, 'nombre': 'M-1005', 'descripcion': 'Tajo principal'},
+    {'id': 2, 'nombre': 'M-535 V5', 'descripcion': ''},
+    {'id': 3, 'nombre': 'M-535 V5 N', 'descripcion': 'Nivel norte'},
+    {'id': 4, 'nombre': 'P-554', 'descripcion': 'Chimenea'},
+    {'id': 5, 'nombre': 'BERLÍN', 'descripcion': 'Galería antigua'},
+]
+
+def crear_indice(frecuencias=None):
+    indice = IndiceBusqueda('labores')
+    indice.cargar(LABORES, frecuencias)
+    return indice
+
+def nombres(resultados):
+    return [registro['nombre'] for registro in resultados]
+
+def test_normalizacion():
+    """Mayúsculas, tildes y espacios no afectan la comparación"""
+    print("=== TEST: Normalización ===")
+    assert normalizar_texto('  berlín   ') == 'BERLIN'
+    assert normalizar_texto('m-535  v5') == 'M-535 V5'
+    assert normalizar_texto(None) == ''
+    print("✅ Normalización correcta")
+
+def test_prefijo_y_exacta():
+    """La coincidencia exacta va primero, luego los prefijos del nombre"""
+    print("=== TEST: Prefijos ===")
+    indice = crear_indice()
+    assert nombres(indice.buscar('m-535 v5')) == ['M-535 V5', 'M-535 V5 N']
+    assert nombres(indice.buscar('M-')) == ['M-1005', 'M-535 V5', 'M-535 V5 N']
+    assert nombres(indice.buscar('berl')) == ['BERLÍN']
+    print("✅ Prefijos y coincidencia exacta correctos")
+
+def test_subcadena_y_descripcion():
+    """Coincidencias dentro del nombre, por palabra y en la descripción"""
+    print("=== TEST: Subcadenas ===")
+    indice = crear_indice()
+    assert nombres(indice.buscar('554')) == ['P-554']
+    assert nombres(indice.buscar('v5')) == ['M-535 V5', 'M-535 V5 N']
+    assert nombres(indice.buscar('galeria')) == ['BERLÍN']
+    assert nombres(indice.buscar('norte')) == ['M-535 V5 N']
+    assert indice.buscar('XYZ') == []
+    print("✅ Subcadenas correctas")
+
+def test_orden_por_frecuencia():
+    """A igual tipo de coincidencia, primero la labor más usada"""
+    print("=== TEST: Frecuencia de uso ===")
+    indice = crear_indice({'m-535 v5 n': 12, 'M-1005': 3})
+    assert nombres(indice.buscar('M-')) == ['M-535 V5 N', 'M-1005', 'M-535 V5']
+    assert nombres(indice.buscar('', limite=2)) == ['M-535 V5 N', 'M-1005']
+
+    indice.registrar_uso('P-554')
+    assert nombres(indice.buscar('', limite=3)) == ['M-535 V5 N', 'M-1005', 'P-554']
+    print("✅ Orden por frecuencia correcto")
+
+def test_invalidacion():
+    """Un índice invalidado no responde hasta recargarse"""
+    print("=== TEST: Invalidación ===")
+    indice = crear_indice()
+    indice.invalidar()
+    assert not indice.cargado
+    assert indice.buscar('M') == []
+
+    indice.cargar(LABORES + [{'id': 6, 'nombre': 'N-830', 'descripcion': None}])
+    assert nombres(indice.buscar('n-8')) == ['N-830']
+    assert len(indice.todos()) == 6
+    print("✅ Invalidación y recarga correctas")
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Pruebas del tamaño de lote de las escrituras de stock_diario en SQL Server
+Compila las sentencias con el dialecto mssql+pyodbc (marcadores ?) y verifica que
+ningún lote supere el límite de 2100 parámetros. No requiere conexión a base de datos.
+"""
+
+import sys
+import os
+from datetime import date, datetime
+
+# Agregar el directorio del proyecto al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from sqlalchemy.dialects.mssql import pyodbc
+
+from app import dividir_en_lotes
+from recalcular_stock_automatico import (sentencia_actualizar_stock_diario, sentencia_insertar_stock_diario,
+                                         PARAMETROS_FILA_ACTUALIZAR, PARAMETROS_FILA_INSERTAR)
+
+LIMITE_SQL_SERVER = 2100
+FILAS = 5000
+
+def contar_marcadores(sentencia):
+    """Parámetros que pyodbc envía a SQL Server para la sentencia"""
+    return sentencia.compile(dialect=pyodbc.dialect(paramstyle='qmark')).string.count('?')
+
+def test_insert_por_lote_bajo_el_limite():
+    """Cada INSERT en lote envía menos de 2100 marcadores"""
+    print("=== TEST: INSERT en lote ===")
+    insertar = [((i, date(2025, 8, 1), 'dia'), (10, 12)) for i in range(FILAS)]
+    lotes = list(dividir_en_lotes(insertar, PARAMETROS_FILA_INSERTAR))
+    assert sum(len(lote) for lote in lotes) == FILAS
+
+    for lote in lotes:
+        sentencia, _ = sentencia_insertar_stock_diario(lote, 'Creado automáticamente', datetime(2025, 8, 1))
+        marcadores = contar_marcadores(sentencia)
+        assert marcadores == len(lote) * PARAMETROS_FILA_INSERTAR
+        assert marcadores <= LIMITE_SQL_SERVER, marcadores
+    print(f"✅ {len(lotes)} lotes de hasta {len(lotes[0])} filas")
+
+def test_update_por_lote_bajo_el_limite():
+    """Cada UPDATE con CASE envía menos de 2100 marcadores"""
+    print("=== TEST: UPDATE en lote ===")
+    actualizar = [(i, None, (0, 0), (10, 12)) for i in range(FILAS)]
+    for lote in dividir_en_lotes(actualizar, PARAMETROS_FILA_ACTUALIZAR, parametros_fijos=1):
+        sentencia, _ = sentencia_actualizar_stock_diario(lote, 'Recalculado automáticamente')
+        marcadores = contar_marcadores(sentencia)
+        assert marcadores == len(lote) * PARAMETROS_FILA_ACTUALIZAR + 1
+        assert marcadores <= LIMITE_SQL_SERVER, marcadores
+    print("✅ UPDATE dentro del límite")
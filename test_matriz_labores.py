@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Pruebas de calcular_matriz_labores sobre una base SQLite en memoria
+Verifica que las salidas se agrupen por fecha (no por año, como haría CAST AS DATE
+en SQLite), turno y labor.
+"""
+
+import sys
+import os
+from datetime import date, datetime
+
+# Agregar el directorio del proyecto al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+from app import app, db, Explosivo, Salida, calcular_matriz_labores
+
+def registrar_salida(explosivo_id, labor, cantidad, guardia, fecha, hora):
+    db.session.add(Salida(explosivo_id=explosivo_id, labor=labor, cantidad=cantidad, guardia=guardia,
+                          fecha_salida=datetime.combine(fecha, datetime.min.time()).replace(hour=hora)))
+
+def test_matriz_agrupa_por_fecha():
+    """Dos días del mismo año quedan en celdas distintas con su consumo por labor"""
+    print("=== TEST: Matriz de labores por fecha ===")
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add(Explosivo(id=1, codigo='EXP-1', descripcion='Explosivo 1', unidad='UND'))
+        registrar_salida(1, 'M-100', 5, 'dia', date(2025, 8, 1), 9)
+        registrar_salida(1, 'M-100', 3, 'dia', date(2025, 8, 1), 11)
+        registrar_salida(1, 'M-200', 4, 'noche', date(2025, 8, 1), 21)
+        registrar_salida(1, 'M-100', 7, 'dia', date(2025, 8, 2), 10)
+        db.session.commit()
+
+        matriz = calcular_matriz_labores(date(2025, 8, 1), date(2025, 8, 2))
+        assert matriz['celdas'] == {
+            (1, date(2025, 8, 1), 'dia'): {'M-100': 8.0},
+            (1, date(2025, 8, 1), 'noche'): {'M-200': 4.0},
+            (1, date(2025, 8, 2), 'dia'): {'M-100': 7.0},
+        }
+        assert matriz['labores_por_turno'] == {'dia': ['M-100'], 'noche': ['M-200']}
+    print("✅ Consumo agrupado por fecha, turno y labor")
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+Pruebas para la agenda de pre-inicialización de turnos
+No requiere conexión a base de datos
+"""
+
+import sys
+import os
+import time
+from datetime import datetime, date
+
+# Agregar el directorio del proyecto al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from preinicializacion_turnos import PreinicializadorTurnos, siguiente_limite_turno
+
+def test_siguiente_limite():
+    """Los límites son 00:00, 06:00 y 18:00 (cambio de fecha y de guardia)"""
+    print("=== TEST: Límites de turno ===")
+    assert siguiente_limite_turno(datetime(2025, 3, 10, 5, 55)) == datetime(2025, 3, 10, 6, 0)
+    assert siguiente_limite_turno(datetime(2025, 3, 10, 6, 0)) == datetime(2025, 3, 10, 18, 0)
+    assert siguiente_limite_turno(datetime(2025, 3, 10, 17, 59, 59)) == datetime(2025, 3, 10, 18, 0)
+    assert siguiente_limite_turno(datetime(2025, 3, 10, 23, 55)) == datetime(2025, 3, 11, 0, 0)
+    assert siguiente_limite_turno(datetime(2025, 12, 31, 18, 0)) == datetime(2026, 1, 1, 0, 0)
+    print("✅ Límites correctos")
+
+def test_agenda_y_solicitudes():
+    """Al arrancar asegura el día en curso, anticipa el próximo límite y atiende solicitudes"""
+    print("=== TEST: Agenda ===")
+    llamadas = []
+
+    def preinicializar(fecha, anticipado):
+        llamadas.append(('preinicializar', fecha, anticipado))
+        return 2
+
+    def realinear(fecha):
+        llamadas.append(('realinear', fecha))
+        return 0
+
+    # Antelación de un día: el próximo límite ya está dentro de la ventana
+    preinicializador = PreinicializadorTurnos(preinicializar, realinear, antelacion_seg=86400, margen_seg=0)
+    limite = siguiente_limite_turno(datetime.now())
+    preinicializador.asegurar_hilo()
+    preinicializador.solicitar(date(2025, 1, 15))
+    time.sleep(0.3)
+    preinicializador.detener()
+
+    assert llamadas[0] == ('preinicializar', date.today(), False), llamadas
+    assert ('preinicializar', limite.date(), True) in llamadas
+    assert ('preinicializar', date(2025, 1, 15), False) in llamadas
+    assert preinicializador.estado()['filas_creadas_total'] >= 6
+    print("✅ Agenda correcta")
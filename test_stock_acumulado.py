@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Pruebas para el motor de recálculo acumulado de stock_diario
+No requiere conexión a base de datos
+"""
+
+import sys
+import os
+from datetime import date
+
+# Agregar el directorio del proyecto al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stock_acumulado import (calcular_saldos_acumulados, comparar_con_existentes,
+                             detectar_rupturas_continuidad, resumir_diferencias)
+
+D1 = date(2025, 8, 1)
+D2 = date(2025, 8, 2)
+
+MOVIMIENTOS = [
+    # (explosivo_id, fecha, guardia, ingresos, salidas, devoluciones)
+    (1, D1, 'dia', 100, 30, 0),
+    (1, D1, 'noche', 0, 20, 5),
+    (1, D2, 'noche', 50, 0, 0),
+    (2, D2, 'dia', 10, 4, 0),
+]
+
+def test_suma_acumulada():
+    """El stock inicial de cada turno es el final del turno anterior del mismo explosivo"""
+    print("=== TEST: Suma acumulada ===")
+    saldos = calcular_saldos_acumulados(MOVIMIENTOS)
+    assert saldos[(1, D1, 'dia')] == (0, 70)
+    assert saldos[(1, D1, 'noche')] == (70, 55)
+    assert saldos[(1, D2, 'noche')] == (55, 105)
+    assert saldos[(2, D2, 'dia')] == (0, 6)
+    print("✅ Saldos acumulados correctos")
+
+def test_continuidad_y_saldo_previo():
+    """Los turnos sin movimientos arrastran el saldo; el saldo previo se respeta"""
+    print("=== TEST: Continuidad ===")
+    saldos = calcular_saldos_acumulados(MOVIMIENTOS, [(1, D2, 'dia'), (2, D1, 'noche')], {1: 10})
+    assert saldos[(1, D1, 'dia')] == (10, 80)
+    assert saldos[(1, D2, 'dia')] == (65, 65)
+    assert saldos[(1, D2, 'noche')] == (65, 115)
+    assert saldos[(2, D1, 'noche')] == (0, 0)
+    assert saldos[(2, D2, 'dia')] == (0, 6)
+    print("✅ Continuidad correcta")
+
+def test_solo_diferencias():
+    """Solo se actualizan las filas que cambian y se insertan las que faltan"""
+    print("=== TEST: Diferencias ===")
+    objetivo = calcular_saldos_acumulados(MOVIMIENTOS)
+    existentes = {
+        (1, D1, 'dia'): (11, 0, 70),
+        (1, D1, 'noche'): (12, 70, 60),
+        (1, D2, 'noche'): (13, 55.004, 105),
+    }
+    actualizar, insertar = comparar_con_existentes(objetivo, existentes)
+    assert actualizar == [(12, (1, D1, 'noche'), (70.0, 60.0), (70, 55))]
+    assert insertar == [((2, D2, 'dia'), (0, 6))]
+    print("✅ Diferencias correctas")
+
+def test_rupturas_y_resumen():
+    """Se detectan saltos entre el final de un turno y el inicial del siguiente"""
+    print("=== TEST: Rupturas de continuidad ===")
+    existentes = {
+        (1, D1, 'dia'): (11, 0, 70),
+        (1, D1, 'noche'): (12, 70, 55),
+        (1, D2, 'dia'): (13, 50, 50),
+        (2, D1, 'dia'): (14, 8, 8),
+    }
+    assert detectar_rupturas_continuidad(existentes) == [((1, D2, 'dia'), 55.0, 50.0)]
+
+    actualizar = [(13, (1, D2, 'dia'), (50.0, 50.0), (55, 55))]
+    resumen = resumir_diferencias(actualizar, [((2, D2, 'dia'), (8, 8))], [((1, D2, 'dia'), 55.0, 50.0)])
+    assert resumen['actualizar'] == 1 and resumen['insertar'] == 1
+    assert resumen['explosivos_afectados'] == 2
+    assert resumen['delta_max'] == 5 and resumen['rupturas_continuidad'] == 1
+    print("✅ Rupturas y resumen correctos")
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Pruebas para el almacenamiento disperso de stock_diario
+No requiere conexión a base de datos
+"""
+
+import sys
+import os
+from datetime import date, timedelta
+
+# Agregar el directorio del proyecto al path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stock_diario_disperso import (filas_compactables, derivar_turnos, observaciones_derivadas,
+                                   sql_vista_dispersa, RESPONSABLE_DERIVADO, VISTA_POWERBI_DISPERSA)
+
+def generar_filas_densas(dias=6):
+    """Una fila por turno y explosivo; el explosivo 1 tiene movimientos en algunos turnos"""
+    netos = {(1, 1, 'dia'): 50, (1, 3, 'noche'): -20, (2, 0, 'dia'): 10}
+    filas = []
+    saldos = {1: 100, 2: 0}
+    fila_id = 0
+    for dia in range(dias):
+        fecha = date(2025, 5, 1) + timedelta(days=dia)
+        for guardia in ('dia', 'noche'):
+            for explosivo_id in (1, 2):
+                neto = netos.get((explosivo_id, dia, guardia), 0)
+                inicial = saldos[explosivo_id]
+                saldos[explosivo_id] = inicial + neto
+                fila_id += 1
+                filas.append((fila_id, explosivo_id, fecha, guardia, inicial, saldos[explosivo_id],
+                              RESPONSABLE_DERIVADO, observaciones_derivadas(fecha, guardia), bool(neto), bool(neto)))
+    return filas
+
+def test_compactar_y_derivar_reproduce_lo_denso():
+    """Después de borrar las filas compactables, la derivación da los mismos turnos"""
+    print("=== TEST: Compactar y derivar ===")
+    filas = generar_filas_densas()
+    borrar = set(filas_compactables(filas))
+    assert borrar and len(borrar) < len(filas)
+
+    densas = {(f[1], f[2], f[3]): (f[4], f[5], f[6], f[7]) for f in filas}
+    guardadas = {(f[1], f[2], f[3]): (f[4], f[5], f[6], f[7]) for f in filas if f[0] not in borrar}
+    calendario = {(f[2], f[3]) for f in filas}
+    assert derivar_turnos(guardadas, calendario, (1, 2)) == densas
+
+    # Se conserva la fila base de cada explosivo y toda fila con movimientos
+    assert 1 not in borrar and 2 not in borrar
+    assert not any(f[8] and f[0] in borrar for f in filas)
+    print(f"✅ {len(borrar)} de {len(filas)} filas compactadas sin cambiar los turnos visibles")
+
+def test_filas_que_se_conservan():
+    """Etiquetas distintas, saldo distinto o turnos repetidos no se compactan"""
+    print("=== TEST: Filas conservadas ===")
+    f1, f2, f3 = date(2025, 5, 1), date(2025, 5, 2), date(2025, 5, 3)
+    base = (1, 7, f1, 'dia', 10, 10, 'Juan', 'Conteo', False, False)
+    filas = [
+        base,
+        (2, 7, f1, 'noche', 10, 10, 'Sistema', 'Auto-inicializado 2025-05-01', False, False),
+        (3, 7, f2, 'dia', 10, 10, RESPONSABLE_DERIVADO, observaciones_derivadas(f2, 'dia'), False, False),
+        (4, 7, f2, 'noche', 12, 12, RESPONSABLE_DERIVADO, observaciones_derivadas(f2, 'noche'), False, False),
+        (5, 7, f3, 'dia', 12, 12, RESPONSABLE_DERIVADO, observaciones_derivadas(f3, 'dia'), False, False),
+        (6, 7, f3, 'dia', 12, 12, RESPONSABLE_DERIVADO, observaciones_derivadas(f3, 'dia'), False, False),
+    ]
+    assert filas_compactables(filas) == [3]
+    assert filas_compactables(filas, normalizar_etiquetas=True) == [2, 3]
+    print("✅ Filas conservadas correctamente")
+
+def test_vista_por_dialecto():
+    """La vista usa TOP 1 y el filtro de activos en SQL Server, LIMIT 1 en SQLite"""
+    print("=== TEST: Vista dispersa ===")
+    mssql = sql_vista_dispersa('mssql')
+    sqlite = sql_vista_dispersa('sqlite')
+    assert 'TOP 1' in mssql and 'e.activo = 1' in mssql and 'LIMIT' not in mssql
+    assert 'LIMIT 1' in sqlite and 'TOP 1' not in sqlite and 'activo' not in sqlite
+    assert all('turnos_calendario' in sql and 'vw_stock_diario_simple' in sql for sql in (mssql, sqlite))
+    assert all('stock_diario_id' in sql for sql in (mssql, sqlite))
+    # Power BI lee los turnos de la vista dispersa, no de stock_diario
+    assert 'FROM vw_stock_diario_simple v' in VISTA_POWERBI_DISPERSA
+    assert 'FROM stock_diario sd' not in VISTA_POWERBI_DISPERSA
+    assert observaciones_derivadas(date(2025, 5, 1), 'noche') == 'Turno NOCHE inicializado automáticamente - 2025-05-01'
+    print("✅ Vista dispersa correcta")